@@ -139,7 +139,8 @@ def create_standard_policy(stack: core.Stack, iot_scope: core.Construct) -> None
                 'Resource': [
                     f'arn:aws:iot:{stack.region}:{stack.account}:topic/$aws/things/${{iot:Connection.Thing.ThingName}}/shadow/*',
                     f'arn:aws:iot:{stack.region}:{stack.account}:topic/$aws/things/${{iot:Connection.Thing.ThingName}}/jobs/*',
-                    f'arn:aws:iot:{stack.region}:{stack.account}:topic/$aws/rules/{cdk.topic_prefix}/things/${{iot:Connection.Thing.ThingName}}/*'
+                    f'arn:aws:iot:{stack.region}:{stack.account}:topic/$aws/rules/{cdk.topic_prefix}/things/${{iot:Connection.Thing.ThingName}}/*',
+                    f'arn:aws:iot:{stack.region}:{stack.account}:topic/$aws/rules/{cdk.topic_prefix}_batch/things/${{iot:Connection.Thing.ThingName}}/*'
                 ]
             },
             {
@@ -1,6 +1,7 @@
 from aws_cdk import aws_iam
 from aws_cdk import aws_iot
 from aws_cdk import aws_lambda
+from aws_cdk import aws_sqs
 from aws_cdk import core
 
 from baseline_cdk.util import cdk
@@ -11,6 +12,7 @@ def create(stack: core.Stack) -> None:
     if not iot_scope: iot_scope = core.Construct(stack, 'Iot')
 
     lambda_function: aws_lambda.CfnFunction = cdk.find_resource(stack, 'IngestLambda/Function')
+    queue: aws_sqs.CfnQueue = cdk.find_resource(stack, 'IngestLambda/Queue')
 
     republish_role = aws_iam.CfnRole(
         iot_scope, 'MqttRepublishRole',
@@ -50,7 +52,7 @@ def create(stack: core.Stack) -> None:
                 f'       traceid() as traceId,',
                 f'       clientid() as clientId,',
                 f'       principal() as principal,',
-                f'       *',
+                f'       encode(*, "base64") as payload',
                 f' where not endswith(topic(), "/accepted")',
                 f'   and not endswith(topic(), "/rejected")',
             ]),
@@ -73,6 +75,71 @@ def create(stack: core.Stack) -> None:
     topic_rule.add_depends_on(lambda_function)
     topic_rule.add_depends_on(republish_role)
 
+    queue_role = aws_iam.CfnRole(
+        iot_scope, 'QueueRole',
+        role_name=f'{cdk.app_name}-mqtt-queue',
+        assume_role_policy_document={
+            'Version': '2012-10-17',
+            'Statement': [{
+                'Effect': 'Allow',
+                'Action': 'sts:AssumeRole',
+                'Principal': {
+                    'Service': 'iot.amazonaws.com'
+                }
+            }]
+        },
+        policies=[aws_iam.CfnRole.PolicyProperty(
+            policy_name=f'{cdk.app_name}-mqtt-queue',
+            policy_document={
+                'Version': '2012-10-17',
+                'Statement': [{
+                    'Effect': 'Allow',
+                    'Action': 'sqs:SendMessage',
+                    'Resource': queue.attr_arn
+                }]
+            }
+        )]
+    )
+
+    # Devices publish logs and telemetry to $aws/rules/<topic_prefix>_batch/... when ingest_batch is set, and
+    # this rule queues them for the ingest lambda to take in batches instead of being invoked for each one.
+    # The topic is given the same prefix as the rule above, so the lambda routes both the same way.
+    # noinspection SqlDialectInspection
+    # noinspection SqlNoDataSourceInspection
+    batch_topic_rule = aws_iot.CfnTopicRule(
+        iot_scope, 'BatchTopicRule',
+        rule_name=f'{cdk.topic_prefix}_batch',
+        topic_rule_payload=aws_iot.CfnTopicRule.TopicRulePayloadProperty(
+            aws_iot_sql_version='2016-03-23',
+            sql='\n'.join([
+                f'select concat("$aws/rules/{cdk.topic_prefix}/", topic()) as topic,',
+                f'       traceid() as traceId,',
+                f'       clientid() as clientId,',
+                f'       principal() as principal,',
+                f'       encode(*, "base64") as payload',
+            ]),
+            actions=[aws_iot.CfnTopicRule.ActionProperty(
+                sqs=aws_iot.CfnTopicRule.SqsActionProperty(
+                    queue_url=queue.ref,
+                    role_arn=queue_role.attr_arn,
+                    use_base64=False
+                )
+            )],
+            error_action=aws_iot.CfnTopicRule.ActionProperty(
+                republish=aws_iot.CfnTopicRule.RepublishActionProperty(
+                    role_arn=republish_role.attr_arn,
+                    topic=f'{cdk.topic_prefix}/${{topic()}}/rejected',
+                    qos=1
+                )
+            ),
+            rule_disabled=False
+        )
+    )
+
+    batch_topic_rule.add_depends_on(queue)
+    batch_topic_rule.add_depends_on(queue_role)
+    batch_topic_rule.add_depends_on(republish_role)
+
 
 def strip_sides(s: str) -> str:
     lines = []
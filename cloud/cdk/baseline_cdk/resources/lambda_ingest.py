@@ -7,6 +7,7 @@ from aws_cdk import aws_ec2
 from aws_cdk import aws_iam
 from aws_cdk import aws_lambda
 from aws_cdk import aws_logs
+from aws_cdk import aws_sqs
 from aws_cdk import core
 from aws_cdk.core import RemovalPolicy
 
@@ -20,6 +21,11 @@ from baseline_cdk.util.zip import zip_all
 
 lambda_type = 'ingest'
 
+# messages from the batch topic rule are handed to the function up to queue_batch_size at a time, waiting
+# up to queue_batch_window seconds for a batch to fill
+queue_batch_size = 1000
+queue_batch_window = 5
+
 
 def create_layer_zip() -> str:
     this_dir = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
@@ -127,12 +133,16 @@ def create(stack: core.Stack) -> None:
                         'iot:DeleteCertificate',
                         'iot:DescribeCACertificate',
                         'iot:Publish',
+                        'cloudwatch:PutMetricData',
                         'logs:CreateLogGroup',
                         'logs:CreateLogStream',
                         'logs:DescribeLogStreams',
                         'logs:PutLogEvents',
                         'logs:PutRetentionPolicy',
                         'secretsmanager:GetSecretValue',
+                        'sqs:DeleteMessage',
+                        'sqs:GetQueueAttributes',
+                        'sqs:ReceiveMessage',
                         'ssm:GetParameter',
                         'ssm:GetParameters'
                     ],
@@ -200,6 +210,38 @@ def create(stack: core.Stack) -> None:
 
     iot_permission.add_depends_on(lambda_function)
 
+    dead_letter_queue = aws_sqs.CfnQueue(
+        lambda_scope, 'DeadLetterQueue',
+        queue_name=f'{cdk.app_name}-{lambda_type}-dead-letter',
+        message_retention_period=14 * 24 * 60 * 60
+    )
+
+    # the visibility timeout must be at least the function timeout, six times gives room for retries
+    queue = aws_sqs.CfnQueue(
+        lambda_scope, 'Queue',
+        queue_name=f'{cdk.app_name}-{lambda_type}',
+        visibility_timeout=6 * 30,
+        message_retention_period=24 * 60 * 60,
+        redrive_policy={
+            'deadLetterTargetArn': dead_letter_queue.attr_arn,
+            'maxReceiveCount': 5
+        }
+    )
+
+    queue.add_depends_on(dead_letter_queue)
+
+    queue_mapping = aws_lambda.CfnEventSourceMapping(
+        lambda_scope, 'QueueMapping',
+        function_name=lambda_function.ref,
+        event_source_arn=queue.attr_arn,
+        batch_size=queue_batch_size,
+        maximum_batching_window_in_seconds=queue_batch_window,
+        enabled=True
+    )
+
+    queue_mapping.add_depends_on(lambda_function)
+    queue_mapping.add_depends_on(queue)
+
     lambda_log_group = aws_logs.CfnLogGroup(
         lambda_scope, 'LogGroup',
         log_group_name=f'/aws/lambda/{lambda_function.ref}',
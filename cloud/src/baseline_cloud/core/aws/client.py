@@ -0,0 +1,62 @@
+import threading
+import typing
+
+import boto3
+import botocore.config
+
+from baseline_cloud.core.config import config
+
+# Service clients are made on first use and kept for the life of the Lambda container, so a cold start only
+# pays for the clients the invocation needs, and a warm one for none. They share one botocore Config; the
+# "aws_*" keys in config.json tune it. Tests swap a client for a stub (e.g. botocore.stub.Stubber's client,
+# or any object with the same methods) with register(), which the lazy clients pick up on their next call.
+options = {
+    'max_pool_connections': config.aws_max_pool_connections or 16,
+    'connect_timeout': config.aws_connect_timeout or 2,
+    'read_timeout': config.aws_read_timeout or 10,
+    'retries': {
+        'mode': 'adaptive',
+        'max_attempts': config.aws_max_attempts or 5
+    },
+    'tcp_keepalive': True
+}
+
+# tcp_keepalive needs botocore 1.27.84, older runtimes reject the option
+client_config = botocore.config.Config(**{k: v for k, v in options.items() if k in botocore.config.Config.OPTION_DEFAULTS})
+
+clients: typing.Dict[str, typing.Any] = {}
+
+# boto3's default session isn't safe to create clients from on more than one thread at a time
+lock = threading.Lock()
+
+
+def get(service_name: str) -> typing.Any:
+    client = clients.get(service_name)
+    if client is None:
+        with lock:
+            client = clients.get(service_name)
+            if client is None:
+                client = clients[service_name] = boto3.client(service_name, config=client_config)
+    return client
+
+
+def register(service_name: str, client: typing.Any) -> None:
+    clients[service_name] = client
+
+
+def reset() -> None:
+    clients.clear()
+
+
+class LazyClient(object):
+    # stands in for the client of service_name at module level, the client is only made when first used
+
+    def __init__(self, service_name: str) -> None:
+        self.service_name = service_name
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(get(self.service_name), name)
+
+
+def lazy(service_name: str) -> LazyClient:
+    return LazyClient(service_name)
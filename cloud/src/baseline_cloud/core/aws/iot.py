@@ -1,8 +1,9 @@
 import typing
 
-import boto3
+import baseline_cloud.core.aws.client
+from baseline_cloud.core import aws
 
-iot_client = boto3.client('iot')
+iot_client = aws.client.lazy('iot')
 
 
 def describe_thing(thing_name: str) -> dict:
@@ -1,44 +1,291 @@
 import os
+import time
+import typing
 
-from redis import Redis
-
-import baseline_cloud.core.aws.ssm
-from baseline_cloud.core import aws
+import baseline_cloud.core.logging
+from baseline_cloud import core
 from baseline_cloud.core.config import config
 
-if os.environ.get('USE_MOCK_REDIS') == '1':
-    class Redis(object):
+# The client is made on first use, not at import, so importing this module costs nothing until Redis is
+# needed. It is backed by an explicit connection pool whose connections are checked with a PING when idle
+# for longer than redis_health_check_interval, and every call is timed into latencies. With USE_MOCK_REDIS=1
+# the client is MockRedis instead, and MOCK_REDIS_RTT_MS sets the round trip it simulates.
+DEFAULT_TTL = 86400
+
+redis_client: typing.Optional[typing.Any] = None
+
+
+class Latency(object):
 
-        def __init__(self, *args, **kwargs) -> None:
-            super().__init__()
-            self.data = {}
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
 
-        def set(self, name: str, value: str, *args, **kwargs) -> None:
-            self.data[name] = value
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
 
-        def get(self, name: str) -> str:
-            return self.data.get(name)
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count * 1000, 3) if self.count else 0,
+            'max_ms': round(self.max * 1000, 3)
+        }
 
-        def delete(self, *names: str) -> None:
-            for name in names:
-                self.data.pop(name, None)
 
-redis_client = Redis(
-    host=aws.ssm.get_parameter(f'/{config.app_name}/redis-address'),
-    port=int(aws.ssm.get_parameter(f'/{config.app_name}/redis-port'))
-)
+latencies: typing.Dict[str, Latency] = {}
 
 
-def set(key: str, value: str, ttl: int = 86400) -> None:
-    redis_client.set(name=key, value=value, ex=ttl)
+def timed(op: str, started: float) -> None:
+    elapsed = time.perf_counter() - started
+    latencies.setdefault(op, Latency()).add(elapsed)
+    slow_ms = config.redis_slow_call_ms
+    if slow_ms and elapsed * 1000 >= slow_ms:
+        core.logging.logger.warning(f'Redis {op} took {elapsed * 1000:.1f}ms')
 
 
-def delete(key: str) -> None:
-    redis_client.delete(key)
+def latency_summary() -> typing.Dict[str, dict]:
+    return {op: latency.summary() for op, latency in latencies.items()}
 
 
-def get(key: str) -> str:
-    value = redis_client.get(key)
-    if value and type(value) == bytes:
-        value = value.decode('utf-8')
+def decode(value: typing.Any) -> typing.Any:
+    if type(value) == bytes: return value.decode('utf-8')
     return value
+
+
+class MockRedis(object):
+    # An in-memory stand in for redis.Redis with the commands used here. Keys expire like they do in Redis,
+    # and each command, or each pipeline, sleeps for one round trip of rtt seconds.
+
+    def __init__(self, rtt: float = 0) -> None:
+        self.rtt = rtt
+        self.data: typing.Dict[str, typing.Tuple[bytes, typing.Optional[float]]] = {}
+
+    def round_trip(self) -> None:
+        if self.rtt: time.sleep(self.rtt)
+
+    def lookup(self, name: str) -> typing.Optional[bytes]:
+        item = self.data.get(name)
+        if item is None: return None
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            del self.data[name]
+            return None
+        return value
+
+    def store(self, name: str, value: typing.Any, ex: typing.Optional[float] = None) -> None:
+        if type(value) != bytes: value = str(value).encode('utf-8')
+        self.data[name] = (value, time.monotonic() + ex if ex else None)
+
+    def ping(self) -> bool:
+        self.round_trip()
+        return True
+
+    def get(self, name: str) -> typing.Optional[bytes]:
+        self.round_trip()
+        return self.lookup(name)
+
+    def mget(self, keys: typing.List[str]) -> typing.List[typing.Optional[bytes]]:
+        self.round_trip()
+        return [self.lookup(key) for key in keys]
+
+    def set(self, name: str, value: typing.Any, ex: typing.Optional[float] = None, nx: bool = False, xx: bool = False) -> typing.Optional[bool]:
+        self.round_trip()
+        exists = self.lookup(name) is not None
+        if (nx and exists) or (xx and not exists): return None
+        self.store(name, value, ex)
+        return True
+
+    def mset(self, mapping: typing.Dict[str, typing.Any]) -> bool:
+        self.round_trip()
+        for name, value in mapping.items():
+            self.store(name, value)
+        return True
+
+    def delete(self, *names: str) -> int:
+        self.round_trip()
+        deleted = 0
+        for name in names:
+            if self.lookup(name) is not None:
+                del self.data[name]
+                deleted += 1
+        return deleted
+
+    def expire(self, name: str, time: float) -> bool:
+        self.round_trip()
+        value = self.lookup(name)
+        if value is None: return False
+        self.store(name, value, time)
+        return True
+
+    def ttl(self, name: str) -> int:
+        self.round_trip()
+        if self.lookup(name) is None: return -2
+        expires = self.data[name][1]
+        return -1 if expires is None else round(expires - time.monotonic())
+
+    def pipeline(self, transaction: bool = True) -> 'MockPipeline':
+        return MockPipeline(self)
+
+    def close(self) -> None:
+        pass
+
+
+class MockPipeline(object):
+
+    def __init__(self, client: MockRedis) -> None:
+        self.client = client
+        self.command_stack: typing.List[typing.Tuple[str, tuple, dict]] = []
+
+    def __len__(self) -> int:
+        return len(self.command_stack)
+
+    def __getattr__(self, name: str) -> typing.Callable[..., 'MockPipeline']:
+        getattr(self.client, name)  # raises for commands the mock doesn't have
+
+        def queue(*args, **kwargs) -> 'MockPipeline':
+            self.command_stack.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self) -> typing.List[typing.Any]:
+        # the whole stack is one round trip, and nothing else runs in between, like MULTI/EXEC
+        self.client.round_trip()
+        rtt, self.client.rtt = self.client.rtt, 0
+        try:
+            return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.command_stack]
+        finally:
+            self.client.rtt = rtt
+            self.command_stack = []
+
+    def reset(self) -> None:
+        self.command_stack = []
+
+
+def create_client() -> typing.Any:
+    if os.environ.get('USE_MOCK_REDIS') == '1':
+        return MockRedis(rtt=float(os.environ.get('MOCK_REDIS_RTT_MS') or 0) / 1000)
+
+    # imported here so the mock runs without redis, or boto3 for the SSM parameters, installed
+    import redis
+    import baseline_cloud.core.aws.ssm
+    from baseline_cloud.core import aws
+
+    pool = redis.ConnectionPool(
+        host=aws.ssm.get_parameter(f'/{config.app_name}/redis-address'),
+        port=int(aws.ssm.get_parameter(f'/{config.app_name}/redis-port')),
+        max_connections=config.redis_max_connections or 8,
+        health_check_interval=config.redis_health_check_interval or 30,
+        socket_connect_timeout=config.redis_connect_timeout or 1,
+        socket_timeout=config.redis_timeout or 1,
+        socket_keepalive=True,
+        retry_on_timeout=True
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+def client() -> typing.Any:
+    global redis_client
+    if redis_client is None:
+        redis_client = create_client()
+    return redis_client
+
+
+class Pipeline(object):
+    # Commands queued in the with block are sent together when it exits, in one round trip, and inside
+    # MULTI/EXEC when transaction is set. Their replies, decoded, are in results afterwards.
+    #
+    #   with aws.redis.pipeline() as pipe:
+    #       pipe.get('a')
+    #       pipe.set('b', '1', ex=60)
+    #   a, _ = pipe.results
+
+    def __init__(self, transaction: bool = True) -> None:
+        self.pipe = client().pipeline(transaction=transaction)
+        self.results: typing.List[typing.Any] = []
+
+    def __enter__(self) -> 'Pipeline':
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        try:
+            if exc_type is None and len(self.pipe): self.execute()
+        finally:
+            self.pipe.reset()
+
+    def __getattr__(self, name: str) -> typing.Callable[..., 'Pipeline']:
+        command = getattr(self.pipe, name)
+
+        def queue(*args, **kwargs) -> 'Pipeline':
+            command(*args, **kwargs)
+            return self
+
+        return queue
+
+    def execute(self) -> typing.List[typing.Any]:
+        started = time.perf_counter()
+        try:
+            self.results = [decode(result) for result in self.pipe.execute()]
+        finally:
+            timed('pipeline', started)
+        return self.results
+
+
+def pipeline(transaction: bool = True) -> Pipeline:
+    return Pipeline(transaction)
+
+
+def ping() -> bool:
+    started = time.perf_counter()
+    try:
+        return client().ping()
+    finally:
+        timed('ping', started)
+
+
+def set(key: str, value: str, ttl: int = DEFAULT_TTL) -> None:
+    started = time.perf_counter()
+    try:
+        client().set(name=key, value=value, ex=ttl)
+    finally:
+        timed('set', started)
+
+
+def mset(mapping: typing.Dict[str, str], ttl: int = DEFAULT_TTL) -> None:
+    # MSET can't expire keys, so each is a SET in one pipeline, a single round trip either way
+    started = time.perf_counter()
+    try:
+        pipe = client().pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(key, value, ex=ttl)
+        pipe.execute()
+    finally:
+        timed('mset', started)
+
+
+def delete(*keys: str) -> int:
+    started = time.perf_counter()
+    try:
+        return client().delete(*keys)
+    finally:
+        timed('delete', started)
+
+
+def get(key: str) -> typing.Optional[str]:
+    started = time.perf_counter()
+    try:
+        return decode(client().get(key))
+    finally:
+        timed('get', started)
+
+
+def mget(keys: typing.List[str]) -> typing.List[typing.Optional[str]]:
+    if not keys: return []
+    started = time.perf_counter()
+    try:
+        return [decode(value) for value in client().mget(keys)]
+    finally:
+        timed('mget', started)
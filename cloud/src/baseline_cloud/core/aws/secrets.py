@@ -1,9 +1,10 @@
 import base64
 import typing
 
-import boto3
+import baseline_cloud.core.aws.client
+from baseline_cloud.core import aws
 
-secrets_client = boto3.client('secretsmanager')
+secrets_client = aws.client.lazy('secretsmanager')
 
 
 def get_secret_value(name: str) -> typing.Union[str, bytes]:
@@ -0,0 +1,28 @@
+import typing
+
+import baseline_cloud.core.aws.client
+from baseline_cloud.core import aws
+
+sqs_client = aws.client.lazy('sqs')
+
+# DeleteMessageBatch accepts up to 10 entries per request
+MAX_DELETE_ENTRIES = 10
+
+
+def queue_url(queue_arn: str) -> str:
+    # arn:aws:sqs:<region>:<account>:<name>
+    _, _, _, region, account, name = queue_arn.split(':')
+    return f'https://sqs.{region}.amazonaws.com/{account}/{name}'
+
+
+def delete_messages(records: typing.List[dict]) -> None:
+    # deletes the records of a Lambda SQS event, so only the others are received again when the invocation fails
+    queues: typing.Dict[str, typing.List[dict]] = {}
+    for record in records:
+        queues.setdefault(record['eventSourceARN'], []).append(record)
+
+    for queue_arn, queue_records in queues.items():
+        for i in range(0, len(queue_records), MAX_DELETE_ENTRIES):
+            sqs_client.delete_message_batch(
+                QueueUrl=queue_url(queue_arn),
+                Entries=[{'Id': str(n), 'ReceiptHandle': record['receiptHandle']} for n, record in enumerate(queue_records[i:i + MAX_DELETE_ENTRIES])])
@@ -1,8 +1,9 @@
 import typing
 
-import boto3
+import baseline_cloud.core.aws.client
+from baseline_cloud.core import aws
 
-ssm_client = boto3.client('ssm')
+ssm_client = aws.client.lazy('ssm')
 
 parameters = {}
 
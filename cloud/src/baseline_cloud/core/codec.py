@@ -0,0 +1,59 @@
+import json
+import typing
+import zlib
+
+import baseline_cloud.core.py
+from baseline_cloud import core
+
+msgpack = core.py.load_module('msgpack')
+cbor2 = core.py.load_module('cbor2')
+
+# Payloads from devices start with a marker byte giving the format, with ZLIB set when the rest is
+# compressed. Plain JSON has no marker (its first byte is "{" or "["), so older devices and the provisioning
+# requests still decode the same way. Keep this in step with baseline_device.util.codec.
+JSON = 0x01
+MSGPACK = 0x02
+CBOR = 0x03
+ZLIB = 0x10
+
+CODECS = {'json': JSON, 'msgpack': MSGPACK, 'cbor': CBOR}
+
+# smaller payloads seldom get any smaller compressed
+COMPRESS_MIN_BYTES = 256
+
+
+def encode(obj: typing.Any, codec: str = 'json', compress_min_bytes: int = COMPRESS_MIN_BYTES) -> bytes:
+    marker = CODECS[codec]
+    if marker == MSGPACK:
+        data = msgpack.packb(obj, use_bin_type=True)
+    elif marker == CBOR:
+        data = cbor2.dumps(obj)
+    else:
+        data = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    if len(data) >= compress_min_bytes:
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data): return bytes([marker | ZLIB]) + compressed
+
+    return bytes([marker]) + data
+
+
+def decode(data: typing.Union[bytes, str]) -> typing.Any:
+    if isinstance(data, str): data = data.encode('utf-8')
+    if not data: return None
+
+    marker = data[0]
+    if marker & ~ZLIB not in (JSON, MSGPACK, CBOR):
+        return json.loads(data)  # no marker
+
+    body = data[1:]
+    if marker & ZLIB: body = zlib.decompress(body)
+
+    marker &= ~ZLIB
+    if marker == MSGPACK:
+        if msgpack is None: raise ValueError('Unable to decode msgpack payload, msgpack is not installed')
+        return msgpack.unpackb(body, raw=False)
+    if marker == CBOR:
+        if cbor2 is None: raise ValueError('Unable to decode cbor payload, cbor2 is not installed')
+        return cbor2.loads(body)
+    return json.loads(body)
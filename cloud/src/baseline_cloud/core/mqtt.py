@@ -1,9 +1,11 @@
 import json
 
-import boto3
-
+import baseline_cloud.core.aws.client
+from baseline_cloud.core import aws
 from baseline_cloud.core.json import JSONEncoder
 
+iot_data_client = aws.client.lazy('iot-data')
+
 
 def respond(event, status, **payload) -> None:
     if 'topic' not in event: return
@@ -15,8 +17,7 @@ def respond(event, status, **payload) -> None:
     if 'clientToken' in event:
         payload['clientToken'] = event['clientToken']
 
-    client = boto3.client('iot-data')
-    client.publish(
+    iot_data_client.publish(
         topic=f'{topic}/{status}',
         payload=json.dumps(payload, cls=JSONEncoder),
         qos=1
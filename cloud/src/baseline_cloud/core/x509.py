@@ -0,0 +1,53 @@
+import typing
+
+import OpenSSL.crypto as openssl
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from baseline_cloud.core.config import config
+
+# key types a device may send a CSR for, "provision_key_types" in config.json narrows them
+KEY_TYPES = ['rsa', 'ec']
+
+RSA_MIN_BITS = 2048
+
+
+def key_type(key: openssl.PKey) -> str:
+    # "rsa" for RSA keys of at least RSA_MIN_BITS and "ec" for P-256 keys, the two AWS IoT Core accepts for
+    # device certificates registered with a CA
+    key = key.to_cryptography_key()
+    if isinstance(key, rsa.RSAPublicKey) and key.key_size >= RSA_MIN_BITS: return 'rsa'
+    if isinstance(key, ec.EllipticCurvePublicKey) and isinstance(key.curve, ec.SECP256R1): return 'ec'
+    raise ValueError(f'Unsupported key {type(key).__name__} ({key.key_size} bits)')
+
+
+def sign_csr(csr_pem: str, cacert_key_pem: str, cacert_crt_pem: str, common_name: str, key_types: typing.Optional[typing.List[str]] = None) -> str:
+    key_types = key_types or config.provision_key_types or KEY_TYPES
+
+    cacert_key = openssl.load_privatekey(openssl.FILETYPE_PEM, cacert_key_pem)
+    cacert_crt = openssl.load_certificate(openssl.FILETYPE_PEM, cacert_crt_pem)
+    cacert_subject = cacert_crt.get_subject()
+
+    client_csr = openssl.load_certificate_request(openssl.FILETYPE_PEM, csr_pem)
+    client_key = client_csr.get_pubkey()
+    client_csr.verify(client_key)  # raises if the CSR was not signed by its own key
+
+    if key_type(client_key) not in key_types:
+        raise ValueError(f'Key type {key_type(client_key)} is not one of {", ".join(key_types)}')
+
+    client_subject = client_csr.get_subject()
+    if cacert_subject.C: client_subject.C = cacert_subject.C
+    if cacert_subject.ST: client_subject.ST = cacert_subject.ST
+    if cacert_subject.L: client_subject.L = cacert_subject.L
+    if cacert_subject.O: client_subject.O = cacert_subject.O
+    client_subject.CN = common_name
+
+    client_crt = openssl.X509()
+    client_crt.set_notBefore(cacert_crt.get_notBefore())
+    client_crt.set_notAfter(cacert_crt.get_notAfter())
+    client_crt.set_subject(client_subject)
+    client_crt.set_pubkey(client_key)
+    client_crt.set_issuer(cacert_subject)
+    client_crt.sign(cacert_key, 'sha256')
+    client_crt_pem = openssl.dump_certificate(openssl.FILETYPE_PEM, client_crt)
+    return client_crt_pem.decode('utf-8')
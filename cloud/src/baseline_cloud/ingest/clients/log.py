@@ -1,86 +1,240 @@
+import time
 import traceback
 import typing
 
-import boto3
-
+import baseline_cloud.core.aws.client
 import baseline_cloud.core.aws.redis
+import baseline_cloud.core.logging
 import baseline_cloud.core.mqtt
 from baseline_cloud import core
 from baseline_cloud.core import aws
 from baseline_cloud.core.config import config
-from . import RE_UUID
 
-RULE = rf'^\$aws/rules/{config.topic_prefix}/things/{RE_UUID}/log$'
+RULE = f'$aws/rules/{config.topic_prefix}/things/{{thing_name:uuid}}/log'
+
+# PutLogEvents accepts up to 10,000 events and 1,048,576 bytes a request, counting each event as its message
+# in UTF-8 plus 26 bytes, and the events of one request can't span more than 24 hours
+MAX_EVENTS = 10000
+MAX_BYTES = 1048576
+EVENT_OVERHEAD = 26
+MAX_SPAN = 24 * 60 * 60 * 1000
+
+RETENTION_DAYS = 7
+
+
+class Registry(object):
+    # Log groups, as (group,), and streams, as (group, stream), that this container has created or seen
+    # created. Entries expire after ttl seconds, so a group or stream deleted behind the lambda's back is
+    # created again without waiting on a failed write.
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self.expires: typing.Dict[typing.Tuple[str, ...], float] = {}
+
+    def known(self, key: typing.Tuple[str, ...]) -> bool:
+        expires = self.expires.get(key)
+        if expires is None: return False
+        if expires < time.monotonic():
+            del self.expires[key]
+            return False
+        return True
+
+    def add(self, key: typing.Tuple[str, ...]) -> None:
+        self.expires[key] = time.monotonic() + self.ttl
+
+    def discard(self, key: typing.Tuple[str, ...]) -> None:
+        self.expires.pop(key, None)
+
+
+cloudwatch_client = aws.client.lazy('logs')
+
+registry = Registry(config.log_stream_registry_ttl or 3600)
+
+
+def handle(event: dict, context, thing_name: str) -> None:
+    try:
+
+        group_name, stream_name, log_events = to_log_events(event, thing_name)
+
+        if log_events:
+            put_stream(group_name, stream_name, log_events)
+
+        core.mqtt.respond(event, 'accepted')
+
+    except:
+
+        core.mqtt.respond(event, 'rejected', error=traceback.format_exc())
+
+        raise
+
+
+def handle_batch(items: typing.List[typing.Tuple[dict, dict]], context) -> typing.List[dict]:
+    # the messages of a batch, from any number of things, are merged by stream so each stream is written with
+    # as few PutLogEvents as its records fit in. Batched messages are not responded to, the devices publish
+    # their logs without waiting. Returns the messages that could not be written.
+    streams: typing.Dict[typing.Tuple[str, str], typing.List[dict]] = {}
+    stream_messages: typing.Dict[typing.Tuple[str, str], typing.List[dict]] = {}
+    failed = []
+
+    for event, params in items:
+        try:
+            group_name, stream_name, log_events = to_log_events(event, **params)
+        except:
+            core.logging.logger.exception(f'Unable to read the log records from {event.get("topic")}')
+            failed.append(event)
+            continue
 
-cloudwatch_client = boto3.client('logs')
+        streams.setdefault((group_name, stream_name), []).extend(log_events)
+        stream_messages.setdefault((group_name, stream_name), []).append(event)
 
+    for (group_name, stream_name), log_events in streams.items():
+        try:
+            put_stream(group_name, stream_name, log_events)
+        except:
+            core.logging.logger.exception(f'Unable to put the log events for {group_name}/{stream_name}')
+            failed.extend(stream_messages[(group_name, stream_name)])
 
-def handle(event: dict, context) -> None:
+    return failed
+
+
+def to_log_events(event: dict, thing_name: str) -> typing.Tuple[str, str, typing.List[dict]]:
+    # a single record
     # {
+    #     "process": "string",
     #     "level": "string",
     #     "message": "string",
     #     "timestamp": float,
     #     "exception": "string"
     # }
+    #
+    # or a batch of records from the same process
+    # {
+    #     "process": "string",
+    #     "records": [{"level": "string", "message": "string", "timestamp": float, "exception": "string"}, ...],
+    #     "dropped": int
+    # }
+    group_name = f'{config.app_name}/things'
+    stream_name = f'{thing_name}/{event["process"]}'
 
-    try:
-
-        client_id = event['clientId']
+    records = event['records'] if 'records' in event else [event]
 
-        group_name = f'{config.app_name}/things'
-        stream_name = f'{client_id}/{event["process"]}'
+    log_events = []
 
-        log_events = [{
-            'timestamp': event['timestamp'],
-            'message': f'[{event["level"]}] {event["message"]}'
-        }]
+    for record in records:
+        log_events.append({
+            'timestamp': record['timestamp'],
+            'message': f'[{record["level"]}] {record["message"]}'
+        })
 
-        if 'exception' in event:
+        if 'exception' in record:
             log_events.append({
-                'timestamp': event['timestamp'],
-                'message': event['exception']
+                'timestamp': record['timestamp'],
+                'message': record['exception']
             })
 
-        sequence_token_key = f'{group_name}/{stream_name}/sequence_token'
-        sequence_token = aws.redis.get(sequence_token_key)
+    if event.get('dropped'):
+        log_events.append({
+            'timestamp': max(log_event['timestamp'] for log_event in log_events) if log_events else round(time.time() * 1000),
+            'message': f'[WARNING] {event["dropped"]} log records were dropped by the device'
+        })
 
-        sequence_token = put_log_events(group_name, stream_name, log_events, sequence_token)
+    return group_name, stream_name, log_events
 
-        aws.redis.set(sequence_token_key, sequence_token)
 
-        core.mqtt.respond(event, 'accepted')
+def put_stream(group_name: str, stream_name: str, log_events: typing.List[dict]) -> None:
+    # put_log_events requires the events in chronological order, the sort is stable so exceptions follow their record
+    log_events.sort(key=lambda log_event: log_event['timestamp'])
 
-    except:
+    if config.log_sequence_tokens:
+        put_stream_with_sequence_tokens(group_name, stream_name, log_events)
+        return
 
-        core.mqtt.respond(event, 'rejected', error=traceback.format_exc())
+    ensure_stream(group_name, stream_name)
+    for chunk in chunk_log_events(log_events):
+        put_log_events(group_name, stream_name, chunk)
 
-        raise
+
+def chunk_log_events(log_events: typing.List[dict]) -> typing.Iterator[typing.List[dict]]:
+    # sorted events split to the PutLogEvents limits
+    chunk, chunk_bytes = [], 0
+    for log_event in log_events:
+        event_bytes = len(log_event['message'].encode('utf-8')) + EVENT_OVERHEAD
+        if chunk and (len(chunk) == MAX_EVENTS or chunk_bytes + event_bytes > MAX_BYTES or log_event['timestamp'] - chunk[0]['timestamp'] > MAX_SPAN):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(log_event)
+        chunk_bytes += event_bytes
+    if chunk: yield chunk
+
+
+def ensure_stream(group_name: str, stream_name: str) -> None:
+    # created before the first write rather than after it fails, each at most once a registry ttl per container
+    if not registry.known((group_name,)):
+        try:
+            cloudwatch_client.create_log_group(logGroupName=group_name)
+            cloudwatch_client.put_retention_policy(logGroupName=group_name, retentionInDays=RETENTION_DAYS)
+        except cloudwatch_client.exceptions.ResourceAlreadyExistsException:
+            pass
+        registry.add((group_name,))
+
+    if not registry.known((group_name, stream_name)):
+        try:
+            cloudwatch_client.create_log_stream(logGroupName=group_name, logStreamName=stream_name)
+        except cloudwatch_client.exceptions.ResourceAlreadyExistsException:
+            pass
+        registry.add((group_name, stream_name))
 
 
-def put_log_events(group_name: str, stream_name: str, log_events: typing.List[dict], sequence_token: typing.Optional[str]) -> str:
+def put_log_events(group_name: str, stream_name: str, log_events: typing.List[dict]) -> None:
     try:
 
-        return try_put_log_events(group_name, stream_name, log_events, sequence_token)
+        try_put_log_events(group_name, stream_name, log_events)
 
-    except cloudwatch_client.exceptions.ResourceNotFoundException as e:
+    except cloudwatch_client.exceptions.ResourceNotFoundException:
+
+        # deleted since the registry saw it, forget both and create them again
+        registry.discard((group_name,))
+        registry.discard((group_name, stream_name))
+        ensure_stream(group_name, stream_name)
+
+        try_put_log_events(group_name, stream_name, log_events)
+
+
+def try_put_log_events(group_name: str, stream_name: str, log_events: typing.List[dict]) -> None:
+    response = cloudwatch_client.put_log_events(
+        logGroupName=group_name,
+        logStreamName=stream_name,
+        logEvents=log_events)
+    rejected = response.get('rejectedLogEventsInfo')
+    if rejected:
+        core.logging.logger.warning(f'Log events were rejected from {group_name}/{stream_name}: {rejected}')
+
+
+# The sequence token path, for when log_sequence_tokens is set in config.json. CloudWatch Logs ignores
+# sequence tokens now, this keeps the previous behaviour of storing each stream's token in Redis.
+def put_stream_with_sequence_tokens(group_name: str, stream_name: str, log_events: typing.List[dict]) -> None:
+    sequence_token_key = f'{group_name}/{stream_name}/sequence_token'
+    sequence_token = aws.redis.get(sequence_token_key)
+
+    try:
+        for chunk in chunk_log_events(log_events):
+            sequence_token = put_log_events_with_sequence_token(group_name, stream_name, chunk, sequence_token)
+    finally:
+        if sequence_token: aws.redis.set(sequence_token_key, sequence_token)
+
+
+def put_log_events_with_sequence_token(group_name: str, stream_name: str, log_events: typing.List[dict], sequence_token: typing.Optional[str]) -> str:
+    try:
 
-        create_stream = False
+        return try_put_log_events_with_sequence_token(group_name, stream_name, log_events, sequence_token)
 
-        if 'The specified log group does not exist.' in e.response['Error']['Message']:
-            create_stream = True
-            try:
-                cloudwatch_client.create_log_group(logGroupName=group_name)
-                cloudwatch_client.put_retention_policy(logGroupName=group_name, retentionInDays=7)
-            except cloudwatch_client.exceptions.ResourceAlreadyExistsException:
-                pass
+    except cloudwatch_client.exceptions.ResourceNotFoundException:
 
-        if create_stream or 'The specified log stream does not exist.' in e.response['Error']['Message']:
-            try:
-                cloudwatch_client.create_log_stream(logGroupName=group_name, logStreamName=stream_name)
-            except cloudwatch_client.exceptions.ResourceAlreadyExistsException:
-                pass
+        registry.discard((group_name,))
+        registry.discard((group_name, stream_name))
+        ensure_stream(group_name, stream_name)
 
-        return try_put_log_events(group_name, stream_name, log_events, None)
+        return try_put_log_events_with_sequence_token(group_name, stream_name, log_events, None)
 
     except cloudwatch_client.exceptions.InvalidSequenceTokenException as e:
         # {
@@ -91,13 +245,13 @@ def put_log_events(group_name: str, stream_name: str, log_events: typing.List[di
         #     "ResponseMetadata": {...}
         # }
         sequence_token = e.response['Error']['Message'].rsplit(maxsplit=1)[1]
-        return try_put_log_events(group_name, stream_name, log_events, sequence_token)
+        return try_put_log_events_with_sequence_token(group_name, stream_name, log_events, sequence_token)
 
     except cloudwatch_client.exceptions.DataAlreadyAcceptedException as e:
         return e.response['Error']['Message'].rsplit(maxsplit=1)[1]
 
 
-def try_put_log_events(group_name: str, stream_name: str, log_events: typing.List[dict], sequence_token: typing.Optional[str]) -> str:
+def try_put_log_events_with_sequence_token(group_name: str, stream_name: str, log_events: typing.List[dict], sequence_token: typing.Optional[str]) -> str:
     kwargs = {}
     if sequence_token: kwargs['sequenceToken'] = sequence_token
     response = cloudwatch_client.put_log_events(
@@ -0,0 +1,124 @@
+import traceback
+import typing
+from datetime import datetime
+from datetime import timezone
+
+import baseline_cloud.core.aws.client
+import baseline_cloud.core.logging
+import baseline_cloud.core.mqtt
+from baseline_cloud import core
+from baseline_cloud.core import aws
+from baseline_cloud.core.config import config
+
+RULE = f'$aws/rules/{config.topic_prefix}/things/{{thing_name:uuid}}/metrics'
+
+# PutMetricData accepts up to 1000 metric data per request
+MAX_METRIC_DATA = 1000
+
+UNITS = {
+    'cpu': 'Percent',
+    'memory': 'Percent',
+    'disk': 'Percent',
+    'network_rx': 'Bytes/Second',
+    'network_tx': 'Bytes/Second'
+}
+
+cloudwatch_client = aws.client.lazy('cloudwatch')
+
+
+def handle(event: dict, context, thing_name: str) -> None:
+    try:
+
+        put_metric_data(to_metric_data(event, thing_name))
+
+        core.mqtt.respond(event, 'accepted')
+
+    except:
+
+        core.mqtt.respond(event, 'rejected', error=traceback.format_exc())
+
+        raise
+
+
+def handle_batch(items: typing.List[typing.Tuple[dict, dict]], context) -> typing.List[dict]:
+    # the windows of a batch, from any number of things, are put together MAX_METRIC_DATA at a time and are
+    # not responded to. Returns the messages that could not be put.
+    metric_data: typing.List[typing.Tuple[dict, dict]] = []
+    failed = []
+
+    for event, params in items:
+        try:
+            metric_data.extend((metric_datum, event) for metric_datum in to_metric_data(event, **params))
+        except:
+            core.logging.logger.exception(f'Unable to read the metrics from {event.get("topic")}')
+            failed.append(event)
+
+    for i in range(0, len(metric_data), MAX_METRIC_DATA):
+        chunk = metric_data[i:i + MAX_METRIC_DATA]
+        try:
+            put_metric_data([metric_datum for metric_datum, _ in chunk])
+        except:
+            core.logging.logger.exception('Unable to put the metric data')
+            failed.extend(event for _, event in chunk)
+
+    # a message spread over two chunks that both failed is only returned once
+    return list({id(event): event for event in failed}.values())
+
+
+def to_metric_data(event: dict, thing_name: str) -> typing.List[dict]:
+    # one summary per window, each metric as [min, max, mean, p95]
+    # {
+    #     "timestamp": int,
+    #     "window": float,
+    #     "samples": int,
+    #     "metrics": {"cpu": [min, max, mean, p95], "memory": [...], "disk": [...], "load": [...], "network_rx": [...], "network_tx": [...]},
+    #     "processes": {"<supervisor process name>": [min, max, mean, p95], ...}
+    # }
+    timestamp = datetime.fromtimestamp(event['timestamp'] / 1000, tz=timezone.utc)
+    samples = event.get('samples') or 1
+
+    metric_data = []
+
+    for name, summary in (event.get('metrics') or {}).items():
+        metric_data.extend(metric_datums(name, summary, samples, timestamp, UNITS.get(name, 'None'), [
+            {'Name': 'ThingName', 'Value': thing_name}
+        ]))
+
+    for process, summary in (event.get('processes') or {}).items():
+        metric_data.extend(metric_datums('rss', summary, samples, timestamp, 'Bytes', [
+            {'Name': 'ThingName', 'Value': thing_name},
+            {'Name': 'Process', 'Value': process}
+        ]))
+
+    return metric_data
+
+
+def put_metric_data(metric_data: typing.List[dict]) -> None:
+    for i in range(0, len(metric_data), MAX_METRIC_DATA):
+        cloudwatch_client.put_metric_data(
+            Namespace=f'{config.app_name}/things',
+            MetricData=metric_data[i:i + MAX_METRIC_DATA])
+
+
+def metric_datums(name: str, summary: typing.List[float], samples: int, timestamp: datetime, unit: str, dimensions: typing.List[dict]) -> typing.List[dict]:
+    # the window as a statistic set, so CloudWatch can still give the min, max and average over any period,
+    # and the p95 as its own metric because percentiles cannot be rebuilt from a statistic set
+    minimum, maximum, mean, p95 = summary
+    return [{
+        'MetricName': name,
+        'Dimensions': dimensions,
+        'Timestamp': timestamp,
+        'StatisticValues': {
+            'SampleCount': samples,
+            'Sum': mean * samples,
+            'Minimum': minimum,
+            'Maximum': maximum
+        },
+        'Unit': unit
+    }, {
+        'MetricName': f'{name}_p95',
+        'Dimensions': dimensions,
+        'Timestamp': timestamp,
+        'Value': p95,
+        'Unit': unit
+    }]
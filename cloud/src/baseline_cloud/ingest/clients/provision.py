@@ -1,27 +1,23 @@
 import traceback
 import uuid
 
-import OpenSSL.crypto as openssl
-import boto3
-
+import baseline_cloud.core.aws.client
 import baseline_cloud.core.aws.secrets
 import baseline_cloud.core.aws.ssm
 import baseline_cloud.core.date
 import baseline_cloud.core.mqtt
+import baseline_cloud.core.x509
 from baseline_cloud import core
 from baseline_cloud.core import aws
 from baseline_cloud.core.config import config
-from . import RE_UUID
-
-RULE_PROVISION = rf'^\$aws/rules/{config.topic_prefix}/clients/[0-9a-f]{{128}}/provision$'
-RULE_VERIFY = rf'^\$aws/rules/{config.topic_prefix}/things/{RE_UUID}/provision$'
 
-iot_client = boto3.client('iot')
+RULE_PROVISION = f'$aws/rules/{config.topic_prefix}/clients/{{client_id:hex128}}/provision'
+RULE_VERIFY = f'$aws/rules/{config.topic_prefix}/things/{{thing_name:uuid}}/provision'
 
+iot_client = aws.client.lazy('iot')
 
-def verify(event: dict, context) -> None:
-    thing_name = event['clientId']
 
+def verify(event: dict, context, thing_name: str) -> None:
     try:
 
         add_thing_to_thing_group(thing_name, f'{config.app_name}-verified')
@@ -46,7 +42,7 @@ def verify(event: dict, context) -> None:
         raise
 
 
-def provision(event: dict, context) -> None:
+def provision(event: dict, context, client_id: str) -> None:
     client_crt_arn = None
 
     thing_name = str(uuid.uuid4())
@@ -59,29 +55,9 @@ def provision(event: dict, context) -> None:
         cacert_id = cacert_arn.rsplit(maxsplit=1, sep='/')[1]
 
         cacert_key_pem = aws.secrets.get_secret_value(f'/{config.app_name}/key/{cacert_id}')
-        cacert_key = openssl.load_privatekey(openssl.FILETYPE_PEM, cacert_key_pem)
-
         cacert_crt_pem = get_ca_certificate(cacert_arn)
-        cacert_crt = openssl.load_certificate(openssl.FILETYPE_PEM, cacert_crt_pem)
-        cacert_subject = cacert_crt.get_subject()
-
-        client_csr = openssl.load_certificate_request(openssl.FILETYPE_PEM, csr_pem)
-        client_subject = client_csr.get_subject()
-        if cacert_subject.C: client_subject.C = cacert_subject.C
-        if cacert_subject.ST: client_subject.ST = cacert_subject.ST
-        if cacert_subject.L: client_subject.L = cacert_subject.L
-        if cacert_subject.O: client_subject.O = cacert_subject.O
-        client_subject.CN = thing_name
-
-        client_crt = openssl.X509()
-        client_crt.set_notBefore(cacert_crt.get_notBefore())
-        client_crt.set_notAfter(cacert_crt.get_notAfter())
-        client_crt.set_subject(client_subject)
-        client_crt.set_pubkey(client_csr.get_pubkey())
-        client_crt.set_issuer(cacert_subject)
-        client_crt.sign(cacert_key, 'sha256')
-        client_crt_pem = openssl.dump_certificate(openssl.FILETYPE_PEM, client_crt)
-        client_crt_pem = client_crt_pem.decode('utf-8')
+
+        client_crt_pem = core.x509.sign_csr(csr_pem, cacert_key_pem, cacert_crt_pem, thing_name)
 
         client_crt_arn = register_certificate(cacert_crt_pem, client_crt_pem)
 
@@ -1,21 +1,131 @@
+import base64
 import json
-import re
+import random
 import typing
 
+import baseline_cloud.core.aws.sqs
+import baseline_cloud.core.codec
+import baseline_cloud.core.logging
 import baseline_cloud.ingest.clients.log
+import baseline_cloud.ingest.clients.metrics
 import baseline_cloud.ingest.clients.provision
+import baseline_cloud.ingest.router
+from baseline_cloud import core
+from baseline_cloud import ingest
+from baseline_cloud.core import aws
+from baseline_cloud.core.config import config
 from baseline_cloud.ingest import clients
 
-handlers: typing.Dict[str, typing.Callable[[dict, object], None]] = {
+router = ingest.router.Router({
     clients.provision.RULE_PROVISION: clients.provision.provision,
     clients.provision.RULE_VERIFY: clients.provision.verify,
-    clients.log.RULE: clients.log.handle
-}
+    clients.log.RULE: clients.log.handle,
+    clients.metrics.RULE: clients.metrics.handle
+})
 
+# clients that can take every message of a batch in one call, handle_batch([(event, params), ...], context),
+# returning the messages that failed
+batch_router = ingest.router.Router({
+    clients.log.RULE: clients.log.handle_batch,
+    clients.metrics.RULE: clients.metrics.handle_batch
+})
+
+# the fraction of events printed in full to the function's log, e.g. 0.01, none by default
+debug_sample_rate: float = config.ingest_debug_sample_rate or 0
+
+
+def handle(event: typing.Union[dict, list], context) -> None:
+    # a message from the topic rule, a list of them, or an SQS event from the batch topic rule's queue
+    if 'Records' in event:
+        handle_queue(event, context)
+        return
+
+    events = [e for message in (event if isinstance(event, list) else [event]) for e in expand_event(decode_event(message))]
+    if len(events) != 1 or isinstance(event, list):
+        failed = handle_batch(events, context)
+        if failed: raise Exception(f'{len(failed)} of {len(events)} messages failed')
+        return
+
+    event = events[0]
+    debug_print(event)
 
-def handle(event: dict, context) -> None:
-    print(json.dumps(event, indent=4))
     topic = event['topic']
-    for rule, handler in handlers.items():
-        if re.match(rule, topic):
-            handler(event, context)
+    route = router.match(topic)
+    if not route:
+        print(f'No handler for topic {topic}')
+        return
+
+    handler, params = route
+    handler(event, context, **params)
+
+
+def handle_queue(event: dict, context) -> None:
+    # {"Records": [{"messageId": "string", "receiptHandle": "string", "body": "<topic rule message>", "eventSourceARN": "string", ...}, ...]}
+    records = event['Records']
+    record_events = [expand_event(decode_event(json.loads(record['body']))) for record in records]
+
+    failed = handle_batch([e for events in record_events for e in events], context)
+    if not failed: return
+
+    # failing the invocation returns the whole batch to the queue, so the messages that were handled are
+    # deleted first, leaving only the failed ones to be received again
+    failed_ids = set(id(e) for e in failed)
+    handled = [record for record, events in zip(records, record_events) if not any(id(e) in failed_ids for e in events)]
+    aws.sqs.delete_messages(handled)
+    raise Exception(f'{len(records) - len(handled)} of {len(records)} messages failed')
+
+
+def handle_batch(events: typing.List[dict], context) -> typing.List[dict]:
+    batches: typing.Dict[ingest.router.Handler, typing.List[typing.Tuple[dict, dict]]] = {}
+    failed = []
+
+    for event in events:
+        debug_print(event)
+
+        topic = event['topic']
+        route = batch_router.match(topic)
+        if route:
+            batch_handler, params = route
+            batches.setdefault(batch_handler, []).append((event, params))
+            continue
+
+        route = router.match(topic)
+        if not route:
+            print(f'No handler for topic {topic}')
+            continue
+
+        handler, params = route
+        try:
+            handler(event, context, **params)
+        except:
+            core.logging.logger.exception(f'Unable to handle {topic}')
+            failed.append(event)
+
+    for batch_handler, items in batches.items():
+        failed.extend(batch_handler(items, context))
+
+    return failed
+
+
+def debug_print(event: dict) -> None:
+    if debug_sample_rate and random.random() < debug_sample_rate:
+        print(json.dumps(event, indent=4))
+
+
+def decode_event(event: dict) -> dict:
+    # the topic rule passes the payload through as base64, so it can be in any of the core.codec formats,
+    # and adds the topic, clientId, traceId and principal, which take precedence over anything in the payload
+    if 'payload' not in event: return event
+
+    envelope = {k: v for k, v in event.items() if k != 'payload'}
+    payload = core.codec.decode(base64.b64decode(event['payload']))
+
+    if isinstance(payload, dict): return {**payload, **envelope}
+    return {**envelope, 'payload': payload}
+
+
+def expand_event(event: dict) -> typing.List[dict]:
+    # a payload that is an array holds several messages for the same topic, published as one
+    if not isinstance(event.get('payload'), list): return [event]
+    envelope = {k: v for k, v in event.items() if k != 'payload'}
+    return [{**message, **envelope} for message in event['payload'] if isinstance(message, dict)]
@@ -0,0 +1,80 @@
+import re
+import typing
+
+from baseline_cloud.ingest.clients import RE_UUID
+
+Handler = typing.Callable[..., None]
+
+# Routes are topics with typed captures, e.g. "$aws/rules/baseline/things/{thing_name:uuid}/log". They are
+# parsed into a trie of topic levels once, at cold start, so an event is routed by walking its levels, at a
+# cost that depends on the depth of the topic and not on how many routes there are. The captured levels are
+# passed to the handler as keyword arguments, handler(event, context, thing_name=...).
+TYPES: typing.Dict[str, typing.Pattern] = {
+    'str': re.compile(r'[^/]+'),
+    'uuid': re.compile(RE_UUID),
+    'hex128': re.compile(r'[0-9a-f]{128}')
+}
+
+RE_CAPTURE = re.compile(r'^{(?P<name>[a-z_][a-z0-9_]*)(?::(?P<type>[a-z0-9]+))?}$')
+
+
+class Node(object):
+
+    def __init__(self) -> None:
+        self.literals: typing.Dict[str, Node] = {}
+        self.captures: typing.List[typing.Tuple[str, typing.Pattern, Node]] = []
+        self.handler: typing.Optional[Handler] = None
+
+
+class Router(object):
+
+    def __init__(self, routes: typing.Optional[typing.Dict[str, Handler]] = None) -> None:
+        self.root = Node()
+        for route, handler in (routes or {}).items():
+            self.add(route, handler)
+
+    def add(self, route: str, handler: Handler) -> None:
+        node = self.root
+        for level in route.split('/'):
+            capture = RE_CAPTURE.match(level)
+            if not capture:
+                node = node.literals.setdefault(level, Node())
+                continue
+
+            name, type = capture.group('name'), capture.group('type') or 'str'
+            if type not in TYPES:
+                raise ValueError(f'Unknown capture type {type} in route {route}')
+
+            pattern = TYPES[type]
+            child = next((c for n, p, c in node.captures if n == name and p is pattern), None)
+            if not child:
+                child = Node()
+                node.captures.append((name, pattern, child))
+            node = child
+
+        if node.handler:
+            raise ValueError(f'Route {route} is already handled')
+        node.handler = handler
+
+    def match(self, topic: str) -> typing.Optional[typing.Tuple[Handler, typing.Dict[str, str]]]:
+        params: typing.Dict[str, str] = {}
+        handler = self.match_levels(self.root, topic.split('/'), 0, params)
+        return (handler, params) if handler else None
+
+    def match_levels(self, node: Node, levels: typing.List[str], i: int, params: typing.Dict[str, str]) -> typing.Optional[Handler]:
+        if i == len(levels): return node.handler
+
+        # literals take precedence over captures, and only fall back to them when nothing below matched
+        child = node.literals.get(levels[i])
+        if child:
+            handler = self.match_levels(child, levels, i + 1, params)
+            if handler: return handler
+
+        for name, pattern, child in node.captures:
+            if pattern.fullmatch(levels[i]):
+                params[name] = levels[i]
+                handler = self.match_levels(child, levels, i + 1, params)
+                if handler: return handler
+                del params[name]
+
+        return None
@@ -0,0 +1,53 @@
+import logging
+import os
+import typing
+
+import baseline_device.util.aiomqtt
+import baseline_device.util.py
+from baseline_device import util
+from baseline_device.util.aiomqtt import AsyncClient
+from baseline_device.util.config import config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+this_dir = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
+
+# services are loaded by path, because the jobs/ package shadows jobs.py as an importable module name
+agent_services: typing.List[str] = config.agent_services or ['shadows/sample', 'jobs', 'tunnels', 'telemetry', 'main']
+
+services: typing.List[typing.Any] = []
+
+
+def load_services() -> None:
+    for name in agent_services:
+        modname = f'{__package__ or "baseline_device.service"}.agent_{name.replace("/", "_")}'
+        service = util.py.load_source(modname, f'{this_dir}/{name}.py')
+        services.append(service)
+        logger.info(f'Loaded service: {name}')
+
+
+def setup(client: AsyncClient) -> None:
+    load_services()
+    for service in services:
+        service.setup(client)
+
+
+def teardown(client: AsyncClient) -> None:
+    for service in reversed(services):
+        if hasattr(service, 'teardown'):
+            try:
+                service.teardown(client)
+            except:
+                logger.warning(f'Unable to teardown service {service.__name__}', exc_info=True)
+
+
+if __name__ == '__main__':
+
+    try:
+
+        util.aiomqtt.run(setup, teardown, client_id=f'{os.environ["BASELINE_CLIENT_ID"]}-agent', clean_session=not config.mqtt_persistent_sessions)
+
+    except:
+
+        logger.critical('Fatal shutdown...', exc_info=True)
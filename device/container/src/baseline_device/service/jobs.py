@@ -1,55 +1,100 @@
+import asyncio
+import heapq
 import json
 import logging
 import os
-import signal
-import subprocess
-import threading
 import typing
+import xmlrpc.client
 
 import paho.mqtt.client as paho
 
+import baseline_device.util.aiomqtt
+import baseline_device.util.outbox
+import baseline_device.util.supervisor
+from baseline_device import util
+from baseline_device.util.aiomqtt import AsyncClient
 from baseline_device.util.config import config
 from baseline_device.util.mqtt import MqttLoggingHandler
-from baseline_device.util.os import shell
+from baseline_device.util.supervisor import supervisor
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__file__)
 
 client_id = os.environ['BASELINE_CLIENT_ID']
 
-check_pending_timer: typing.Optional[threading.Timer] = None
+# how many job executions may run at once, in total and for each program; running more than one execution
+# of a program needs a supervisor program for each extra slot, named jobs_<program>_<slot> (e.g. jobs_sample1_1)
+max_concurrency: int = config.jobs_max_concurrency or 4
+program_concurrency: typing.Dict[str, int] = config.jobs_program_concurrency or {}
 
-active_job_execution: typing.Optional[dict] = None
-active_job_timer: typing.Optional[threading.Timer] = None
+check_pending_timer: typing.Optional[asyncio.TimerHandle] = None
 
 
-def on_connect(client: paho.Client, userdata: dict, flags: dict, rc: int) -> None:
-    client.subscribe(f'$aws/things/{client_id}/jobs/get/accepted', qos=2)
-    client.subscribe(f'$aws/things/{client_id}/jobs/get/rejected', qos=2)
-    client.subscribe(f'$aws/things/{client_id}/jobs/start-next/accepted', qos=2)
-    client.subscribe(f'$aws/things/{client_id}/jobs/start-next/rejected', qos=2)
-    client.subscribe(f'$aws/things/{client_id}/jobs/+/get/accepted', qos=2)
-    client.subscribe(f'$aws/things/{client_id}/jobs/+/get/rejected', qos=2)
-    client.subscribe(f'$aws/things/{client_id}/jobs/+/update/accepted', qos=2)
-    client.subscribe(f'$aws/things/{client_id}/jobs/+/update/rejected', qos=2)
-    client.subscribe(f'$aws/things/{client_id}/jobs/notify', qos=2)
-    client.subscribe(f'$aws/things/{client_id}/jobs/notify-next', qos=2)
-    client.subscribe(f'supervisor/processes/+/events/PROCESS_STATE', qos=2)
+class JobExecution(object):
 
-    client.publish(f'$aws/things/{client_id}/jobs/get', qos=2)
+    def __init__(self, execution: dict, slot: int) -> None:
+        self.execution = execution
+        self.slot = slot
+        self.started = False
+        self.timer: typing.Optional[asyncio.TimerHandle] = None
 
+    @property
+    def job_id(self) -> str:
+        return self.execution['jobId']
+
+    @property
+    def program(self) -> str:
+        return self.execution['jobDocument']['program']
+
+    @property
+    def name(self) -> str:
+        # the job process finds its execution details in /tmp/<app_name>/jobs/<name>
+        return self.program if self.slot == 0 else f'{self.program}_{self.slot}'
+
+    @property
+    def process_name(self) -> str:
+        return f'jobs_{self.name}'
+
+
+# the executions that hold a slot, keyed by jobId
+active_executions: typing.Dict[str, JobExecution] = {}
+
+# executions waiting for a slot, keyed by jobId, and ordered by the job document's priority then queuedAt
+waiting_executions: typing.Dict[str, dict] = {}
+waiting_queue: typing.List[typing.Tuple[int, int, str]] = []
+
+
+async def on_connect(client: AsyncClient, flags: dict, rc: int) -> None:
+    if not util.aiomqtt.session_present(flags):
+        client.subscribe([
+            f'$aws/things/{client_id}/jobs/get/accepted',
+            f'$aws/things/{client_id}/jobs/get/rejected',
+            f'$aws/things/{client_id}/jobs/+/get/accepted',
+            f'$aws/things/{client_id}/jobs/+/get/rejected',
+            f'$aws/things/{client_id}/jobs/+/update/accepted',
+            f'$aws/things/{client_id}/jobs/+/update/rejected',
+            f'$aws/things/{client_id}/jobs/notify',
+            f'$aws/things/{client_id}/jobs/notify-next',
+            f'supervisor/processes/+/events/PROCESS_STATE'
+        ])
+
+    # jittered, so the services (and devices) reconnecting after a broker restart do not all ask at once
     global check_pending_timer
     if check_pending_timer: check_pending_timer.cancel()
-    check_pending_timer = threading.Timer(600, client.publish, args=[f'$aws/things/{client_id}/jobs/get'], kwargs={'qos': 2})
-    check_pending_timer.start()
+    check_pending_timer = client.call_later(util.aiomqtt.jitter(config.mqtt_reconnect_jitter or 5), check_pending, client)
+
+
+def check_pending(client: AsyncClient) -> None:
+    client.publish(f'$aws/things/{client_id}/jobs/get')
+
+    global check_pending_timer
+    check_pending_timer = client.call_later(600 + util.aiomqtt.jitter(60), check_pending, client)
 
 
 # GetPendingJobExecutions:
 # Gets the list of all jobs for a thing that are not in a terminal state.
 # https://docs.aws.amazon.com/iot/latest/developerguide/jobs-api.html
-def jobs_get_accepted(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
-    active_execution = active_job_execution
-
+async def jobs_get_accepted(client: AsyncClient, message: paho.MQTTMessage) -> None:
     # {
     #     "inProgressJobs": [{
     #         "jobId": "string",
@@ -71,79 +116,35 @@ def jobs_get_accepted(client: paho.Client, userdata: dict, message: paho.MQTTMes
     # }
     payload = json.loads(message.payload.decode('utf-8'))
 
-    in_progress_jobs = payload['inProgressJobs']
-    queued_jobs = payload['queuedJobs']
-
-    def start_next() -> None:
-        client.publish(f'$aws/things/{client_id}/jobs/start-next', qos=2)
-
-    if in_progress_jobs:
-        next_execution = in_progress_jobs[0]
-        if not active_execution:
-            start_next()
-        elif active_execution['jobId'] != next_execution['jobId']:
-            stop_job_execution(active_execution)
-            start_next()
-        elif pidof_job_execution(active_execution) == 0:  # pid of 0 means not running
-            restart_job_execution(active_execution)
-    else:
-        if active_execution:
-            stop_job_execution(active_execution)
-        if queued_jobs:
-            start_next()
+    pending_jobs = payload['inProgressJobs'] + payload['queuedJobs']
+    pending_job_ids = set(job['jobId'] for job in pending_jobs)
 
+    # executions no longer pending were canceled or removed in the cloud
+    for job_id, job_execution in list(active_executions.items()):
+        if job_id not in pending_job_ids:
+            await stop_job_execution(client, job_execution)
 
-def jobs_get_rejected(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
-    # {
-    #     "code": "ErrorCode",
-    #     "message": "string",
-    #     "timestamp": timestamp,
-    #     "clientToken": "string"
-    # }
-    logger.error(f'MQTT request rejected for topic {message.topic}:\n{message.payload}')
+    for job_id in list(waiting_executions):
+        if job_id not in pending_job_ids:
+            waiting_executions.pop(job_id)
 
+    for job in pending_jobs:
+        job_id = job['jobId']
+        job_execution = active_executions.get(job_id)
 
-# StartNextPendingJobExecution:
-# Gets and starts the next pending job execution for a thing (status IN_PROGRESS or QUEUED).
-# * Any job executions with status IN_PROGRESS are returned first.
-# * Job executions are returned in the order in which they were created.
-# * If the next pending job execution is QUEUED, its state is changed to IN_PROGRESS and the job execution's status details are set as specified.
-# * If the next pending job execution is already IN_PROGRESS, its status details are not changed.
-# * If no job executions are pending, the response does not include the execution field.
-# * You can optionally create a step timer by setting a value for the stepTimeoutInMinutes property.
-#   If you don't update the value of this property by running UpdateJobExecution, the job execution times out when the step timer expires.
-# https://docs.aws.amazon.com/iot/latest/developerguide/jobs-api.html
-def jobs_start_next_accepted(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
-    active_execution = active_job_execution
+        if job_execution:
+            if job_execution.started and await supervisor.pid(job_execution.process_name) == 0:  # pid of 0 means not running
+                await restart_job_execution(job_execution)
 
-    # {
-    #     "execution": {
-    #         "jobId": "string",
-    #         "jobDocument": "string",
-    #         "status": "IN_PROGRESS",
-    #         "queuedAt": timestamp,
-    #         "startedAt": timestamp,
-    #         "lastUpdatedAt": timestamp,
-    #         "versionNumber": number,
-    #         "executionNumber": long
-    #     },
-    #     "timestamp": timestamp,
-    #     "clientToken": "string"
-    # }
-    payload = json.loads(message.payload.decode('utf-8'))
+        elif job_id not in waiting_executions:
+            # the job documents are needed to schedule, so describe every new execution at once instead of
+            # working through them one start-next round trip at a time
+            client.publish(f'$aws/things/{client_id}/jobs/{job_id}/get')
 
-    if 'execution' in payload:
-        next_execution = payload['execution']
-        if not active_execution:
-            start_job_execution(next_execution)
-        elif active_execution['jobId'] != next_execution['jobId']:
-            stop_job_execution(active_execution)
-            start_job_execution(next_execution)
-        elif pidof_job_execution(active_execution) == 0:  # pid of 0 means not running
-            restart_job_execution(active_execution)
+    await schedule(client)
 
 
-def jobs_start_next_rejected(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
+async def jobs_get_rejected(client: AsyncClient, message: paho.MQTTMessage) -> None:
     # {
     #     "code": "ErrorCode",
     #     "message": "string",
@@ -157,7 +158,7 @@ def jobs_start_next_rejected(client: paho.Client, userdata: dict, message: paho.
 # Gets detailed information about a job execution.
 # You can set the jobId to $next to return the next pending job execution for a thing (status IN_PROGRESS or QUEUED).
 # https://docs.aws.amazon.com/iot/latest/developerguide/jobs-api.html
-def jobs_jobid_get_accepted(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
+async def jobs_jobid_get_accepted(client: AsyncClient, message: paho.MQTTMessage) -> None:
     # {
     #     "execution": {
     #         "jobId": "string",
@@ -175,18 +176,24 @@ def jobs_jobid_get_accepted(client: paho.Client, userdata: dict, message: paho.M
     payload = json.loads(message.payload.decode('utf-8'))
 
     execution = payload['execution']
+    job_id = execution['jobId']
 
-    global active_job_execution
-    active_job_execution = execution
+    job_execution = active_executions.get(job_id)
 
     if execution['status'] in ['FAILED', 'CANCELED', 'TIMED_OUT', 'REJECTED', 'REMOVED']:
-        stop_job_execution(execution)
+        waiting_executions.pop(job_id, None)
+        if job_execution: await stop_job_execution(client, job_execution)
+
+    elif job_execution:
+        job_execution.execution = execution
 
+    elif execution['status'] in ['QUEUED', 'IN_PROGRESS']:
+        enqueue(execution)
 
-def jobs_jobid_get_rejected(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
-    execution = active_job_execution
-    if not execution: return
+    await schedule(client)
 
+
+async def jobs_jobid_get_rejected(client: AsyncClient, message: paho.MQTTMessage) -> None:
     # {
     #     "code": "ErrorCode",
     #     "message": "string",
@@ -195,11 +202,14 @@ def jobs_jobid_get_rejected(client: paho.Client, userdata: dict, message: paho.M
     # }
     payload = json.loads(message.payload.decode('utf-8'))
 
+    topic_job_id = message.topic.split('/')[4]
+
     if payload.get('code') == 'TerminalStateReached':
-        topic_job_id = message.topic.split('/')[4]
-        if topic_job_id == execution['jobId']:
-            stop_job_execution(execution)
-            client.publish(f'$aws/things/{client_id}/jobs/get', qos=2)
+        waiting_executions.pop(topic_job_id, None)
+        job_execution = active_executions.get(topic_job_id)
+        if job_execution:
+            await stop_job_execution(client, job_execution)
+            client.publish(f'$aws/things/{client_id}/jobs/get')
     else:
         logger.error(f'MQTT request rejected for topic {message.topic}:\n{message.payload}')
 
@@ -208,20 +218,41 @@ def jobs_jobid_get_rejected(client: paho.Client, userdata: dict, message: paho.M
 # Updates the status of a job execution. You can optionally create a step timer by setting a value for the stepTimeoutInMinutes property.
 # If you don't update the value of this property by running UpdateJobExecution again, the job execution times out when the step timer expires.
 # https://docs.aws.amazon.com/iot/latest/developerguide/jobs-api.html
-def jobs_jobid_update_accepted(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
+async def jobs_jobid_update_accepted(client: AsyncClient, message: paho.MQTTMessage) -> None:
     # {
     #     "executionState": {
     #         "status": "QUEUED|IN_PROGRESS|FAILED|SUCCEEDED|CANCELED|TIMED_OUT|REJECTED|REMOVED",
+    #         "statusDetails": {...},
     #         "versionNumber": number
     #     },
     #     "jobDocument": "string",
     #     "timestamp": timestamp,
     #     "clientToken": "string"
     # }
-    pass
+    # executionState and jobDocument are only there when the update asked for them with includeJobExecutionState
+    # and includeJobDocument
+    payload = json.loads(message.payload.decode('utf-8'))
+
+    topic_job_id = message.topic.split('/')[4]
+
+    # a queued execution holds its slot until it has been moved to IN_PROGRESS, then its process is started
+    job_execution = active_executions.get(topic_job_id)
+    if not job_execution or job_execution.started: return
+
+    execution_state = payload.get('executionState')
+    if execution_state:
+        if execution_state.get('status') != 'IN_PROGRESS': return
+        job_execution.execution['versionNumber'] = execution_state['versionNumber']
+    else:
+        # accepted updates bump the version by one
+        job_execution.execution['versionNumber'] += 1
+
+    job_execution.execution['status'] = 'IN_PROGRESS'
 
+    await start_job_execution(client, job_execution)
 
-def jobs_jobid_update_rejected(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
+
+async def jobs_jobid_update_rejected(client: AsyncClient, message: paho.MQTTMessage) -> None:
     # {
     #     "code": "ErrorCode",
     #     "message": "string",
@@ -230,11 +261,21 @@ def jobs_jobid_update_rejected(client: paho.Client, userdata: dict, message: pah
     # }
     logger.error(f'MQTT request rejected for topic {message.topic}:\n{message.payload}')
 
+    topic_job_id = message.topic.split('/')[4]
+
+    # a queued execution that couldn't be moved to IN_PROGRESS gives up its slot, and is only queued again by
+    # jobs_jobid_get_accepted once it has been described again, so the next update has its current versionNumber
+    job_execution = active_executions.get(topic_job_id)
+    if job_execution and not job_execution.started:
+        release_job_execution(job_execution)
+        client.publish(f'$aws/things/{client_id}/jobs/{topic_job_id}/get')
+        await schedule(client)
+
 
 # JobExecutionsChanged:
 # Sent whenever a job execution is added to or removed from the list of pending job executions for a thing.
 # https://docs.aws.amazon.com/iot/latest/developerguide/jobs-api.html
-def jobs_notify(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
+async def jobs_notify(client: AsyncClient, message: paho.MQTTMessage) -> None:
     # {
     #     "jobs": {
     #         "JobExecutionState": [{
@@ -248,7 +289,7 @@ def jobs_notify(client: paho.Client, userdata: dict, message: paho.MQTTMessage)
     #     },
     #     "timestamp": timestamp,
     # }
-    client.publish(f'$aws/things/{client_id}/jobs/get', qos=2)
+    client.publish(f'$aws/things/{client_id}/jobs/get')
 
 
 # NextJobExecutionChanged:
@@ -259,7 +300,7 @@ def jobs_notify(client: paho.Client, userdata: dict, message: paho.MQTTMessage)
 # If the state of J2 is changed to IN_PROGRESS while the state of J1 remains unchanged, then this notification is
 # sent and contains details of J2.
 # https://docs.aws.amazon.com/iot/latest/developerguide/jobs-api.html
-def jobs_notify_next(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
+async def jobs_notify_next(client: AsyncClient, message: paho.MQTTMessage) -> None:
     # {
     #     "execution": {
     #         "jobId": "string",
@@ -273,116 +314,131 @@ def jobs_notify_next(client: paho.Client, userdata: dict, message: paho.MQTTMess
     #     },
     #     "timestamp": timestamp,
     # }
-    client.publish(f'$aws/things/{client_id}/jobs/get', qos=2)
+    client.publish(f'$aws/things/{client_id}/jobs/get')
 
 
-def start_job_execution(execution: dict) -> None:
+def enqueue(execution: dict) -> None:
     job_id = execution['jobId']
+    if job_id not in waiting_executions:
+        priority = execution['jobDocument'].get('priority', 0)
+        heapq.heappush(waiting_queue, (-priority, execution.get('queuedAt', 0), job_id))
+    waiting_executions[job_id] = execution
 
-    job_document = execution['jobDocument']
-    program = job_document['program']
 
-    os.makedirs(f'/tmp/{config.app_name}/jobs', exist_ok=True)
+async def schedule(client: AsyncClient) -> None:
+    # hands out free slots to the waiting executions in priority order, skipping over programs that are at their limit
+    skipped = []
 
-    with open(f'/tmp/{config.app_name}/jobs/{program}', 'w') as f:
-        json.dump(execution, f)
+    while waiting_queue and len(active_executions) < max_concurrency:
+        entry = heapq.heappop(waiting_queue)
+        job_id = entry[2]
 
-    shell(f'/usr/bin/supervisorctl'
-          f' -c /etc/{config.app_name}/supervisord.conf'
-          f' start jobs_{program}')
+        execution = waiting_executions.get(job_id)
+        if not execution or job_id in active_executions: continue
 
-    global active_job_execution
-    active_job_execution = execution
+        slot = free_slot(execution['jobDocument']['program'])
+        if slot is None:
+            skipped.append(entry)
+            continue
 
-    global active_job_timer
-    if active_job_timer: active_job_timer.cancel()
-    active_job_timer = threading.Timer(60, client.publish, args=[f'$aws/things/{client_id}/jobs/{job_id}/get'], kwargs={'qos': 2})
-    active_job_timer.start()
+        waiting_executions.pop(job_id)
+        job_execution = JobExecution(execution, slot)
+        active_executions[job_id] = job_execution
 
+        if execution['status'] == 'QUEUED':
+            client.publish(f'$aws/things/{client_id}/jobs/{job_id}/update', payload=json.dumps({
+                'status': 'IN_PROGRESS',
+                'expectedVersion': execution['versionNumber'],
+                'includeJobExecutionState': True
+            }))
+        else:
+            await start_job_execution(client, job_execution)
 
-def restart_job_execution(execution: dict) -> None:
-    job_document = execution['jobDocument']
-    program = job_document['program']
+    for entry in skipped:
+        heapq.heappush(waiting_queue, entry)
 
-    shell(f'/usr/bin/supervisorctl'
-          f' -c /etc/{config.app_name}/supervisord.conf'
-          f' restart jobs_{program}')
 
+def free_slot(program: str) -> typing.Optional[int]:
+    used = set(job_execution.slot for job_execution in active_executions.values() if job_execution.program == program)
+    for slot in range(program_concurrency.get(program, 1)):
+        if slot not in used: return slot
+    return None
 
-def stop_job_execution(execution: dict) -> None:
-    job_document = execution['jobDocument']
-    program = job_document['program']
 
-    shell(f'/usr/bin/supervisorctl'
-          f' -c /etc/{config.app_name}/supervisord.conf'
-          f' stop jobs_{program}')
+async def start_job_execution(client: AsyncClient, job_execution: JobExecution) -> None:
+    job_id = job_execution.job_id
 
-    reset_job_execution()
+    os.makedirs(f'/tmp/{config.app_name}/jobs', exist_ok=True)
 
+    with open(f'/tmp/{config.app_name}/jobs/{job_execution.name}', 'w') as f:
+        json.dump(job_execution.execution, f)
 
-def reset_job_execution() -> None:
-    global active_job_execution
-    active_job_execution = None
+    try:
+        await supervisor.start(job_execution.process_name)
+    except xmlrpc.client.Fault as e:
+        # still running from before this service restarted
+        if e.faultCode != util.supervisor.ALREADY_STARTED: raise
 
-    global active_job_timer
-    if active_job_timer:
-        active_job_timer.cancel()
-        active_job_timer = None
+    job_execution.started = True
 
+    if job_execution.timer: job_execution.timer.cancel()
+    job_execution.timer = client.call_later(60, lambda: client.publish(f'$aws/things/{client_id}/jobs/{job_id}/get'))
 
-def pidof_job_execution(execution: dict) -> int:
-    job_document = execution['jobDocument']
-    program = job_document['program']
 
-    pid = shell(f'/usr/bin/supervisorctl'
-                f' -c /etc/{config.app_name}/supervisord.conf'
-                f' pid jobs_{program}', stdout=subprocess.STDOUT)
+async def restart_job_execution(job_execution: JobExecution) -> None:
+    await supervisor.restart(job_execution.process_name)
 
-    return int(pid)
 
+async def stop_job_execution(client: AsyncClient, job_execution: JobExecution) -> None:
+    if job_execution.started:
+        await supervisor.stop(job_execution.process_name)
 
-def supervisor_process_state(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
-    execution = active_job_execution
-    if not execution: return
+    release_job_execution(job_execution)
+
+    await schedule(client)
+
+
+def release_job_execution(job_execution: JobExecution) -> None:
+    active_executions.pop(job_execution.job_id, None)
+
+    if job_execution.timer:
+        job_execution.timer.cancel()
+        job_execution.timer = None
 
-    payload = json.loads(message.payload.decode('utf-8'))
 
-    job_document = execution['jobDocument']
-    program = job_document['program']
+async def supervisor_process_state(client: AsyncClient, message: paho.MQTTMessage) -> None:
+    payload = json.loads(message.payload.decode('utf-8'))
 
-    if payload['processname'] != program: return
+    job_execution = next((x for x in active_executions.values() if x.started and x.process_name == payload['processname']), None)
+    if not job_execution: return
 
     # http://supervisord.org/events.html#process-state-stopped-event-type
     # http://supervisord.org/events.html#process-state-exited-event-type
     if payload['eventname'] in ['PROCESS_STATE_STOPPED', 'PROCESS_STATE_EXITED']:
-        reset_job_execution()
+        release_job_execution(job_execution)
+        await schedule(client)
 
     # in the case where you might have your job process use supervisor's autorestart feature,
     # you may want the FAILED status to only send when supervisor gives up and goes into FATAL state.
     # http://supervisord.org/events.html#process-state-fatal-event-type
     elif payload['eventname'] == 'PROCESS_STATE_FATAL':
-        reset_job_execution()
+        release_job_execution(job_execution)
 
-        job_id = execution['jobId']
-        client.publish(f'$aws/things/{client_id}/jobs/{job_id}/update', qos=2, payload=json.dumps({
+        execution = job_execution.execution
+        client.publish(f'$aws/things/{client_id}/jobs/{job_execution.job_id}/update', payload=json.dumps({
             'status': 'FAILED',
             'expectedVersion': execution['versionNumber'],
             'executionNumber': execution['executionNumber']
         }))
 
+        await schedule(client)
 
-client = None
-
-try:
 
-    client = paho.Client(clean_session=True)
-    client.on_connect = on_connect
-    client.enable_logger(logger)
-    logger.addHandler(MqttLoggingHandler(client, f'$aws/rules/{config.topic_prefix}/things/{client_id}/log'))
+def setup(client: AsyncClient) -> None:
+    logger.addHandler(MqttLoggingHandler(client.paho, util.outbox.topic(f'$aws/rules/{config.topic_prefix}/things/{client_id}/log')))
+    client.connect_callback_add(on_connect)
     client.message_callback_add(f'$aws/things/{client_id}/jobs/get/accepted', jobs_get_accepted)
     client.message_callback_add(f'$aws/things/{client_id}/jobs/get/rejected', jobs_get_rejected)
-    client.message_callback_add(f'$aws/things/{client_id}/jobs/start-next/accepted', jobs_start_next_accepted)
-    client.message_callback_add(f'$aws/things/{client_id}/jobs/start-next/rejected', jobs_start_next_rejected)
     client.message_callback_add(f'$aws/things/{client_id}/jobs/+/get/accepted', jobs_jobid_get_accepted)
     client.message_callback_add(f'$aws/things/{client_id}/jobs/+/get/rejected', jobs_jobid_get_rejected)
     client.message_callback_add(f'$aws/things/{client_id}/jobs/+/update/accepted', jobs_jobid_update_accepted)
@@ -390,23 +446,22 @@ try:
     client.message_callback_add(f'$aws/things/{client_id}/jobs/notify', jobs_notify)
     client.message_callback_add(f'$aws/things/{client_id}/jobs/notify-next', jobs_notify_next)
     client.message_callback_add(f'supervisor/processes/+/events/PROCESS_STATE', supervisor_process_state)
-    client.connect_async('localhost')
-    client.loop_start()
 
-    signal.sigwait([signal.SIGINT])
 
-except:
+def teardown(client: AsyncClient) -> None:
+    for job_execution in active_executions.values():
+        if job_execution.timer: job_execution.timer.cancel()
+
+    if check_pending_timer:
+        check_pending_timer.cancel()
+
 
-    logger.critical('Fatal shutdown...', exc_info=True)
+if __name__ == '__main__':
 
-finally:
+    try:
 
-    if active_job_timer:
-        active_job_timer.cancel()
+        util.aiomqtt.run(setup, teardown, client_id=f'{client_id}-jobs', clean_session=not config.mqtt_persistent_sessions)
 
-    if check_pending_timer:
-        check_pending_timer.cancel()
+    except:
 
-    if client:
-        client.loop_stop()
-        client.disconnect()
+        logger.critical('Fatal shutdown...', exc_info=True)
@@ -6,6 +6,8 @@ import time
 
 import paho.mqtt.publish as paho
 
+import baseline_device.util.qos
+from baseline_device import util
 from baseline_device.util.config import config
 
 logging.basicConfig(level=logging.INFO)
@@ -13,7 +15,8 @@ logger = logging.getLogger(__file__)
 
 client_id = os.environ['BASELINE_CLIENT_ID']
 
-program = 'sample1'
+# jobs_<program> or jobs_<program>_<slot> when the program runs more than one execution at a time
+program = os.environ.get('SUPERVISOR_PROCESS_NAME', 'jobs_sample1')[len('jobs_'):]
 
 job_id = None
 
@@ -30,7 +33,7 @@ try:
 
     logger.info('Job complete!')
 
-    paho.single(f'$aws/things/{client_id}/jobs/{job_id}/update', qos=2, payload=json.dumps({
+    paho.single(f'$aws/things/{client_id}/jobs/{job_id}/update', qos=util.qos.qos(f'$aws/things/{client_id}/jobs/{job_id}/update'), payload=json.dumps({
         'status': 'SUCCEEDED',
         'expectedVersion': execution['versionNumber'],
         'executionNumber': execution['executionNumber']
@@ -47,7 +50,7 @@ except:
 
     if job_id:
         try:
-            paho.single(f'$aws/things/{client_id}/jobs/{job_id}/update', qos=2, payload=json.dumps({
+            paho.single(f'$aws/things/{client_id}/jobs/{job_id}/update', qos=util.qos.qos(f'$aws/things/{client_id}/jobs/{job_id}/update'), payload=json.dumps({
                 'status': 'FAILED',
                 'expectedVersion': execution['versionNumber'],
                 'executionNumber': execution['executionNumber']
@@ -8,6 +8,9 @@ import time
 import paho.mqtt.client as paho
 import paho.mqtt.publish as paho_publish
 
+import baseline_device.util.outbox
+import baseline_device.util.qos
+from baseline_device import util
 from baseline_device.util.config import config
 from baseline_device.util.mqtt import MqttLoggingHandler
 
@@ -16,7 +19,8 @@ logger = logging.getLogger(__file__)
 
 client_id = os.environ['BASELINE_CLIENT_ID']
 
-program = 'sample2'
+# jobs_<program> or jobs_<program>_<slot> when the program runs more than one execution at a time
+program = os.environ.get('SUPERVISOR_PROCESS_NAME', 'jobs_sample2')[len('jobs_'):]
 
 connected = threading.Event()
 
@@ -46,7 +50,7 @@ try:
     client = paho.Client(clean_session=True)
     client.on_connect = on_connect
     client.enable_logger(logger)
-    logger.addHandler(MqttLoggingHandler(client, f'$aws/rules/{config.topic_prefix}/things/{client_id}/log'))
+    logger.addHandler(MqttLoggingHandler(client, util.outbox.topic(f'$aws/rules/{config.topic_prefix}/things/{client_id}/log')))
     client.connect_async('localhost')
     client.loop_start()
 
@@ -59,7 +63,7 @@ try:
 
     logger.info('Job complete!')
 
-    client.publish(f'$aws/things/{client_id}/jobs/{job_id}/update', qos=2, payload=json.dumps({
+    client.publish(f'$aws/things/{client_id}/jobs/{job_id}/update', qos=util.qos.qos(f'$aws/things/{client_id}/jobs/{job_id}/update'), payload=json.dumps({
         'status': 'SUCCEEDED',
         'expectedVersion': execution['versionNumber'],
         'executionNumber': execution['executionNumber']
@@ -77,7 +81,7 @@ except:
     if job_id:
         try:
             client_publish = client.publish if client.is_connected() else paho_publish.single
-            client_publish(f'$aws/things/{client_id}/jobs/{job_id}/update', qos=2, payload=json.dumps({
+            client_publish(f'$aws/things/{client_id}/jobs/{job_id}/update', qos=util.qos.qos(f'$aws/things/{client_id}/jobs/{job_id}/update'), payload=json.dumps({
                 'status': 'FAILED',
                 'expectedVersion': execution['versionNumber'],
                 'executionNumber': execution['executionNumber']
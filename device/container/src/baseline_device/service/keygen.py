@@ -0,0 +1,26 @@
+import logging
+import os
+
+import baseline_device.util.keys
+from baseline_device import util
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+# Runs once after provisioning to leave a spare key for the next one, at low priority so the other services
+# are not held up by an RSA key being generated.
+
+if __name__ == '__main__':
+
+    try:
+
+        os.nice(10)
+
+        if util.keys.ensure_spare():
+            logger.info(f'Generated a spare {util.keys.configured()} key')
+
+    except:
+
+        logger.critical('Unable to generate a spare key.', exc_info=True)
+
+        raise
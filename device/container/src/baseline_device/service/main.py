@@ -1,30 +1,44 @@
+import asyncio
 import json
 import logging
 import os
-import signal
+import typing
 import uuid
 
 import paho.mqtt.client as paho
 
+import baseline_device.util.aiomqtt
 import baseline_device.util.hex
+import baseline_device.util.outbox
 from baseline_device import util
+from baseline_device.util.aiomqtt import AsyncClient
 from baseline_device.util.config import config
 from baseline_device.util.date import format_utc
 from baseline_device.util.mqtt import MqttLoggingHandler
+from baseline_device.util.outbox import Outbox
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__file__)
 
 client_id = os.environ['BASELINE_CLIENT_ID']
 
+outbox: typing.Optional[Outbox] = None
+bridge_online = False
+replay_task: typing.Optional[asyncio.Task] = None
 
-def on_connect(client: paho.Client, userdata: dict, flags: dict, rc: int) -> None:
+
+async def on_connect(client: AsyncClient, flags: dict, rc: int) -> None:
     logger.info(f'Local Client: CONNECTED')
 
-    client.subscribe(f'$SYS/broker/connection/{client_id}/state', qos=2)
+    # subscribing again is what gets the retained bridge state sent, so that one is always renewed
+    client.subscribe(f'$SYS/broker/connection/{client_id}/state')
+
+    # with a persistent session, outbox messages published while this service was down are waiting for it
+    if not util.aiomqtt.session_present(flags):
+        client.subscribe(f'{util.outbox.LOCAL_PREFIX}#')
 
     # updating the shadow will create it if it does not exist
-    client.publish(f'$aws/things/{client_id}/shadow/name/sample/update', qos=2, payload=json.dumps({
+    client.publish(f'$aws/things/{client_id}/shadow/name/sample/update', payload=json.dumps({
         'state': {
             'desired': {
                 'connected': format_utc(),
@@ -36,31 +50,55 @@ def on_connect(client: paho.Client, userdata: dict, flags: dict, rc: int) -> Non
     }))
 
 
-def bridge_connection_status(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
-    status = 'ONLINE' if message.payload == b'1' else 'OFFLINE'
+async def bridge_connection_status(client: AsyncClient, message: paho.MQTTMessage) -> None:
+    global bridge_online
+    bridge_online = message.payload == b'1'
+
+    status = 'ONLINE' if bridge_online else 'OFFLINE'
     logger.info(f'Remote Bridge Connection: {status}')
 
+    if bridge_online: start_replay(client)
+
+
+async def outbox_message(client: AsyncClient, message: paho.MQTTMessage) -> None:
+    topic = util.outbox.remote_topic(message.topic)
+
+    # anything already waiting goes first, so messages are forwarded in the order they were published
+    if bridge_online and not len(outbox):
+        client.publish(topic, message.payload, qos=message.qos)
+    else:
+        outbox.append(topic, message.payload, qos=message.qos)
+        if bridge_online: start_replay(client)
 
-client = None
 
-try:
+def start_replay(client: AsyncClient) -> None:
+    global replay_task
+    if replay_task and not replay_task.done(): return
+    if not len(outbox): return
+    replay_task = client.loop.create_task(util.aiomqtt.log_exceptions(outbox.replay(client, lambda: bridge_online), outbox.replay))
 
-    client = paho.Client(clean_session=True)
-    client.on_connect = on_connect
-    client.enable_logger(logger)
-    logger.addHandler(MqttLoggingHandler(client, f'$aws/rules/{config.topic_prefix}/things/{client_id}/log'))
+
+def setup(client: AsyncClient) -> None:
+    global outbox
+    outbox = Outbox()
+
+    logger.addHandler(MqttLoggingHandler(client.paho, util.outbox.topic(f'$aws/rules/{config.topic_prefix}/things/{client_id}/log')))
+    client.connect_callback_add(on_connect)
     client.message_callback_add(f'$SYS/broker/connection/{client_id}/state', bridge_connection_status)
-    client.connect_async('localhost')
-    client.loop_start()
+    client.message_callback_add(f'{util.outbox.LOCAL_PREFIX}#', outbox_message)
+
+
+def teardown(client: AsyncClient) -> None:
+    if replay_task: replay_task.cancel()
+    if outbox: outbox.close()
+
 
-    signal.sigwait([signal.SIGINT])
+if __name__ == '__main__':
 
-except:
+    try:
 
-    logger.critical('Fatal shutdown...', exc_info=True)
+        util.aiomqtt.run(setup, teardown, client_id=f'{client_id}-main', clean_session=not config.mqtt_persistent_sessions)
 
-finally:
+    except:
 
-    if client:
-        client.loop_stop()
-        client.disconnect()
+        logger.critical('Fatal shutdown...', exc_info=True)
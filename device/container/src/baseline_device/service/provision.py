@@ -2,10 +2,17 @@ import json
 import logging
 import os
 import shutil
+import ssl
+import time
+import typing
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 
 import OpenSSL.crypto as openssl
 import paho.mqtt.client as paho
 
+import baseline_device.util.keys
+from baseline_device import util
 from baseline_device.util import hex
 from baseline_device.util.config import config
 from baseline_device.util.file import mkdtemp
@@ -15,144 +22,201 @@ from baseline_device.util.mqtt import send_and_receive
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__file__)
 
-client = None
 
-try:
+def write_synced(path: str, data: str, mode: int = 0o644) -> None:
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
 
-    with open(f'/etc/{config.app_name}/aws/endpoint', 'r') as f:
-        aws_endpoint = f.read()
 
-    client_key = openssl.PKey()
-    client_key.generate_key(openssl.TYPE_RSA, 2048)
-    client_key_pem = openssl.dump_privatekey(openssl.FILETYPE_PEM, client_key)
-    client_key_pem = client_key_pem.decode('utf-8')
-
-    client_csr = openssl.X509Req()
-    client_subject = client_csr.get_subject()
-    client_subject.C = 'US'
-    client_subject.CN = config.app_name
-    client_csr.set_pubkey(client_key)
-    client_csr.sign(client_key, 'sha256')
-    client_csr.verify(client_key)
-    client_csr_pem = openssl.dump_certificate_request(openssl.FILETYPE_PEM, client_csr)
-    client_csr_pem = client_csr_pem.decode('utf-8')
+def close_client(client: typing.Optional[paho.Client]) -> None:
+    if client:
+        client.disconnect()
+        client.loop_stop()
 
-    # force iot:ClientId to be 128 characters to avoid collisions when randomly selected by new clients.
-    # https://docs.aws.amazon.com/general/latest/gr/iot-core.html#iot-protocol-limits
-    client_id = hex.rand(128)
 
-    client = paho.Client(client_id, clean_session=True)
-    client.enable_logger(logger)
-    client.tls_set(
-        ca_certs=f'/etc/{config.app_name}/aws/root.crt',
-        certfile=f'/etc/{config.app_name}/aws/client.crt',
-        keyfile=f'/etc/{config.app_name}/aws/client.key',
-        cert_reqs=paho.ssl.CERT_REQUIRED,
-        tls_version=paho.ssl.PROTOCOL_SSLv23
-    )
+# Provisioning as a state machine, each state returns the next:
+#
+#   connect    connect with the bootstrap certificate and a random 128 character client id
+#   request    send the CSR to clients/<client-id>/provision, the response is the signed certificate
+#   reconnect  connect again with the new certificate and the thing name as the client id, while the
+#              credentials are written to a staging directory and the bootstrap client is closed
+#   verify     call things/<thing-name>/provision to move the thing to the verified group
+#   commit     rename the staging directory into place, the entrypoint only looks for that directory
+#
+# The two connections can't be one, AWS IoT Core ties the client id and the policy to the certificate of the
+# connection. They share one SSL context, so the CA bundle is only loaded once, with the new certificate
+# loaded into it for the second. The second handshake is always a full one, resuming the first session
+# would carry over the bootstrap certificate's identity.
+class Provisioner(object):
+
+    def __init__(self, aws_dir: str, persistent_dir: str) -> None:
+        self.aws_dir = aws_dir
+        self.persistent_dir = persistent_dir
+        self.staging_dir = f'{persistent_dir}.staging'
+
+        self.state = 'connect'
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+        # the key is taken from the spare made in the background, or generated while connecting
+        self.client_key_future = util.keys.take_or_generate_async()
+
+        with open(f'{aws_dir}/endpoint', 'r') as f:
+            self.aws_endpoint = f.read()
+
+        self.context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=f'{aws_dir}/root.crt')
+        self.context.load_cert_chain(f'{aws_dir}/client.crt', f'{aws_dir}/client.key')
+
+        # force iot:ClientId to be 128 characters to avoid collisions when randomly selected by new clients.
+        # https://docs.aws.amazon.com/general/latest/gr/iot-core.html#iot-protocol-limits
+        self.client_id = hex.rand(128)
+
+        self.bootstrap_client: typing.Optional[paho.Client] = None
+        self.client: typing.Optional[paho.Client] = None
+        self.staged: typing.Optional[Future] = None
+
+        self.client_key_pem: typing.Optional[str] = None
+        self.certificate_id: typing.Optional[str] = None
+        self.certificate_pem: typing.Optional[str] = None
+        self.thing_name: typing.Optional[str] = None
+
+    def run(self) -> None:
+        started = time.monotonic()
+        try:
+            while self.state != 'done':
+                state, state_started = self.state, time.monotonic()
+                self.state = getattr(self, state)()
+                logger.info(f'Provisioning {state} took {time.monotonic() - state_started:.3f}s')
+            logger.info(f'Provisioned {self.thing_name} in {time.monotonic() - started:.3f}s')
+        finally:
+            self.close()
+
+    def create_client(self, client_id: str) -> paho.Client:
+        client = paho.Client(client_id, clean_session=True)
+        client.enable_logger(logger)
+        client.tls_set_context(self.context)
+        return client
 
-    client.loop_start()
+    def connect(self) -> str:
+        self.bootstrap_client = self.create_client(self.client_id)
+        connect_and_wait(self.bootstrap_client, self.aws_endpoint, port=8883)
+        return 'request'
 
-    connect_and_wait(client, aws_endpoint, port=8883)
+    def request(self) -> str:
+        client_key = self.client_key_future.result()
+        self.client_key_pem = util.keys.dump(client_key)
+        client_csr_pem = util.keys.create_csr(client_key, config.app_name)
 
-    response = send_and_receive(
-        client=client,
-        topic=f'$aws/rules/{config.topic_prefix}/clients/{client_id}/provision',
-        payload=json.dumps({
-            'csr': client_csr_pem
-        }),
-        qos=1
-    )
+        response = send_and_receive(
+            client=self.bootstrap_client,
+            topic=f'$aws/rules/{config.topic_prefix}/clients/{self.client_id}/provision',
+            payload=json.dumps({
+                'csr': client_csr_pem
+            }),
+            qos=1
+        )
 
-    if not response:
-        raise Exception('No response from provision(1) request.')
+        if not response:
+            raise Exception('No response from provision(1) request.')
 
-    if response.topic.endswith('/rejected'):
-        raise Exception('Provision(1) request rejected.')
+        if response.topic.endswith('/rejected'):
+            raise Exception('Provision(1) request rejected.')
 
-    response = response.payload.decode('utf-8')
-    response = json.loads(response)
+        response = response.payload.decode('utf-8')
+        response = json.loads(response)
 
-    certificate_arn = response['arn']
-    certificate_id = certificate_arn.rsplit(maxsplit=1, sep='/')[1]
-    certificate_pem = response['pem']
+        certificate_arn = response['arn']
+        self.certificate_id = certificate_arn.rsplit(maxsplit=1, sep='/')[1]
+        self.certificate_pem = response['pem']
 
-    certificate = openssl.load_certificate(openssl.FILETYPE_PEM, certificate_pem)
-    certificate_subject = certificate.get_subject()
+        certificate = openssl.load_certificate(openssl.FILETYPE_PEM, self.certificate_pem)
+        self.thing_name = certificate.get_subject().CN
 
-    thing_name = certificate_subject.CN
+        return 'reconnect'
 
-    with mkdtemp() as tmp_dir:
+    def reconnect(self) -> str:
+        self.staged = self.executor.submit(self.stage)
 
-        with open(f'{tmp_dir}/client.crt', 'w') as f:
-            f.write(certificate_pem)
+        # ssl only loads certificates from files, these never leave tmpfs
+        with mkdtemp() as tmp_dir:
+            with open(f'{tmp_dir}/client.crt', 'w') as f:
+                f.write(self.certificate_pem)
+            with open(f'{tmp_dir}/client.key', 'w') as f:
+                f.write(self.client_key_pem)
+            self.context.load_cert_chain(f'{tmp_dir}/client.crt', f'{tmp_dir}/client.key')
 
-        with open(f'{tmp_dir}/client.key', 'w') as f:
-            f.write(client_key_pem)
+        # the bootstrap client takes up to a second to stop its network loop, which needn't hold us up
+        bootstrap_client, self.bootstrap_client = self.bootstrap_client, None
+        self.executor.submit(close_client, bootstrap_client)
 
-        # reconnect using the thing_name as the client_id to verify provisioning
-        client.loop_stop()
-        client.disconnect()
-
-        client.reinitialise(thing_name, clean_session=True)
-        client.enable_logger(logger)
-        client.tls_set(
-            ca_certs=f'/etc/{config.app_name}/aws/root.crt',
-            certfile=f'{tmp_dir}/client.crt',
-            keyfile=f'{tmp_dir}/client.key',
-            cert_reqs=paho.ssl.CERT_REQUIRED,
-            tls_version=paho.ssl.PROTOCOL_SSLv23
-        )
-
-        client.loop_start()
-
-        connect_and_wait(client, aws_endpoint, port=8883)
+        self.client = self.create_client(self.thing_name)
+        connect_and_wait(self.client, self.aws_endpoint, port=8883)
+        return 'verify'
 
+    def verify(self) -> str:
         response = send_and_receive(
-            client=client,
-            topic=f'$aws/rules/{config.topic_prefix}/things/{thing_name}/provision',
+            client=self.client,
+            topic=f'$aws/rules/{config.topic_prefix}/things/{self.thing_name}/provision',
             qos=1
         )
 
-        client.loop_stop()
-        client.disconnect()
-        client = None
-
         if not response:
             raise Exception('No response from provision(2) request.')
 
         if response.topic.endswith('/rejected'):
             raise Exception('Provision(2) request rejected.')
 
-        persistent_dir = f'/mnt/{config.app_name}/aws'
+        return 'commit'
 
-        try:
+    def commit(self) -> str:
+        self.staged.result()
+        if os.path.exists(self.persistent_dir): shutil.rmtree(self.persistent_dir)
+        os.rename(self.staging_dir, self.persistent_dir)
+        self.staged = None
+        return 'done'
 
-            os.makedirs(persistent_dir, exist_ok=True)
+    def stage(self) -> None:
+        # synced to disk so the rename in commit can't expose a directory with an empty key after a power cut
+        if os.path.exists(self.staging_dir): shutil.rmtree(self.staging_dir)
+        os.makedirs(self.staging_dir)
 
-            with open(f'{persistent_dir}/thing.id', 'w') as f:
-                f.write(thing_name)
+        write_synced(f'{self.staging_dir}/thing.id', self.thing_name)
+        write_synced(f'{self.staging_dir}/client.crt.id', self.certificate_id)
+        write_synced(f'{self.staging_dir}/client.crt', self.certificate_pem)
+        write_synced(f'{self.staging_dir}/client.key', self.client_key_pem, 0o600)
 
-            with open(f'{persistent_dir}/client.crt.id', 'w') as f:
-                f.write(certificate_id)
+        fd = os.open(self.staging_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
-            shutil.move(f'{tmp_dir}/client.crt', f'{persistent_dir}/client.crt')
-            shutil.move(f'{tmp_dir}/client.key', f'{persistent_dir}/client.key')
+    def close(self) -> None:
+        close_client(self.client)
+        self.client = None
+        close_client(self.bootstrap_client)
+        self.bootstrap_client = None
 
-        except:
+        if self.staged:
+            # provisioning failed, the credentials are for a thing that the cloud has removed again
+            try:
+                self.staged.result()
+            except:
+                pass
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
 
-            shutil.rmtree(persistent_dir)
+        self.executor.shutdown(wait=True)
 
-            raise
 
-except:
+if __name__ == '__main__':
 
-    logger.critical('Unable to complete provisioning.', exc_info=True)
+    try:
 
-    raise
+        Provisioner(f'/etc/{config.app_name}/aws', f'/mnt/{config.app_name}/aws').run()
 
-finally:
+    except:
 
-    if client:
-        client.loop_stop()
-        client.disconnect()
+        logger.critical('Unable to complete provisioning.', exc_info=True)
+
+        raise
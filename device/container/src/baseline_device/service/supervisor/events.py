@@ -1,109 +1,104 @@
+import asyncio
 import json
 import logging
 import os
-import select
 import signal
 import sys
-import threading
 
-import paho.mqtt.client as paho
+import baseline_device.util.aiomqtt
+import baseline_device.util.supervisor
+from baseline_device import util
+from baseline_device.util.aiomqtt import AsyncClient
+from baseline_device.util.config import config
+from baseline_device.util.supervisor import EventParser
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__file__)
 
 client_id = os.environ['BASELINE_CLIENT_ID']
 
-client = None
+# each event is published once, process events to the first topic and everything else to the second,
+# the full event name (e.g. PROCESS_STATE_EXITED) is always in the payload
+process_topic = config.supervisor_events_process_topic or 'supervisor/processes/{processname}/events/{eventtype}'
+event_topic = config.supervisor_events_topic or 'supervisor/events/{eventtype}'
 
-try:
+# http://supervisord.org/events.html#event-listener-notification-protocol
+READY = b'READY\n'
+RESULT_OK = b'RESULT 2\nOK'
+RESULT_FAIL = b'RESULT 4\nFAIL'
 
-    client = paho.Client(clean_session=True)
-    client.enable_logger(logger)
-    client.connect_async('localhost')
-    client.loop_start()
+parser = EventParser()
 
-    terminate = threading.Event()
 
+def stdin_ready(client: AsyncClient) -> None:
+    data = os.read(sys.stdin.fileno(), 65536)
 
-    def shutting_down() -> bool:
-        return terminate.is_set() or \
-               client._state == paho.mqtt_cs_disconnecting or \
-               client._thread_terminate
+    if not data:
+        logger.warning('Supervisor closed stdin, shutting down')
+        asyncio.get_event_loop().remove_reader(sys.stdin.fileno())
+        signal.raise_signal(signal.SIGTERM)
+        return
 
+    global parser
 
-    def shutdown(signum, frame) -> None:
-        terminate.set()
-        client.loop_stop()
-        client.disconnect()
+    try:
+        events = parser.feed(data)
+    except:
+        logger.error('Unable to parse supervisor event', exc_info=True)
+        parser = EventParser()
+        write(RESULT_FAIL + READY)
+        return
 
+    # supervisor sends the next event only after a result, so there is normally just the one
+    for headers, payload in events:
+        try:
+            publish_event(client, headers, payload)
+            write(RESULT_OK + READY)
+        except:
+            logger.error(f'Unable to publish supervisor event {headers.get("eventname")}', exc_info=True)
+            write(RESULT_FAIL + READY)
 
-    signal.signal(signal.SIGINT, shutdown)
 
-    sys.stdout.write('READY\n')
-    sys.stdout.flush()
+def publish_event(client: AsyncClient, headers: dict, payload: bytes) -> None:
+    # http://supervisord.org/events.html#event-types
+    event_name = headers['eventname']
+    body = util.supervisor.parse_payload(payload)
 
-    while not shutting_down():
+    values = {
+        **body,
+        'eventname': event_name,
+        'eventtype': util.supervisor.event_type(event_name)
+    }
 
-        available, _, _ = select.select([sys.stdin], [], [], 0.100)
-        if not available: continue
+    topic = process_topic if 'processname' in body else event_topic
 
-        if shutting_down(): break
+    client.publish(topic.format(**values), payload=json.dumps({
+        'eventname': event_name,
+        **body
+    }))
 
-        try:
 
-            data = sys.stdin.readline()
-            headers = dict([x.split(':') for x in data.split()])
-            body = sys.stdin.read(int(headers['len']))
+def write(data: bytes) -> None:
+    os.write(sys.stdout.fileno(), data)
 
-            sys.stdout.write('RESULT 2\nOK')
-            sys.stdout.write('READY\n')
-            sys.stdout.flush()
 
-        except:
+def setup(client: AsyncClient) -> None:
+    # the event loop wakes us when supervisor writes an event, instead of polling stdin on a timeout
+    asyncio.get_event_loop().add_reader(sys.stdin.fileno(), stdin_ready, client)
+
+    write(READY)
+
+
+def teardown(client: AsyncClient) -> None:
+    asyncio.get_event_loop().remove_reader(sys.stdin.fileno())
+
+
+if __name__ == '__main__':
+
+    try:
+
+        util.aiomqtt.run(setup, teardown, client_id=f'{client_id}-events', clean_session=not config.mqtt_persistent_sessions)
+
+    except:
 
-            sys.stdout.write('RESULT 4\nFAIL')
-            sys.stdout.write('READY\n')
-            sys.stdout.flush()
-            continue
-
-        event_name = headers['eventname']
-
-        # http://supervisord.org/events.html#supervisor-state-change-event-type
-        if event_name.startswith('SUPERVISOR_STATE_CHANGE_'):
-            client.publish(f'supervisor/events/SUPERVISOR_STATE_CHANGE', qos=2, payload=json.dumps({
-                'eventname': event_name
-            }))
-            client.publish(f'supervisor/events/{event_name}', qos=2, payload=json.dumps({
-                'eventname': event_name
-            }))
-
-        # http://supervisord.org/events.html#process-state-event-type
-        elif event_name.startswith('PROCESS_STATE_'):
-            body = dict([x.split(':') for x in body.split()])
-            process_name = body['processname']
-            client.publish(f'supervisor/processes/{process_name}/events/PROCESS_STATE', qos=2, payload=json.dumps({
-                'eventname': event_name,
-                **body
-            }))
-            client.publish(f'supervisor/processes/{process_name}/events/{event_name}', qos=2, payload=json.dumps({
-                'eventname': event_name,
-                **body
-            }))
-
-        else:
-
-            body = dict([x.split(':') for x in body.split()]) if '\n' not in body else {'body': body}
-            client.publish(f'supervisor/events/{event_name}', qos=2, payload=json.dumps({
-                'eventname': event_name,
-                **body
-            }))
-
-except:
-
-    logger.critical('Fatal shutdown...', exc_info=True)
-
-finally:
-
-    if client:
-        client.loop_stop()
-        client.disconnect()
+        logger.critical('Fatal shutdown...', exc_info=True)
@@ -0,0 +1,204 @@
+import logging
+import math
+import os
+import time
+import typing
+
+import baseline_device.util.aiomqtt
+import baseline_device.util.codec
+import baseline_device.util.outbox
+from baseline_device import util
+from baseline_device.util.aiomqtt import AsyncClient
+from baseline_device.util.config import config
+from baseline_device.util.mqtt import MqttLoggingHandler
+from baseline_device.util.supervisor import supervisor
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+client_id = os.environ['BASELINE_CLIENT_ID']
+
+# samples are taken every sample_interval seconds but only a summary of each window is published, so the
+# uplink costs the same however often the device is sampled
+sample_interval: float = config.telemetry_sample_interval or 5
+window: float = config.telemetry_window or 60
+disk_path: str = config.telemetry_disk_path or f'/mnt/{config.app_name}'
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# metric name (or supervisor process name) to the values sampled in the current window
+samples: typing.Dict[str, typing.List[float]] = {}
+process_samples: typing.Dict[str, typing.List[float]] = {}
+sample_count = 0
+
+# supervisor process name to pid, refreshed every window
+processes: typing.Dict[str, int] = {}
+
+# the counters from the previous sample, cpu and network are reported as rates between samples
+previous: typing.Optional[dict] = None
+
+window_start = 0.0
+timer = None
+
+
+def read_cpu() -> typing.Tuple[int, int]:
+    # cpu  user nice system idle iowait irq softirq steal ...
+    with open('/proc/stat', 'r') as f:
+        fields = [int(field) for field in f.readline().split()[1:9]]
+    idle = fields[3] + fields[4]
+    return sum(fields) - idle, sum(fields)
+
+
+def read_memory() -> float:
+    # percentage in use, MemAvailable counts the reclaimable caches as free
+    values = {}
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            name, value = line.split(':', 1)
+            if name in ('MemTotal', 'MemAvailable'): values[name] = int(value.split()[0])
+            if len(values) == 2: break
+    return 100 * (1 - values['MemAvailable'] / values['MemTotal'])
+
+
+def read_disk() -> float:
+    stat = os.statvfs(disk_path)
+    return 100 * (1 - stat.f_bavail / stat.f_blocks) if stat.f_blocks else 0
+
+
+def read_network() -> typing.Tuple[int, int]:
+    # bytes received and sent by every interface other than loopback
+    rx, tx = 0, 0
+    with open('/proc/net/dev', 'r') as f:
+        for line in f.readlines()[2:]:
+            name, counters = line.split(':', 1)
+            if name.strip() == 'lo': continue
+            counters = counters.split()
+            rx += int(counters[0])
+            tx += int(counters[8])
+    return rx, tx
+
+
+def read_rss(pid: int) -> typing.Optional[int]:
+    try:
+        with open(f'/proc/{pid}/statm', 'r') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None  # exited since the last refresh
+
+
+def add(values: typing.Dict[str, typing.List[float]], name: str, value: typing.Optional[float]) -> None:
+    if value is not None: values.setdefault(name, []).append(value)
+
+
+def sample() -> None:
+    global previous, sample_count
+
+    now = time.monotonic()
+    busy, total = read_cpu()
+    rx, tx = read_network()
+
+    if previous:
+        elapsed = now - previous['time']
+        if total > previous['total']: add(samples, 'cpu', 100 * (busy - previous['busy']) / (total - previous['total']))
+        if elapsed > 0:
+            add(samples, 'network_rx', (rx - previous['rx']) / elapsed)
+            add(samples, 'network_tx', (tx - previous['tx']) / elapsed)
+
+    previous = {'time': now, 'busy': busy, 'total': total, 'rx': rx, 'tx': tx}
+
+    add(samples, 'memory', read_memory())
+    add(samples, 'disk', read_disk())
+    add(samples, 'load', os.getloadavg()[0])
+
+    for name, pid in processes.items():
+        add(process_samples, name, read_rss(pid))
+
+    sample_count += 1
+
+
+def summarize(values: typing.List[float]) -> typing.List[float]:
+    # [min, max, mean, p95], p95 by nearest rank
+    values = sorted(values)
+    p95 = values[max(math.ceil(0.95 * len(values)) - 1, 0)]
+    return [round(values[0], 2), round(values[-1], 2), round(sum(values) / len(values), 2), round(p95, 2)]
+
+
+def publish_window(client: AsyncClient) -> None:
+    # {
+    #     "timestamp": int,
+    #     "window": float,
+    #     "samples": int,
+    #     "metrics": {"cpu": [min, max, mean, p95], "memory": [...], "disk": [...], "load": [...], "network_rx": [...], "network_tx": [...]},
+    #     "processes": {"<supervisor process name>": [min, max, mean, p95], ...}
+    # }
+    global sample_count
+
+    if sample_count:
+        client.publish(util.outbox.topic(f'$aws/rules/{config.topic_prefix}/things/{client_id}/metrics'), payload=util.codec.encode({
+            'timestamp': round(time.time() * 1000),
+            'window': window,
+            'samples': sample_count,
+            'metrics': {name: summarize(values) for name, values in samples.items() if values},
+            'processes': {name: summarize(values) for name, values in process_samples.items() if values}
+        }))
+
+    samples.clear()
+    process_samples.clear()
+    sample_count = 0
+
+
+async def refresh_processes() -> None:
+    try:
+        infos = await supervisor.all_process_info()
+    except:
+        logger.warning('Unable to list the supervisor processes', exc_info=True)
+        return
+    processes.clear()
+    processes.update({info['name']: info['pid'] for info in infos if info['pid']})
+
+
+async def tick(client: AsyncClient) -> None:
+    global window_start, timer
+
+    try:
+        sample()
+    except:
+        logger.error('Unable to sample metrics', exc_info=True)
+
+    now = client.loop.time()
+    if now - window_start >= window - sample_interval / 2:
+        window_start = now
+        publish_window(client)
+        await refresh_processes()
+
+    # keeps to the sample interval however long the sample took
+    timer = client.call_later(max(sample_interval - (client.loop.time() - now), 0), tick, client)
+
+
+def setup(client: AsyncClient) -> None:
+    logger.addHandler(MqttLoggingHandler(client.paho, util.outbox.topic(f'$aws/rules/{config.topic_prefix}/things/{client_id}/log')))
+
+    global window_start, timer
+    window_start = client.loop.time()
+    timer = client.call_later(0, start, client)
+
+
+async def start(client: AsyncClient) -> None:
+    global timer
+    await refresh_processes()
+    timer = client.call_later(0, tick, client)
+
+
+def teardown(client: AsyncClient) -> None:
+    if timer: timer.cancel()
+
+
+if __name__ == '__main__':
+
+    try:
+
+        util.aiomqtt.run(setup, teardown, client_id=f'{client_id}-telemetry', clean_session=not config.mqtt_persistent_sessions)
+
+    except:
+
+        logger.critical('Fatal shutdown...', exc_info=True)
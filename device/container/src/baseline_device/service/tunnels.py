@@ -1,13 +1,16 @@
 import json
 import logging
 import os
-import signal
 
 import paho.mqtt.client as paho
 
+import baseline_device.util.aiomqtt
+import baseline_device.util.outbox
+from baseline_device import util
+from baseline_device.util.aiomqtt import AsyncClient
 from baseline_device.util.config import config
 from baseline_device.util.mqtt import MqttLoggingHandler
-from baseline_device.util.os import shell
+from baseline_device.util.supervisor import supervisor
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__file__)
@@ -15,11 +18,12 @@ logger = logging.getLogger(__file__)
 client_id = os.environ['BASELINE_CLIENT_ID']
 
 
-def on_connect(client: paho.Client, userdata: dict, flags: dict, rc: int) -> None:
-    client.subscribe(f'$aws/things/{client_id}/tunnels/notify', qos=2)
+async def on_connect(client: AsyncClient, flags: dict, rc: int) -> None:
+    if not util.aiomqtt.session_present(flags):
+        client.subscribe(f'$aws/things/{client_id}/tunnels/notify')
 
 
-def tunnels_notify(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
+async def tunnels_notify(client: AsyncClient, message: paho.MQTTMessage) -> None:
     # {
     #     "clientAccessToken": "<destination-client-access-token>",
     #     "clientMode": "destination",
@@ -36,31 +40,21 @@ def tunnels_notify(client: paho.Client, userdata: dict, message: paho.MQTTMessag
             f.write(f'access-token = {payload["clientAccessToken"]}')
             f.write(f'destination-app = localhost:22')
 
-        shell(f'/usr/bin/supervisorctl'
-              f' -c /etc/{config.app_name}/supervisord.conf'
-              f' start ssh')
+        await supervisor.start('ssh')
 
 
-client = None
-
-try:
-
-    client = paho.Client(clean_session=True)
-    client.on_connect = on_connect
-    client.enable_logger(logger)
-    logger.addHandler(MqttLoggingHandler(client, f'$aws/rules/{config.topic_prefix}/things/{client_id}/log'))
+def setup(client: AsyncClient) -> None:
+    logger.addHandler(MqttLoggingHandler(client.paho, util.outbox.topic(f'$aws/rules/{config.topic_prefix}/things/{client_id}/log')))
+    client.connect_callback_add(on_connect)
     client.message_callback_add(f'$aws/things/{client_id}/tunnels/notify', tunnels_notify)
-    client.connect_async('localhost')
-    client.loop_start()
 
-    signal.sigwait([signal.SIGINT])
 
-except:
+if __name__ == '__main__':
+
+    try:
 
-    logger.critical('Fatal shutdown...', exc_info=True)
+        util.aiomqtt.run(setup, client_id=f'{client_id}-tunnels', clean_session=not config.mqtt_persistent_sessions)
 
-finally:
+    except:
 
-    if client:
-        client.loop_stop()
-        client.disconnect()
+        logger.critical('Fatal shutdown...', exc_info=True)
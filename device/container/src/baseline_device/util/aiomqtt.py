@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import random
+import signal
+import socket
+import typing
+
+import paho.mqtt.client as paho
+
+import baseline_device.util.qos
+from baseline_device import util
+from baseline_device.util.qos import QosProfile
+
+logger = logging.getLogger(__file__)
+
+MessageHandler = typing.Callable[['AsyncClient', paho.MQTTMessage], typing.Optional[typing.Awaitable[None]]]
+ConnectHandler = typing.Callable[['AsyncClient', dict, int], typing.Optional[typing.Awaitable[None]]]
+
+
+# Runs a paho client on an asyncio event loop instead of paho's loop_start() thread. The socket is watched
+# by the event loop, keepalives and reconnects are asyncio tasks, and message handlers are coroutines. The
+# publish(), subscribe() and unsubscribe() calls return futures, so they can be awaited for the broker's
+# acknowledgement or simply fired and forgotten like their paho equivalents. When no QoS is given, it comes
+# from the QoS profile for the topic's class (see util/qos.py).
+class AsyncClient(object):
+
+    def __init__(self, client_id: str = '', clean_session: bool = True, loop: typing.Optional[asyncio.AbstractEventLoop] = None, qos_profile: typing.Optional[QosProfile] = None) -> None:
+        self.loop = loop or asyncio.get_event_loop()
+        self.qos_profile = qos_profile or util.qos.profile()
+
+        self.paho = paho.Client(client_id, clean_session=clean_session)
+        self.paho.enable_logger(logger)
+        self.paho.on_socket_open = self._on_socket_open
+        self.paho.on_socket_close = self._on_socket_close
+        self.paho.on_socket_register_write = self._on_socket_register_write
+        self.paho.on_socket_unregister_write = self._on_socket_unregister_write
+        self.paho.on_connect = self._on_connect
+        self.paho.on_disconnect = self._on_disconnect
+        self.paho.on_subscribe = self._on_subscribe
+        self.paho.on_unsubscribe = self._on_unsubscribe
+        self.paho.on_publish = self._on_publish
+
+        self.connect_handlers: typing.List[ConnectHandler] = []
+        self.acks: typing.Dict[int, asyncio.Future] = {}
+
+        self.connack: typing.Optional[asyncio.Future] = None
+        self.misc_task: typing.Optional[asyncio.Task] = None
+        self.reconnect_task: typing.Optional[asyncio.Task] = None
+        self.reconnect_min_delay = 1
+        self.reconnect_max_delay = 30
+        self.closing = False
+
+    def is_connected(self) -> bool:
+        return self.paho.is_connected()
+
+    async def connect(self, host: str = 'localhost', port: int = 1883, keepalive: int = 60) -> None:
+        self.closing = False
+        self.connack = self.loop.create_future()
+        self.paho.connect_async(host, port, keepalive)
+
+        await self._reconnect(delay=0)
+
+        rc = await self.connack
+        if rc != paho.CONNACK_ACCEPTED:
+            raise ConnectionError(paho.connack_string(rc))
+
+        if not self.misc_task:
+            self.misc_task = self.loop.create_task(self._misc())
+
+    async def disconnect(self) -> None:
+        self.closing = True
+
+        for task in [self.reconnect_task, self.misc_task]:
+            if task: task.cancel()
+
+        self.reconnect_task = None
+        self.misc_task = None
+
+        if self.paho.is_connected():
+            self.paho.disconnect()
+
+    def connect_callback_add(self, handler: ConnectHandler) -> None:
+        self.connect_handlers.append(handler)
+
+    def message_callback_add(self, sub: str, handler: MessageHandler) -> None:
+        def callback(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
+            self.spawn(handler, self, message)
+
+        self.paho.message_callback_add(sub, callback)
+
+    def message_callback_remove(self, sub: str) -> None:
+        self.paho.message_callback_remove(sub)
+
+    def publish(self, topic: str, payload: typing.Optional[typing.Union[str, bytes]] = None, qos: typing.Optional[int] = None, retain: bool = False) -> asyncio.Future:
+        future = self.loop.create_future()
+
+        if qos is None: qos = self.qos_profile.publish(topic)
+
+        message_info: paho.MQTTMessageInfo = self.paho.publish(topic, payload=payload, qos=qos, retain=retain)
+
+        if message_info.rc == paho.MQTT_ERR_NO_CONN:
+            # paho queues qos > 0 messages while disconnected and sends them after the reconnect
+            if qos == 0: future.set_exception(ConnectionError(f'Unable to publish to {topic} while disconnected'))
+            else: self.acks[message_info.mid] = future
+        elif message_info.rc != paho.MQTT_ERR_SUCCESS:
+            future.set_exception(ValueError(f'Publish received error result {message_info.rc}'))
+        elif message_info.is_published():  # qos 0 can complete inline
+            future.set_result(message_info.mid)
+        else:
+            self.acks[message_info.mid] = future
+
+        future.add_done_callback(consume_future_exception)
+        return future
+
+    def subscribe(self, topic: typing.Union[str, typing.List[typing.Union[str, typing.Tuple[str, int]]]], qos: typing.Optional[int] = None) -> asyncio.Future:
+        future = self.loop.create_future()
+
+        if isinstance(topic, list):
+            topic = [(t, self.qos_profile.subscribe(t)) if isinstance(t, str) else t for t in topic]
+        elif qos is None:
+            qos = self.qos_profile.subscribe(topic)
+
+        res, mid = self.paho.subscribe(topic, qos=qos or 0)
+
+        if res != paho.MQTT_ERR_SUCCESS:
+            future.set_exception(ValueError(f'Subscribe received error result {res}'))
+        else:
+            self.acks[mid] = future
+
+        future.add_done_callback(consume_future_exception)
+        return future
+
+    def unsubscribe(self, topic: typing.Union[str, typing.List[str]]) -> asyncio.Future:
+        future = self.loop.create_future()
+
+        res, mid = self.paho.unsubscribe(topic)
+
+        if res != paho.MQTT_ERR_SUCCESS:
+            future.set_exception(ValueError(f'Unsubscribe received error result {res}'))
+        else:
+            self.acks[mid] = future
+
+        future.add_done_callback(consume_future_exception)
+        return future
+
+    def call_later(self, delay: float, callback: typing.Callable, *args) -> asyncio.TimerHandle:
+        return self.loop.call_later(delay, self.spawn, callback, *args)
+
+    def spawn(self, callback: typing.Callable, *args) -> None:
+        try:
+            result = callback(*args)
+        except:
+            logger.error(f'Unexpected exception caught in {callback}', exc_info=True)
+            return
+
+        if asyncio.iscoroutine(result):
+            self.loop.create_task(log_exceptions(result, callback))
+
+    async def _misc(self) -> None:
+        while True:
+            await asyncio.sleep(1)
+            self.paho.loop_misc()
+
+    async def _reconnect(self, delay: float) -> None:
+        while not self.closing:
+
+            # jittered, so clients that lost the broker together do not all come back at the same moment
+            if delay: await asyncio.sleep(random.uniform(delay / 2, delay))
+
+            try:
+                self.paho.reconnect()
+                return
+            except (socket.error, OSError) as e:
+                logger.warning(f'Unable to connect to {self.paho._host}:{self.paho._port}, {e}')
+
+            delay = min(max(delay * 2, self.reconnect_min_delay), self.reconnect_max_delay)
+
+    def _schedule_reconnect(self) -> None:
+        if self.closing: return
+        if self.reconnect_task and not self.reconnect_task.done(): return
+        self.reconnect_task = self.loop.create_task(self._reconnect(delay=self.reconnect_min_delay))
+
+    def _on_socket_open(self, client: paho.Client, userdata: dict, sock: socket.socket) -> None:
+        self.loop.add_reader(sock, self.paho.loop_read)
+
+    def _on_socket_close(self, client: paho.Client, userdata: dict, sock: socket.socket) -> None:
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+
+    def _on_socket_register_write(self, client: paho.Client, userdata: dict, sock: socket.socket) -> None:
+        # publishing is allowed from other threads (e.g. logging handlers), so hop onto the loop
+        self.loop.call_soon_threadsafe(self._add_writer, sock)
+
+    def _on_socket_unregister_write(self, client: paho.Client, userdata: dict, sock: socket.socket) -> None:
+        self.loop.call_soon_threadsafe(self._remove_writer, sock)
+
+    def _add_writer(self, sock: socket.socket) -> None:
+        if sock.fileno() == -1: return
+        if self.paho.socket() is not sock: return
+        self.loop.add_writer(sock, self.paho.loop_write)
+
+    def _remove_writer(self, sock: socket.socket) -> None:
+        if sock.fileno() == -1: return
+        self.loop.remove_writer(sock)
+
+    def _on_connect(self, client: paho.Client, userdata: dict, flags: dict, rc: int) -> None:
+        if self.connack and not self.connack.done():
+            self.connack.set_result(rc)
+
+        if rc != paho.CONNACK_ACCEPTED: return
+
+        for handler in self.connect_handlers:
+            self.spawn(handler, self, flags, rc)
+
+    def _on_disconnect(self, client: paho.Client, userdata: dict, rc: int) -> None:
+        self.loop.call_soon_threadsafe(self._disconnected, rc)
+
+    def _disconnected(self, rc: int) -> None:
+        # qos > 0 publishes stay queued inside paho and complete after reconnecting
+        for mid, future in list(self.acks.items()):
+            if future.done() or mid in self.paho._out_messages: continue
+            future.set_exception(ConnectionError(f'Disconnected with result {rc}'))
+            self.acks.pop(mid, None)
+
+        if rc != paho.MQTT_ERR_SUCCESS:
+            logger.warning(f'Disconnected unexpectedly with result {rc}')
+            self._schedule_reconnect()
+
+    def _on_subscribe(self, client: paho.Client, userdata: dict, mid: int, granted_qos: typing.Tuple[int], properties: dict = None) -> None:
+        future = self.acks.pop(mid, None)
+        if not future or future.done(): return
+        if any(qos == 0x80 for qos in granted_qos):  # SUBACK failure return code
+            future.set_exception(ValueError(f'Subscribe rejected by broker {granted_qos}'))
+        else:
+            future.set_result(granted_qos)
+
+    def _on_unsubscribe(self, client: paho.Client, userdata: dict, mid: int) -> None:
+        future = self.acks.pop(mid, None)
+        if future and not future.done(): future.set_result(mid)
+
+    def _on_publish(self, client: paho.Client, userdata: dict, mid: int) -> None:
+        future = self.acks.pop(mid, None)
+        if future and not future.done(): future.set_result(mid)
+
+
+def session_present(flags: dict) -> bool:
+    # with clean_session=False the broker kept our subscriptions (and queued messages), so there is no need to subscribe again
+    return bool(flags.get('session present'))
+
+
+def jitter(delay: float) -> float:
+    return random.uniform(0, delay) if delay else 0
+
+
+def consume_future_exception(future: asyncio.Future) -> None:
+    # fire-and-forget callers never retrieve the result, which would otherwise log "exception was never retrieved"
+    if not future.cancelled(): future.exception()
+
+
+async def log_exceptions(coro: typing.Awaitable, callback: typing.Callable) -> None:
+    try:
+        await coro
+    except asyncio.CancelledError:
+        raise
+    except:
+        logger.error(f'Unexpected exception caught in {callback}', exc_info=True)
+
+
+def run(setup: typing.Callable[[AsyncClient], typing.Optional[typing.Awaitable[None]]], teardown: typing.Optional[typing.Callable[[AsyncClient], None]] = None, host: str = 'localhost', port: int = 1883, client_id: str = '', clean_session: bool = True) -> None:
+    async def main() -> None:
+        loop = asyncio.get_event_loop()
+
+        terminate = asyncio.Event()
+        loop.add_signal_handler(signal.SIGINT, terminate.set)
+        loop.add_signal_handler(signal.SIGTERM, terminate.set)
+
+        client = AsyncClient(client_id, clean_session=clean_session, loop=loop)
+
+        try:
+
+            result = setup(client)
+            if asyncio.iscoroutine(result): await result
+
+            await client.connect(host, port)
+            await terminate.wait()
+
+        finally:
+
+            if teardown: teardown(client)
+
+            await client.disconnect()
+
+    asyncio.run(main())
@@ -28,12 +28,48 @@ def diff(a: dict, b: dict) -> typing.Tuple[dict, dict, dict]:
     return added, removed, changed
 
 
+def deep_diff(a: dict, b: dict) -> dict:
+    # the minimal patch that turns a into b, nested dicts are compared key by key and anything else (lists
+    # included) by value; keys missing from b are set to None, which is how shadow updates delete attributes
+    patch = {}
+
+    for k, v in b.items():
+        if k not in a:
+            patch[k] = v
+            continue
+
+        old = a[k]
+        if old is v: continue
+
+        if isinstance(v, dict) and isinstance(old, dict):
+            nested = deep_diff(old, v)
+            if nested: patch[k] = nested
+        elif old != v or type(old) is not type(v):
+            patch[k] = v
+
+    for k in a:
+        if k not in b: patch[k] = None
+
+    return patch
+
+
+def deep_patch(d: dict, patch: dict) -> dict:
+    # applies a patch from deep_diff in place, the same way shadows merge an update
+    for k, v in patch.items():
+        if v is None:
+            d.pop(k, None)
+        elif isinstance(v, dict) and isinstance(d.get(k), dict):
+            deep_patch(d[k], v)
+        else:
+            d[k] = deep_copy(v) if isinstance(v, (dict, list)) else v
+    return d
+
+
 def dpath_read(d: dict, path: str, sep: typing.Optional[str] = '.') -> typing.Any:
     current = d
     for part in path.split(sep):
         if not isinstance(current, dict): return None
         if part not in current: return None
-        if not current[part]: return None
         current = current[part]
     return current
 
@@ -42,7 +78,7 @@ def dpath_write(d: dict, path: str, value: typing.Any, sep: typing.Optional[str]
     current = d
     parts = path.split(sep)
     for part in parts[:-1]:
-        current[part] = current.get(part, {})
+        if not isinstance(current.get(part), dict): current[part] = {}
         current = current[part]
     current[parts[-1]] = value
 
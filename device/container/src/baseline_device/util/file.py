@@ -1,5 +1,7 @@
+import os
 import shutil
 import tempfile
+import typing
 from contextlib import contextmanager
 
 
@@ -10,3 +12,16 @@ def mkdtemp() -> str:
         yield dir
     finally:
         shutil.rmtree(dir)
+
+
+def write_atomic(path: str, data: typing.Union[str, bytes]) -> None:
+    # readers see either the old file or the new one, never a partially written one
+    directory, name = os.path.split(path)
+    fd, temp = tempfile.mkstemp(dir=directory or '.', prefix=f'.{name}.')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        os.replace(temp, path)
+    except:
+        os.remove(temp)
+        raise
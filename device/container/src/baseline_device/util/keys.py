@@ -0,0 +1,102 @@
+import logging
+import os
+import typing
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+import OpenSSL.crypto as openssl
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+import baseline_device.util.file
+from baseline_device import util
+from baseline_device.util.config import config
+
+logger = logging.getLogger(__file__)
+
+# Device keys are RSA-2048 or EC P-256, chosen by provision_key_type in config.json. Generating an RSA key
+# takes seconds on the smaller ARM boards and an EC key a few milliseconds. Either way a spare key for the
+# next provisioning is generated in the background (see service/keygen.py) so it is ready when needed.
+KEY_TYPES = ['rsa', 'ec']
+
+RSA_BITS = 2048
+
+
+def configured() -> str:
+    key_type = config.provision_key_type or 'rsa'
+    if key_type not in KEY_TYPES:
+        raise ValueError(f'Unknown provision key type {key_type}')
+    return key_type
+
+
+def generate(key_type: typing.Optional[str] = None) -> openssl.PKey:
+    key_type = key_type or configured()
+    if key_type == 'ec':
+        # pyOpenSSL only generates RSA and DSA keys, and before 20.0 only wraps those from cryptography
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        key_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        return openssl.load_privatekey(openssl.FILETYPE_PEM, key_pem)
+    key = openssl.PKey()
+    key.generate_key(openssl.TYPE_RSA, RSA_BITS)
+    return key
+
+
+def create_csr(key: openssl.PKey, common_name: str) -> str:
+    csr = openssl.X509Req()
+    subject = csr.get_subject()
+    subject.C = 'US'
+    subject.CN = common_name
+    csr.set_pubkey(key)
+    csr.sign(key, 'sha256')
+    csr.verify(key)
+    csr_pem = openssl.dump_certificate_request(openssl.FILETYPE_PEM, csr)
+    return csr_pem.decode('utf-8')
+
+
+def dump(key: openssl.PKey) -> str:
+    return openssl.dump_privatekey(openssl.FILETYPE_PEM, key).decode('utf-8')
+
+
+def spare_path(key_type: str) -> str:
+    # outside /mnt/{app_name}/aws, which is removed to provision again
+    spare_dir = config.provision_key_dir or f'/mnt/{config.app_name}/keys'
+    return f'{spare_dir}/next.{key_type}.key'
+
+
+def take_spare(key_type: typing.Optional[str] = None) -> typing.Optional[openssl.PKey]:
+    # the spare is removed as it is taken, so a key is never used for two certificates
+    path = spare_path(key_type or configured())
+    try:
+        with open(path, 'r') as f:
+            key = openssl.load_privatekey(openssl.FILETYPE_PEM, f.read())
+    except FileNotFoundError:
+        return None
+    except:
+        logger.warning(f'Unable to load the spare key {path}', exc_info=True)
+        key = None
+    os.remove(path)
+    return key
+
+
+def ensure_spare(key_type: typing.Optional[str] = None) -> bool:
+    # True when a spare key had to be generated
+    path = spare_path(key_type or configured())
+    if os.path.exists(path): return False
+    key = generate(key_type)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    util.file.write_atomic(path, dump(key))  # created 0600
+    return True
+
+
+def take_or_generate(key_type: typing.Optional[str] = None) -> openssl.PKey:
+    return take_spare(key_type) or generate(key_type)
+
+
+def take_or_generate_async(key_type: typing.Optional[str] = None) -> 'Future[openssl.PKey]':
+    # OpenSSL releases the GIL while generating, so the key is made while the caller connects
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        return executor.submit(take_or_generate, key_type)
+    finally:
+        executor.shutdown(wait=False)
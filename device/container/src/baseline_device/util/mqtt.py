@@ -1,15 +1,21 @@
+import collections
 import io
 import json
 import logging.handlers
 import os
 import threading
-import time
 import traceback
 import typing
 import uuid
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import paho.mqtt.client as paho
 
+import baseline_device.util.codec
+import baseline_device.util.qos
+from baseline_device import util
+
 
 def connect_and_wait(client: paho.Client, *connect_args, timeout=15, **connect_kwargs) -> typing.Optional[int]:
     complete = threading.Event()
@@ -24,15 +30,17 @@ def connect_and_wait(client: paho.Client, *connect_args, timeout=15, **connect_k
 
     client.on_connect = on_connect
 
-    client.connect_async(*connect_args, **connect_kwargs)
+    try:
+
+        client.connect_async(*connect_args, **connect_kwargs)
+        client.loop_start()  # no-op if already running, but starting after connect_async avoids the reconnect delay
 
-    start = int(round(time.time()))
-    while not complete.is_set():
-        if int(round(time.time())) - start >= timeout:
+        if not complete.wait(timeout):
             raise TimeoutError
-        time.sleep(1)
 
-    client.on_connect = _on_connect
+    finally:
+
+        client.on_connect = _on_connect
 
     if result and isinstance(result, tuple):
         client, userdata, flags, rc = result
@@ -57,18 +65,19 @@ def subscribe_and_wait(client: paho.Client, *subscribe_args, timeout=15, **subsc
 
     client.on_subscribe = on_subscribe
 
-    res, mid = client.subscribe(*subscribe_args, **subscribe_kwargs)
+    try:
+
+        res, mid = client.subscribe(*subscribe_args, **subscribe_kwargs)
 
-    if res != paho.MQTT_ERR_SUCCESS:
-        raise ValueError(f'Subscribe received error result {res}')
+        if res != paho.MQTT_ERR_SUCCESS:
+            raise ValueError(f'Subscribe received error result {res}')
 
-    start = int(round(time.time()))
-    while not complete.is_set():
-        if int(round(time.time())) - start >= timeout:
+        if not complete.wait(timeout):
             raise TimeoutError
-        time.sleep(1)
 
-    client.on_subscribe = _on_subscribe
+    finally:
+
+        client.on_subscribe = _on_subscribe
 
     if result and isinstance(result, tuple):
         client, userdata, _mid, granted_qos, properties = result
@@ -93,18 +102,19 @@ def unsubscribe_and_wait(client: paho.Client, *unsubscribe_args, timeout=15, **u
 
     client.on_unsubscribe = on_unsubscribe
 
-    res, mid = client.unsubscribe(*unsubscribe_args, **unsubscribe_kwargs)
+    try:
+
+        res, mid = client.unsubscribe(*unsubscribe_args, **unsubscribe_kwargs)
 
-    if res != paho.MQTT_ERR_SUCCESS:
-        raise ValueError(f'Unsubscribe received error result {res}')
+        if res != paho.MQTT_ERR_SUCCESS:
+            raise ValueError(f'Unsubscribe received error result {res}')
 
-    start = int(round(time.time()))
-    while not complete.is_set():
-        if int(round(time.time())) - start >= timeout:
+        if not complete.wait(timeout):
             raise TimeoutError
-        time.sleep(1)
 
-    client.on_unsubscribe = _on_unsubscribe
+    finally:
+
+        client.on_unsubscribe = _on_unsubscribe
 
     if result and isinstance(result, tuple):
         client, userdata, _mid = result
@@ -114,100 +124,308 @@ def unsubscribe_and_wait(client: paho.Client, *unsubscribe_args, timeout=15, **u
     return None
 
 
-def send_and_receive(client: paho.Client, topic: str, *publish_args, filter_by_client_token: bool = True, timeout: int = 15, **publish_kwargs) -> typing.Optional[paho.MQTTMessage]:
-    complete = threading.Event()
-    result = None
+def response_topic(topic: str) -> str:
+    if topic.startswith('$aws/rules/'):
+        # we can't receive responses from the rules topic, so assume the prefix is chopped off
+        return topic[len('$aws/rules/'):]
+    return topic
+
+
+# Matches request/response exchanges on a single paho client. The /accepted and /rejected subscriptions
+# are opened once per response topic and kept open, and every request is keyed by its clientToken, so any
+# number of requests may be in flight and each caller is woken as soon as its own response arrives.
+class MqttCorrelator(object):
+
+    def __init__(self, client: paho.Client, timeout: int = 15) -> None:
+        self.client = client
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self.subscriptions: typing.Dict[str, Future] = {}  # response topic -> SUBACK
+        self.acks: typing.Dict[int, Future] = {}  # subscribe mid -> SUBACK
+        self.pending: typing.Dict[str, Future] = {}  # clientToken (or response topic) -> response
+
+        self._on_subscribe = client.on_subscribe
+        self._on_disconnect = client.on_disconnect
+        client.on_subscribe = self.on_subscribe
+        client.on_disconnect = self.on_disconnect
+
+    def installed(self) -> bool:
+        # paho's reinitialise() resets every callback, which leaves this correlator detached
+        return self.client.on_subscribe == self.on_subscribe
+
+    def request(self, topic: str, payload: typing.Optional[dict] = None, qos: int = 0, filter_by_client_token: bool = True, timeout: typing.Optional[float] = None) -> Future:
+        resp_topic = response_topic(topic)
 
-    if filter_by_client_token:
-        payload = json.loads(publish_kwargs.get('payload') or '{}')
-        client_token = payload.get('clientToken')
-        if not client_token:  # inject the clientToken so we can filter responses
-            payload['clientToken'] = client_token = str(uuid.uuid4())
-            publish_kwargs['payload'] = json.dumps(payload)
+        self.subscribe(resp_topic, qos, timeout)
 
-    def callback(client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
+        payload = dict(payload or {})
 
         if filter_by_client_token:
+            key = payload.setdefault('clientToken', str(uuid.uuid4()))
+        else:
+            key = resp_topic
+
+        future = Future()
+
+        with self.lock:
+            if key in self.pending:
+                raise ValueError(f'Request already in flight for {key}')
+            self.pending[key] = future
+
+        message_info: paho.MQTTMessageInfo = self.client.publish(topic, payload=json.dumps(payload), qos=qos)
+
+        if message_info.rc != paho.MQTT_ERR_SUCCESS:
+            self.discard(future)
+            raise ValueError(f'Publish received error result {message_info.rc}')
+
+        return future
+
+    def discard(self, future: Future) -> None:
+        with self.lock:
+            for key in [k for k, v in self.pending.items() if v is future]:
+                self.pending.pop(key, None)
+        future.cancel()
+
+    def subscribe(self, resp_topic: str, qos: int = 0, timeout: typing.Optional[float] = None) -> None:
+        # registered outside of the lock, paho holds its callback mutex while calling back into us
+        self.client.message_callback_add(f'{resp_topic}/accepted', self.on_response)
+        self.client.message_callback_add(f'{resp_topic}/rejected', self.on_response)
+
+        with self.lock:
+            future = self.subscriptions.get(resp_topic)
+            if not future:
+                res, mid = self.client.subscribe([
+                    (f'{resp_topic}/accepted', qos),
+                    (f'{resp_topic}/rejected', qos)
+                ])
+
+                if res != paho.MQTT_ERR_SUCCESS:
+                    raise ValueError(f'Subscribe received error result {res}')
+
+                future = self.subscriptions[resp_topic] = self.acks[mid] = Future()
+
+        try:
+            future.result(self.timeout if timeout is None else timeout)
+        except Exception as e:
+            # a failed subscription is forgotten, so the next request subscribes again rather than failing with it
+            with self.lock:
+                if self.subscriptions.get(resp_topic) is future:
+                    self.subscriptions.pop(resp_topic, None)
+            if isinstance(e, FutureTimeoutError): raise TimeoutError
+            raise
+
+    def close(self) -> None:
+        with self.lock:
+            topics = list(self.subscriptions.keys())
+            self.subscriptions.clear()
+            for future in self.pending.values(): future.cancel()
+            self.pending.clear()
+
+        for resp_topic in topics:
+            self.client.message_callback_remove(f'{resp_topic}/accepted')
+            self.client.message_callback_remove(f'{resp_topic}/rejected')
+            self.client.unsubscribe([f'{resp_topic}/accepted', f'{resp_topic}/rejected'])
+
+        if self.installed():
+            self.client.on_subscribe = self._on_subscribe
+            self.client.on_disconnect = self._on_disconnect
+
+    def on_response(self, client: paho.Client, userdata: dict, message: paho.MQTTMessage) -> None:
+        try:
             payload = json.loads(message.payload.decode('utf-8'))
-            if client_token != payload.get('clientToken'): return
+        except ValueError:
+            payload = None
 
-        nonlocal result
-        result = message
-        complete.set()
+        client_token = payload.get('clientToken') if isinstance(payload, dict) else None
+        resp_topic = message.topic.rsplit('/', maxsplit=1)[0]
 
-    if topic.startswith('$aws/rules/'):
-        # we can't receive responses from the rules topic, so assume the prefix is chopped off
-        resp_topic = topic[len('$aws/rules/'):]
-    else:
-        resp_topic = topic
+        with self.lock:
+            future = self.pending.pop(client_token, None) if client_token else None
+            if not future: future = self.pending.pop(resp_topic, None)
 
-    try:
+        if future and not future.done():
+            future.set_result(message)
 
-        client.message_callback_add(f'{resp_topic}/accepted', callback)
-        client.message_callback_add(f'{resp_topic}/rejected', callback)
+    def on_subscribe(self, client: paho.Client, userdata: dict, mid: int, granted_qos: int, properties: dict = None) -> None:
+        with self.lock:
+            future = self.acks.pop(mid, None)
 
-        subscribe_kwargs = {}
-        if 'qos' in publish_kwargs:
-            subscribe_kwargs['qos'] = publish_kwargs['qos']
+        if future and not future.done():
+            if any(qos == 0x80 for qos in granted_qos):  # SUBACK failure return code
+                future.set_exception(ValueError(f'Subscribe rejected by broker {granted_qos}'))
+            else:
+                future.set_result(granted_qos)
 
-        subscribe_and_wait(client, f'{resp_topic}/accepted', **subscribe_kwargs)
-        subscribe_and_wait(client, f'{resp_topic}/rejected', **subscribe_kwargs)
+        if self._on_subscribe: self._on_subscribe(client, userdata, mid, granted_qos, properties)
 
-        message_info: paho.MQTTMessageInfo = client.publish(topic, *publish_args, **publish_kwargs)
-        message_info.wait_for_publish()
+    def on_disconnect(self, client: paho.Client, userdata: dict, rc: int) -> None:
+        # a clean session loses the response subscriptions, they are restored on the next request, and the
+        # requests in flight fail now rather than waiting out their timeout for responses that won't come
+        with self.lock:
+            self.subscriptions.clear()
+            futures = list(self.acks.values()) + list(self.pending.values())
+            self.acks.clear()
+            self.pending.clear()
 
-        start = int(round(time.time()))
-        while not complete.is_set():
-            if int(round(time.time())) - start >= timeout:
-                raise TimeoutError
-            time.sleep(1)
+        for future in futures:
+            if not future.done(): future.set_exception(ConnectionError(f'Disconnected with result {rc}'))
 
-        return result
+        if self._on_disconnect: self._on_disconnect(client, userdata, rc)
 
-    finally:
 
-        client.message_callback_remove(f'{resp_topic}/accepted')
-        client.message_callback_remove(f'{resp_topic}/rejected')
+correlator_lock = threading.Lock()
 
-        try:
-            unsubscribe_and_wait(client, f'{resp_topic}/accepted')
-        except:
-            pass
 
-        try:
-            unsubscribe_and_wait(client, f'{resp_topic}/rejected')
-        except:
-            pass
+def correlator(client: paho.Client) -> MqttCorrelator:
+    # kept on the client, the correlator and the client refer to each other and are freed together
+    with correlator_lock:
+        instance: typing.Optional[MqttCorrelator] = getattr(client, '_correlator', None)
+        if not instance or not instance.installed():
+            instance = client._correlator = MqttCorrelator(client)
+        return instance
+
 
+def send_and_receive(client: paho.Client, topic: str, payload: typing.Optional[str] = None, qos: int = 0, filter_by_client_token: bool = True, timeout: int = 15) -> typing.Optional[paho.MQTTMessage]:
+    instance = correlator(client)
 
+    future = instance.request(
+        topic=topic,
+        payload=json.loads(payload or '{}'),
+        qos=qos,
+        filter_by_client_token=filter_by_client_token,
+        timeout=timeout
+    )
+
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError:
+        raise TimeoutError
+    finally:
+        instance.discard(future)
+
+
+# Buffers log records and publishes them in batches from a background thread, so logging never waits on
+# the network. A batch is flushed once it reaches batch_size records or roughly batch_bytes of JSON, or
+# after flush_interval seconds. When the queue fills past the high water mark only WARNING and above are
+# kept, and once it is full everything is dropped; the dropped count is reported with the next batch.
+#
+# {
+#     "process": "string",
+#     "records": [{"level": "string", "message": "string", "timestamp": int, "exception": "string"}, ...],
+#     "dropped": int
+# }
 class MqttLoggingHandler(logging.Handler):
 
-    def __init__(self, client: paho.Client, topic: str) -> None:
+    def __init__(self, client: paho.Client, topic: str, qos: typing.Optional[int] = None, capacity: int = 1000, batch_size: int = 100, batch_bytes: int = 64 * 1024, flush_interval: float = 1.0) -> None:
         super().__init__()
         self.client = client
         self.topic = topic
+        self.qos = util.qos.qos(topic) if qos is None else qos
+        self.capacity = capacity
+        self.high_water = int(capacity * 0.8)
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+
+        self.process = os.environ.get('SUPERVISOR_PROCESS_NAME')
+        self.records: typing.Deque[dict] = collections.deque()
+        self.dropped = 0
+        self.published = 0
+        self.closed = False
+
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='MqttLoggingHandler', daemon=True)
+        self.thread.start()
 
     def emit(self, record: logging.LogRecord) -> None:
 
         try:
 
-            kwargs = {}
+            entry = {
+                'level': record.levelname,
+                'message': record.getMessage(),
+                'timestamp': round(record.created * 1000)
+            }
 
             if record.exc_info:
-                kwargs['exception'] = self.format_exception(record.exc_info)
+                entry['exception'] = self.format_exception(record.exc_info)
 
-            self.client.publish(self.topic, qos=2, payload=json.dumps({
-                'process': os.environ.get('SUPERVISOR_PROCESS_NAME'),
-                'level': record.levelname,
-                'message': record.getMessage(),
-                'timestamp': round(record.created * 1000),
-                **kwargs
-            }))
+            with self.condition:
+
+                if self.closed or len(self.records) >= self.capacity or \
+                        (len(self.records) >= self.high_water and record.levelno < logging.WARNING):
+                    self.dropped += 1
+                    return
+
+                self.records.append(entry)
+
+                if len(self.records) >= self.batch_size:
+                    self.condition.notify()
 
         except:
 
             self.handleError(record)
 
+    def flush(self) -> None:
+        with self.condition:
+            batches = self.take_batches(everything=True)
+        for batch in batches:
+            self.publish(batch)
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join(timeout=self.flush_interval * 2)
+        self.flush()
+        super().close()
+
+    def run(self) -> None:
+        while True:
+
+            with self.condition:
+                if not self.closed and len(self.records) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+                if self.closed: return
+                batches = self.take_batches(everything=False)
+
+            for batch in batches:
+                self.publish(batch)
+
+    def take_batches(self, everything: bool) -> typing.List[dict]:
+        # called with the condition held; a partial batch is taken when the interval has elapsed or on flush
+        batches = []
+
+        while self.records or self.dropped:
+            records, size = [], 0
+
+            while self.records and len(records) < self.batch_size:
+                record = self.records[0]
+                # roughly its size as JSON, before the codec, the encoding is left until the lock is released
+                record_size = len(record['message']) + len(record.get('exception', '')) + 64
+                if records and size + record_size > self.batch_bytes: break
+                records.append(record)
+                size += record_size
+                self.records.popleft()
+
+            batch = {'process': self.process, 'records': records}
+            if self.dropped:
+                batch['dropped'] = self.dropped
+                self.dropped = 0
+            batches.append(batch)
+
+            if not everything and len(self.records) < self.batch_size: break
+
+        return batches
+
+    def publish(self, batch: dict) -> None:
+        try:
+            self.client.publish(self.topic, qos=self.qos, payload=util.codec.encode(batch))
+            self.published += 1
+        except:
+            # reporting through handleError would need a record, and logging here would loop back into us
+            traceback.print_exc()
+
     def format_exception(self, exc_info) -> str:
         sio = io.StringIO()
         traceback.print_exception(*exc_info, file=sio)
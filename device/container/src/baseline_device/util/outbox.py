@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import os
+import struct
+import typing
+
+from baseline_device.util.aiomqtt import AsyncClient
+from baseline_device.util.config import config
+
+logger = logging.getLogger(__file__)
+
+# Device to cloud messages for $aws/rules/... are published locally to outbox/... instead, and the main
+# service forwards them over the bridge. While the bridge is down they are appended to segment files on
+# disk rather than queued in mosquitto's memory, then replayed at a controlled rate once it reconnects.
+LOCAL_PREFIX = 'outbox/'
+REMOTE_PREFIX = '$aws/rules/'
+
+# qos, topic length, payload length
+HEADER = struct.Struct('>BHI')
+
+
+def topic(remote_topic: str) -> str:
+    if not remote_topic.startswith(REMOTE_PREFIX):
+        raise ValueError(f'Only {REMOTE_PREFIX} topics go through the outbox: {remote_topic}')
+    return LOCAL_PREFIX + remote_topic[len(REMOTE_PREFIX):]
+
+
+def remote_topic(local_topic: str) -> str:
+    remote_topic = REMOTE_PREFIX + local_topic[len(LOCAL_PREFIX):]
+    if config.ingest_batch: remote_topic = batch_topic(remote_topic)
+    return remote_topic
+
+
+# With ingest_batch set, logs and telemetry are sent to the <topic_prefix>_batch topic rule, which queues them
+# for the ingest lambda to take in batches rather than be invoked for every message. Nothing waits on the
+# responses to these, which the batch rule doesn't send.
+BATCH_TOPICS = ['log', 'metrics']
+
+
+def batch_topic(remote_topic: str) -> str:
+    # $aws/rules/<topic_prefix>/things/<thing>/log -> $aws/rules/<topic_prefix>_batch/things/<thing>/log
+    rule_prefix = f'{REMOTE_PREFIX}{config.topic_prefix}/'
+    if remote_topic.startswith(f'{rule_prefix}things/') and remote_topic.rsplit('/', maxsplit=1)[1] in BATCH_TOPICS:
+        return f'{REMOTE_PREFIX}{config.topic_prefix}_batch/{remote_topic[len(rule_prefix):]}'
+    return remote_topic
+
+
+class Outbox(object):
+
+    def __init__(self, path: typing.Optional[str] = None, max_bytes: typing.Optional[int] = None, segment_bytes: typing.Optional[int] = None) -> None:
+        self.path = path or f'/mnt/{config.app_name}/outbox'
+        self.max_bytes = max_bytes or config.outbox_max_bytes or 16 * 1024 * 1024
+        self.segment_bytes = min(segment_bytes or config.outbox_segment_bytes or 1024 * 1024, self.max_bytes)
+
+        os.makedirs(self.path, exist_ok=True)
+
+        self.segments: typing.List[int] = sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.seg'))
+        self.sizes: typing.Dict[int, int] = {segment: os.path.getsize(self.segment_path(segment)) for segment in self.segments}
+        self.writer: typing.Optional[typing.BinaryIO] = None
+        self.dropped = 0
+
+        if self.segments:
+            # a crash can leave a partially written record at the end, which would corrupt the next append
+            segment = self.segments[-1]
+            end = 0
+            for _, _, _, end in self.read(segment, 0): pass
+            self.writer = open(self.segment_path(segment), 'ab')
+            self.writer.truncate(end)
+            self.sizes[segment] = end
+
+        # the replay position, persisted so a restart does not resend everything
+        self.cursor = (self.segments[0] if self.segments else 0, 0)
+        try:
+            with open(f'{self.path}/cursor', 'r') as f:
+                segment, offset = map(int, f.read().split())
+            if segment in self.sizes: self.cursor = (segment, offset)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def __len__(self) -> int:
+        # pending bytes, zero means nothing is waiting to be replayed
+        segment, offset = self.cursor
+        return sum(size for s, size in self.sizes.items() if s >= segment) - (offset if segment in self.sizes else 0)
+
+    def segment_path(self, segment: int) -> str:
+        return f'{self.path}/{segment:012d}.seg'
+
+    def append(self, topic: str, payload: bytes, qos: int = 1) -> None:
+        topic_bytes = topic.encode()
+        record = HEADER.pack(qos, len(topic_bytes), len(payload)) + topic_bytes + payload
+
+        if not self.segments or self.sizes[self.segments[-1]] + len(record) > self.segment_bytes:
+            self.rotate()
+
+        while sum(self.sizes.values()) + len(record) > self.max_bytes and len(self.segments) > 1:
+            self.drop_oldest()
+
+        segment = self.segments[-1]
+        self.writer.write(record)
+        self.writer.flush()
+        self.sizes[segment] += len(record)
+
+    def rotate(self) -> None:
+        if self.writer: self.writer.close()
+        segment = self.segments[-1] + 1 if self.segments else 0
+        self.segments.append(segment)
+        self.sizes[segment] = 0
+        self.writer = open(self.segment_path(segment), 'ab')
+        if len(self.segments) == 1: self.save_cursor((segment, 0))
+
+    def drop_oldest(self) -> None:
+        segment = self.segments.pop(0)
+        self.dropped += self.count(segment)
+        self.remove(segment)
+        logger.warning(f'Outbox exceeded {self.max_bytes} bytes, dropped {self.dropped} messages so far')
+        if self.cursor[0] <= segment: self.save_cursor((self.segments[0], 0))
+
+    def remove(self, segment: int) -> None:
+        self.sizes.pop(segment, None)
+        try:
+            os.remove(self.segment_path(segment))
+        except FileNotFoundError:
+            pass
+
+    def count(self, segment: int) -> int:
+        return sum(1 for _ in self.read(segment, 0))
+
+    def read(self, segment: int, offset: int) -> typing.Iterator[typing.Tuple[int, str, bytes, int]]:
+        # yields (qos, topic, payload, next offset), stopping at a partially written record
+        with open(self.segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size: return
+                qos, topic_length, payload_length = HEADER.unpack(header)
+                body = f.read(topic_length + payload_length)
+                if len(body) < topic_length + payload_length: return
+                offset += HEADER.size + len(body)
+                yield qos, body[:topic_length].decode(), body[topic_length:], offset
+
+    def save_cursor(self, cursor: typing.Tuple[int, int]) -> None:
+        self.cursor = cursor
+        with open(f'{self.path}/cursor.tmp', 'w') as f:
+            f.write(f'{cursor[0]} {cursor[1]}')
+        os.replace(f'{self.path}/cursor.tmp', f'{self.path}/cursor')
+
+    async def replay(self, client: AsyncClient, online: typing.Callable[[], bool], rate: typing.Optional[float] = None) -> None:
+        # publishes the backlog oldest first, waiting for each acknowledgement, at no more than rate messages a second
+        interval = 1 / (rate or config.outbox_replay_rate or 20)
+        replayed = 0
+
+        while online() and len(self):
+            segment, offset = self.cursor
+
+            for qos, topic, payload, offset in self.read(segment, offset):
+                if not online(): break
+                await client.publish(topic, payload, qos=qos)
+                replayed += 1
+                # the segment may have been dropped for space while waiting on the acknowledgement
+                if self.cursor[0] != segment: break
+                self.cursor = (segment, offset)
+                if replayed % 100 == 0: self.save_cursor(self.cursor)
+                await asyncio.sleep(interval)
+
+            else:
+                if self.cursor[0] != segment:
+                    continue
+                if segment != self.segments[-1]:
+                    self.segments.remove(segment)
+                    self.remove(segment)
+                    self.save_cursor((self.segments[0], 0))
+                elif self.cursor[1] == self.sizes[segment]:
+                    # fully replayed, start over with an empty segment
+                    self.writer.close()
+                    self.writer = None
+                    self.segments.remove(segment)
+                    self.remove(segment)
+                    self.rotate()
+
+            if self.cursor[0] in self.sizes: self.save_cursor(self.cursor)
+
+        if replayed: logger.info(f'Outbox replayed {replayed} messages, {len(self)} bytes remaining')
+
+    def close(self) -> None:
+        if self.writer: self.writer.close()
+        self.writer = None
+        if self.cursor[0] in self.sizes: self.save_cursor(self.cursor)
@@ -1,12 +1,15 @@
 import functools
 import importlib
+import importlib.util
+import logging
+import sys
 import threading
 import traceback
 import typing
 from inspect import isclass
 from logging import ERROR
 
-from baseline_cloud.core.logging import logger
+logger = logging.getLogger(__file__)
 
 
 def classname(obj: typing.Any) -> str:
@@ -23,6 +26,19 @@ def load_module(modname: str) -> typing.Any:
         return None
 
 
+def load_source(modname: str, path: str) -> typing.Any:
+    if modname in sys.modules: return sys.modules[modname]
+    spec = importlib.util.spec_from_file_location(modname, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[modname] = module
+    try:
+        spec.loader.exec_module(module)
+    except:
+        sys.modules.pop(modname, None)
+        raise
+    return module
+
+
 def parameterized(decorator: callable) -> callable:
     def __func__(*args, **kwargs) -> callable:
         if len(args) > 0 and callable(args[0]):
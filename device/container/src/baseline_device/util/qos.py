@@ -0,0 +1,84 @@
+import typing
+
+import paho.mqtt.client as paho
+
+from baseline_device.util.config import config
+
+# The QoS used with the local broker is chosen by the class of topic rather than at each call, from the
+# profile named by qos_profile in config.json. The bridge forwards to AWS IoT Core at QoS 1 whatever is used
+# locally, so QoS 2 on localhost only adds the extra handshake and holds up the inflight window.
+#
+# "qos_profile": "default",
+# "qos_profiles": {
+#     "default": {"logs": 1, "telemetry": 0, "jobs": 1, "shadow": 1, "events": 1, "default": 1}
+# }
+
+# topic class to the topic filters it covers, checked in order; anything else is "default"
+TOPIC_CLASSES: typing.List[typing.Tuple[str, typing.List[str]]] = [
+    ('logs', ['outbox/+/things/+/log', '$aws/rules/+/things/+/log']),
+    ('telemetry', ['outbox/+/things/+/metrics', '$aws/rules/+/things/+/metrics']),
+    ('jobs', ['$aws/things/+/jobs/#']),
+    ('shadow', ['$aws/things/+/shadow/#']),
+    ('events', ['supervisor/#', '$SYS/#'])
+]
+
+PROFILES: typing.Dict[str, typing.Dict[str, int]] = {
+    # what every service used before profiles
+    'reliable': {'logs': 2, 'telemetry': 2, 'jobs': 2, 'shadow': 2, 'events': 2, 'default': 2},
+    'default': {'logs': 1, 'telemetry': 0, 'jobs': 1, 'shadow': 1, 'events': 1, 'default': 1},
+    # only job control is acknowledged, everything else can be lost if a client or the broker goes away
+    'fast': {'logs': 0, 'telemetry': 0, 'jobs': 1, 'shadow': 0, 'events': 0, 'default': 0}
+}
+
+
+def topic_class(topic: str) -> str:
+    # works for subscription filters too, their wildcards are matched as plain levels
+    for name, filters in TOPIC_CLASSES:
+        if any(paho.topic_matches_sub(f, topic) for f in filters): return name
+    return 'default'
+
+
+class QosProfile(object):
+
+    def __init__(self, levels: typing.Dict[str, int]) -> None:
+        self.levels = {'default': 1, **levels}
+        self.cache: typing.Dict[str, int] = {}
+
+    def publish(self, topic: str) -> int:
+        qos = self.cache.get(topic)
+        if qos is None:
+            # topics with ids in them (e.g. jobs) keep coming, so the cache is only allowed to grow so far
+            if len(self.cache) >= 1024: self.cache.clear()
+            qos = self.cache[topic] = self.levels.get(topic_class(topic), self.levels['default'])
+        return qos
+
+    def subscribe(self, topic: str) -> int:
+        # the delivered QoS is the lower of the publish and subscribe QoS, so a filter outside any one class
+        # (e.g. outbox/#) is subscribed at the highest level in use and the publisher decides
+        name = topic_class(topic)
+        if name == 'default': return max(self.levels.values())
+        return self.levels.get(name, self.levels['default'])
+
+
+def profile(name: typing.Optional[str] = None) -> QosProfile:
+    name = name or config.qos_profile or 'default'
+    profiles = {**PROFILES, **(config.qos_profiles or {})}
+    if name not in profiles:
+        raise ValueError(f'Unknown QoS profile {name}')
+    return QosProfile(profiles[name])
+
+
+configured: typing.Optional[QosProfile] = None
+
+
+def qos(topic: str) -> int:
+    # the publish QoS for a topic in the configured profile
+    global configured
+    if configured is None: configured = profile()
+    return configured.publish(topic)
+
+
+def subscribe_qos(topic: str) -> int:
+    global configured
+    if configured is None: configured = profile()
+    return configured.subscribe(topic)
@@ -0,0 +1,389 @@
+import asyncio
+import json
+import logging
+import typing
+
+import paho.mqtt.client as paho
+
+import baseline_device.util.aiomqtt
+import baseline_device.util.dict
+from baseline_device import util
+from baseline_device.util.aiomqtt import AsyncClient
+
+logger = logging.getLogger(__file__)
+
+# called with the shadow's state, or None when the shadow does not exist (e.g. deleted)
+ShadowHandler = typing.Callable[[AsyncClient, str, typing.Optional[dict]], typing.Optional[typing.Awaitable[None]]]
+
+# called with the shadow name, the dotted attribute path and its desired value (None when removed), returns
+# the value to report for the attribute, or None to report the desired value as is
+AttributeHandler = typing.Callable[[AsyncClient, str, str, typing.Any], typing.Any]
+
+SHADOW_TOPICS = [
+    'get/accepted',
+    'get/rejected',
+    'update/delta',
+    'update/documents',
+    'update/rejected',
+    'delete/accepted',
+    'delete/rejected'
+]
+
+
+# Handles any number of named shadows for a thing over one set of wildcard subscriptions. Messages are
+# dispatched to the handler registered for the shadow name in the topic. GET requests for a shadow are
+# coalesced while one is outstanding, and the periodic refresh cycles through the shadows one at a time
+# on a single timer, so the load stays flat however many shadows there are.
+#
+# Each shadow's desired and reported state is cached locally along with its version. The update/documents
+# and update/delta messages are applied to the cache directly, and a GET is only sent when there is no
+# cached state yet, after a reconnect, or when a delta skips a version.
+class ShadowManager(object):
+
+    def __init__(self, client: AsyncClient, thing_name: str, handlers: typing.Optional[typing.Dict[str, ShadowHandler]] = None, refresh_interval: float = 600, get_spacing: float = 0.05, get_timeout: float = 30, report_interval: float = 1, reconnect_jitter: float = 0) -> None:
+        self.client = client
+        self.thing_name = thing_name
+        self.handlers: typing.Dict[str, ShadowHandler] = dict(handlers or {})
+        self.refresh_interval = refresh_interval
+        self.get_spacing = get_spacing
+        self.get_timeout = get_timeout
+        self.reconnect_jitter = reconnect_jitter
+
+        # shadow name to the loop time its outstanding GET was sent
+        self.requested: typing.Dict[str, float] = {}
+        self.refresh_index = 0
+        self.refresh_timer: typing.Optional[asyncio.TimerHandle] = None
+        self.get_timers: typing.List[asyncio.TimerHandle] = []
+
+        # shadow name to {"desired": {...}, "reported": {...}} and its version, partial when built from a delta
+        self.states: typing.Dict[str, dict] = {}
+        self.versions: typing.Dict[str, int] = {}
+        self.partial: typing.Set[str] = set()
+
+        self.reporter = ReportedPublisher(self, report_interval)
+
+    def topic(self, name: str, action: str) -> str:
+        return f'$aws/things/{self.thing_name}/shadow/name/{name}/{action}'
+
+    def shadow_name(self, topic: str) -> str:
+        # $aws/things/<thing_name>/shadow/name/<shadow_name>/...
+        return topic.split('/')[5]
+
+    def add(self, name: str, handler: ShadowHandler) -> None:
+        self.handlers[name] = handler
+
+    def setup(self) -> None:
+        self.client.connect_callback_add(self.on_connect)
+        self.client.message_callback_add(self.topic('+', 'get/accepted'), self.get_accepted)
+        self.client.message_callback_add(self.topic('+', 'get/rejected'), self.get_rejected)
+        self.client.message_callback_add(self.topic('+', 'update/delta'), self.update_delta)
+        self.client.message_callback_add(self.topic('+', 'update/documents'), self.update_documents)
+        self.client.message_callback_add(self.topic('+', 'update/rejected'), self.rejected)
+        self.client.message_callback_add(self.topic('+', 'delete/accepted'), self.delete_accepted)
+        self.client.message_callback_add(self.topic('+', 'delete/rejected'), self.rejected)
+
+    def teardown(self) -> None:
+        self.cancel_timers()
+        self.reporter.flush_all()
+
+    def cancel_timers(self) -> None:
+        for timer in [self.refresh_timer, *self.get_timers]:
+            if timer: timer.cancel()
+        self.refresh_timer = None
+        self.get_timers = []
+
+    async def on_connect(self, client: AsyncClient, flags: dict, rc: int) -> None:
+        # a persistent session still has the subscriptions from last time
+        if not util.aiomqtt.session_present(flags):
+            client.subscribe([self.topic('+', action) for action in SHADOW_TOPICS])
+
+        # a reconnect may have missed updates, so get everything again, spaced out rather than all at once, and
+        # after a random delay so the services (and devices) reconnecting after a broker restart do not all ask together
+        offset = util.aiomqtt.jitter(self.reconnect_jitter)
+        self.requested.clear()
+        self.cancel_timers()
+        self.get_timers = [client.call_later(offset + i * self.get_spacing, self.get, name) for i, name in enumerate(self.handlers)]
+        self.schedule_refresh(offset)
+
+    def schedule_refresh(self, delay: float = 0) -> None:
+        if not self.handlers: return
+        self.refresh_timer = self.client.call_later(delay + self.refresh_interval / len(self.handlers), self.refresh)
+
+    def refresh(self) -> None:
+        names = list(self.handlers)
+        if names:
+            self.refresh_index = (self.refresh_index + 1) % len(names)
+            self.get(names[self.refresh_index])
+        self.schedule_refresh()
+
+    def get(self, name: str) -> None:
+        now = self.client.loop.time()
+        if now - self.requested.get(name, -self.get_timeout) < self.get_timeout: return
+        self.requested[name] = now
+        self.client.publish(self.topic(name, 'get'))
+
+    def update(self, name: str, state: dict, **kwargs) -> asyncio.Future:
+        return self.client.publish(self.topic(name, 'update'), payload=json.dumps({'state': state, **kwargs}))
+
+    def report(self, name: str, reported: dict) -> None:
+        # a reported state patch, merged with any others for the shadow that are still waiting to be published
+        self.reporter.report(name, reported)
+
+    def state(self, name: str) -> typing.Optional[dict]:
+        return self.states.get(name)
+
+    def version(self, name: str) -> typing.Optional[int]:
+        return self.versions.get(name)
+
+    async def apply(self, name: str, state: typing.Optional[dict], version: typing.Optional[int] = None, partial: bool = False, dispatch: bool = True) -> None:
+        if state is None:
+            self.states.pop(name, None)
+            self.versions.pop(name, None)
+        else:
+            state = {'desired': state.get('desired') or {}, 'reported': state.get('reported') or {}}
+            self.states[name] = state
+            self.versions[name] = version
+
+        if partial: self.partial.add(name)
+        else: self.partial.discard(name)
+
+        if dispatch: await self.dispatch(name, state)
+
+    async def dispatch(self, name: str, state: typing.Optional[dict]) -> None:
+        handler = self.handlers.get(name)
+        if not handler: return
+        result = handler(self.client, name, state)
+        if asyncio.iscoroutine(result): await result
+
+    async def get_accepted(self, client: AsyncClient, message: paho.MQTTMessage) -> None:
+        # {
+        #     "state": {
+        #         "desired": {
+        #             "attribute1": integer,
+        #             "attributeN": boolean
+        #         },
+        #         "reported": {
+        #             "attribute1": integer,
+        #             "attributeN": boolean
+        #         },
+        #         "delta": {
+        #             "attribute1": integer,
+        #             "attributeN": boolean
+        #         }
+        #     },
+        #     "metadata": {...},
+        #     "timestamp": timestamp,
+        #     "clientToken": "token",
+        #     "version": number
+        # }
+        name = self.shadow_name(message.topic)
+        self.requested.pop(name, None)
+
+        payload = json.loads(message.payload.decode('utf-8'))
+
+        # an update may have been applied while the GET was in flight
+        if name in self.versions and payload['version'] < self.versions[name]: return
+
+        await self.apply(name, payload['state'], payload['version'])
+
+    async def get_rejected(self, client: AsyncClient, message: paho.MQTTMessage) -> None:
+        # {
+        #     "code": "ErrorCode",
+        #     "message": "string",
+        #     "timestamp": timestamp,
+        #     "clientToken": "string"
+        # }
+        name = self.shadow_name(message.topic)
+        self.requested.pop(name, None)
+
+        payload = json.loads(message.payload.decode('utf-8'))
+
+        if payload['code'] == 404:  # the shadow is not set up for this device, or was deleted
+            await self.apply(name, None)
+        else:
+            logger.error(f'MQTT request rejected for topic {message.topic}:\n{message.payload}')
+
+    # AWS IoT publishes a response state document to this topic when it accepts a change for the device's shadow,
+    # and the request state document contains different values for desired and reported states:
+    # * A message published on update/delta includes only the desired attributes that differ between the desired and reported sections.
+    #   It contains all of these attributes, regardless of whether these attributes were contained in the current update message or were
+    #   already stored in AWS IoT. Attributes that do not differ between the desired and reported sections are not included.
+    # * If an attribute is in the reported section but has no equivalent in the desired section, it is not included.
+    # * If an attribute is in the desired section but has no equivalent in the reported section, it is included.
+    # * If an attribute is deleted from the reported section but still exists in the desired section, it is included.
+    async def update_delta(self, client: AsyncClient, message: paho.MQTTMessage) -> None:
+        # {
+        #     "state": {
+        #         "attribute1": integer,
+        #         "attributeN": boolean
+        #     },
+        #     "metadata": {...},
+        #     "timestamp": timestamp,
+        #     "clientToken": "token",
+        #     "version": number
+        # }
+        name = self.shadow_name(message.topic)
+        payload = json.loads(message.payload.decode('utf-8'))
+        version = payload['version']
+
+        cached = self.versions.get(name)
+
+        if cached is None or version > cached + 1:  # nothing to apply it to, or an update was missed
+            self.get(name)
+        elif version == cached + 1:
+            # update/documents carries the complete state for the same version and replaces this when it arrives,
+            # until then desired is the cached desired with the differing attributes applied
+            desired = util.dict.deep_update(util.dict.deep_copy(self.states[name]['desired']), payload['state'])
+            await self.apply(name, {**self.states[name], 'desired': desired}, version, partial=True)
+
+    async def update_documents(self, client: AsyncClient, message: paho.MQTTMessage) -> None:
+        # {
+        #   "previous" : {"state": {...}, "metadata": {...}, "version": number},
+        #   "current": {"state": {...}, "metadata": {...}, "version": number},
+        #   "timestamp": timestamp,
+        #   "clientToken": "token"
+        # }
+        name = self.shadow_name(message.topic)
+        payload = json.loads(message.payload.decode('utf-8'))
+        current = payload['current']
+
+        # the current document is complete, so it applies over any older cached state without a GET
+        cached = self.versions.get(name)
+        if cached is None or current['version'] > cached:
+            await self.apply(name, current['state'], current['version'])
+        elif current['version'] == cached and name in self.partial:
+            # the handler has already seen this version's desired state, unless the delta got it wrong
+            desired_changed = (current['state'].get('desired') or {}) != self.states[name]['desired']
+            await self.apply(name, current['state'], current['version'], dispatch=desired_changed)
+
+    async def delete_accepted(self, client: AsyncClient, message: paho.MQTTMessage) -> None:
+        await self.apply(self.shadow_name(message.topic), None)
+
+    async def rejected(self, client: AsyncClient, message: paho.MQTTMessage) -> None:
+        # {
+        #     "code": "ErrorCode",
+        #     "message": "string",
+        #     "timestamp": timestamp,
+        #     "clientToken": "string"
+        # }
+        logger.error(f'MQTT request rejected for topic {message.topic}:\n{message.payload}')
+
+
+# Merges the reported state patches for each shadow and publishes them at most once per interval, so a
+# flapping attribute costs one update per interval with its newest value rather than one per change. The
+# first patch after a quiet period is published right away, later ones wait for the interval to pass.
+class ReportedPublisher(object):
+
+    def __init__(self, shadows: ShadowManager, interval: float = 1) -> None:
+        self.shadows = shadows
+        self.interval = interval
+
+        self.pending: typing.Dict[str, dict] = {}
+        self.published_at: typing.Dict[str, float] = {}
+        self.timers: typing.Dict[str, asyncio.TimerHandle] = {}
+
+        # totals across all shadows, coalesced counts the patches that were merged into one already waiting
+        self.counters = {'reported': 0, 'coalesced': 0, 'published': 0}
+
+    def report(self, name: str, reported: dict) -> None:
+        self.counters['reported'] += 1
+
+        if name in self.pending:
+            self.counters['coalesced'] += 1
+            merge(self.pending[name], reported)
+        else:
+            self.pending[name] = util.dict.deep_copy(reported)
+
+        if name in self.timers: return
+
+        delay = self.published_at.get(name, -self.interval) + self.interval - self.shadows.client.loop.time()
+        if delay <= 0:
+            self.flush(name)
+        else:
+            self.timers[name] = self.shadows.client.call_later(delay, self.flush, name)
+
+    def flush(self, name: str) -> None:
+        timer = self.timers.pop(name, None)
+        if timer: timer.cancel()
+
+        reported = self.pending.pop(name, None)
+        if not reported: return
+
+        self.published_at[name] = self.shadows.client.loop.time()
+        self.counters['published'] += 1
+        self.shadows.update(name, {'reported': reported})
+
+    def flush_all(self) -> None:
+        for name in list(self.pending):
+            self.flush(name)
+
+
+def merge(a: dict, b: dict) -> dict:
+    # like util.dict.deep_update, but a None (delete) is kept as a value, and replaces or is replaced by a dict
+    for k, v in b.items():
+        if isinstance(v, dict) and isinstance(a.get(k), dict):
+            merge(a[k], v)
+        else:
+            a[k] = util.dict.deep_copy(v) if isinstance(v, (dict, list)) else v
+    return a
+
+
+# Handlers for individual attributes, registered by dotted path (e.g. "network.wifi.ssid") for each shadow.
+# The paths are kept in a tree keyed by path part, so finding the handlers for a change walks only the
+# changed keys of the patch, however large the document is and however many handlers there are. A handler
+# on a path runs when anything at or below it changes, and when a parent of it is replaced or removed.
+class AttributeHandlers(object):
+
+    def __init__(self) -> None:
+        # shadow name to a tree of {part: {'handlers': [...], 'children': {...}}}
+        self.trees: typing.Dict[str, dict] = {}
+
+    def add(self, name: str, path: str, handler: AttributeHandler) -> None:
+        children = self.trees.setdefault(name, {})
+        for part in path.split('.'):
+            node = children.setdefault(part, {'handlers': [], 'children': {}})
+            children = node['children']
+        node['handlers'].append(handler)
+
+    def handler(self, name: str, path: str) -> typing.Callable[[AttributeHandler], AttributeHandler]:
+        # as a decorator, @attributes.handler('sample', 'network.wifi.ssid')
+        def register(handler: AttributeHandler) -> AttributeHandler:
+            self.add(name, path, handler)
+            return handler
+        return register
+
+    def matches(self, name: str, patch: dict) -> typing.List[typing.Tuple[str, typing.List[AttributeHandler]]]:
+        # the handlers affected by a patch from util.dict.deep_diff, as (path, handlers), parents first
+        found = []
+        self.match(self.trees.get(name) or {}, patch, '', found)
+        return found
+
+    def match(self, children: dict, patch: typing.Any, prefix: str, found: list) -> None:
+        if isinstance(patch, dict):
+            keys = [k for k in patch if k in children]
+        else:  # replaced or removed, so everything below has changed too
+            keys = list(children)
+
+        for k in keys:
+            node = children[k]
+            path = prefix + k
+            if node['handlers']: found.append((path, node['handlers']))
+            if node['children']:
+                self.match(node['children'], patch[k] if isinstance(patch, dict) else None, path + '.', found)
+
+    async def run(self, client: AsyncClient, name: str, desired: dict, patch: dict) -> dict:
+        # calls the handlers affected by the patch and returns the patch with their results in place, ready to report
+        reported = util.dict.deep_copy(patch)
+
+        for path, handlers in self.matches(name, patch):
+            value = util.dict.dpath_read(desired, path)
+            for handler in handlers:
+                try:
+                    result = handler(client, name, path, value)
+                    if asyncio.iscoroutine(result): result = await result
+                except:
+                    logger.error(f'Unable to handle shadow {name} attribute {path}', exc_info=True)
+                    continue
+                if result is not None: util.dict.dpath_write(reported, path, result)
+
+        return reported
@@ -0,0 +1,298 @@
+import errno
+import itertools
+import json
+import mmap
+import os
+import select
+import socket
+import struct
+import time
+import typing
+
+from baseline_device.util.config import config
+
+# A versioned copy of a document (e.g. a shadow's desired state) in a shared memory mapped file, written by
+# one process and read by any number of others. Readers map the file once, and checking for a change is a
+# single 8 byte read of the sequence number, so there is no reason to poll and re-parse JSON files.
+#
+# The writer uses a seqlock; the sequence is odd while it is writing and even once the write is complete, so
+# a reader that sees the same even sequence before and after reading the data knows it was not torn.
+# When the document outgrows the region, a bigger file is swapped in and the old one is flagged as stale so
+# readers map the new one.
+#
+# The sequence is only ever read and written as one native 8 byte word; struct.pack_into clears its target
+# before writing it, so a reader could briefly see a zero (even) sequence in the middle of a write.
+#
+# Readers that wait() for a change bind a unix datagram socket in <path>.notify/, and after every write the
+# writer sends each socket there one byte, so a waiting reader sleeps in select() until it is woken rather
+# than polling. Sockets left behind by readers that died are removed by the writer when sending fails.
+
+MAGIC = b'BSC1'
+
+# magic, flags, sequence, version, length, all in native byte order as the region never leaves the device
+HEADER = struct.Struct('=4sIQQI')
+FLAGS = struct.Struct('=I')
+FLAGS_OFFSET = 4
+SEQUENCE_OFFSET = 8
+VALUES = struct.Struct('=QI')
+VALUES_OFFSET = 16
+DATA_OFFSET = 32
+
+DELETED = 1
+STALE = 2
+
+# a write takes microseconds, a sequence that stays odd for this long belongs to a writer that died mid-write
+READ_TIMEOUT = 1.0
+
+
+def path(name: str) -> str:
+    directory = config.shadow_cache_dir or (f'/dev/shm/{config.app_name}/shadows' if os.path.isdir('/dev/shm') else f'/tmp/{config.app_name}/shm/shadows')
+    return f'{directory}/{name}'
+
+
+class StateWriter(object):
+
+    def __init__(self, path: str, capacity: int = 64 * 1024) -> None:
+        self.path = path
+        self.capacity = capacity
+        self.map: typing.Optional[mmap.mmap] = None
+        self.sequence_word: typing.Optional[memoryview] = None
+        self.sequence = 0
+        self.notify_socket: typing.Optional[socket.socket] = None
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # carry on from a previous writer's sequence, so its readers see a change rather than a reset
+        previous = self.open_previous()
+        if previous is not None:
+            sequence = HEADER.unpack_from(previous, 0)[2]
+            self.sequence = sequence + sequence % 2
+            previous.close()
+
+    def open_previous(self) -> typing.Optional[mmap.mmap]:
+        try:
+            with open(self.path, 'r+b') as f:
+                previous = mmap.mmap(f.fileno(), 0)
+        except (OSError, ValueError):
+            return None
+        if len(previous) < DATA_OFFSET or previous[:4] != MAGIC:
+            previous.close()
+            return None
+        return previous
+
+    def write(self, version: int, data: typing.Optional[bytes]) -> None:
+        # None marks the document as deleted
+        length = len(data) if data else 0
+
+        if self.map is None or length > self.capacity:
+            while length > self.capacity: self.capacity *= 2
+            self.replace(version, data)
+            return
+
+        self.sequence_word[0] = self.sequence + 1
+        if data: self.map[DATA_OFFSET:DATA_OFFSET + length] = data
+        FLAGS.pack_into(self.map, FLAGS_OFFSET, 0 if data is not None else DELETED)
+        VALUES.pack_into(self.map, VALUES_OFFSET, version, length)
+        self.sequence_word[0] = self.sequence + 2
+        self.sequence += 2
+        self.notify()
+
+    def replace(self, version: int, data: typing.Optional[bytes]) -> None:
+        # the new region is complete before it is renamed into place, then readers of the old one are told to remap
+        length = len(data) if data else 0
+        self.sequence += 2
+
+        previous = self.map if self.map is not None else self.open_previous()
+
+        temp = f'{self.path}.{os.getpid()}'
+        with open(temp, 'w+b') as f:
+            f.truncate(DATA_OFFSET + self.capacity)
+            region = mmap.mmap(f.fileno(), 0)
+        HEADER.pack_into(region, 0, MAGIC, 0 if data is not None else DELETED, self.sequence, version, length)
+        if data: region[DATA_OFFSET:DATA_OFFSET + length] = data
+        os.replace(temp, self.path)
+
+        if previous is not None:
+            # readers of the old region see a new sequence, then the flag telling them to remap
+            sequence_word(previous)[0] = self.sequence
+            FLAGS.pack_into(previous, FLAGS_OFFSET, STALE)
+            if previous is self.map: self.close()
+            else: previous.close()
+
+        self.map = region
+        self.sequence_word = sequence_word(region)
+        self.notify()
+
+    def notify(self) -> None:
+        # wakes the readers waiting on a change, one directory listing when none are
+        try:
+            names = os.listdir(notify_dir(self.path))
+        except FileNotFoundError:
+            return
+
+        if self.notify_socket is None:
+            self.notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.notify_socket.setblocking(False)
+
+        for name in names:
+            address = f'{notify_dir(self.path)}/{name}'
+            try:
+                self.notify_socket.sendto(b'\0', address)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # the reader died without removing its socket
+                try:
+                    os.remove(address)
+                except OSError:
+                    pass
+            except OSError as e:
+                # a full queue already holds a wakeup the reader hasn't taken
+                if e.errno not in (errno.EAGAIN, errno.ENOBUFS): raise
+
+    def close(self) -> None:
+        if self.map is not None:
+            self.sequence_word.release()
+            self.sequence_word = None
+            self.map.close()
+            self.map = None
+        if self.notify_socket is not None:
+            self.notify_socket.close()
+            self.notify_socket = None
+
+
+class StateReader(object):
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.map: typing.Optional[mmap.mmap] = None
+        self.sequence_word: typing.Optional[memoryview] = None
+        # the sequence of the last successful read
+        self.seen: typing.Optional[int] = None
+        # bound on the first wait()
+        self.notify_socket: typing.Optional[socket.socket] = None
+        self.notify_path: typing.Optional[str] = None
+
+    def open(self) -> bool:
+        self.unmap()
+        try:
+            with open(self.path, 'rb') as f:
+                region = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        if len(region) < DATA_OFFSET or region[:4] != MAGIC:
+            region.close()
+            return False
+        self.map = region
+        self.sequence_word = sequence_word(region)
+        return True
+
+    def sequence(self) -> typing.Optional[int]:
+        # None until the writer has created the region
+        if self.map is None and not self.open(): return None
+        if FLAGS.unpack_from(self.map, FLAGS_OFFSET)[0] & STALE and not self.open(): return None
+        return self.sequence_word[0]
+
+    def changed(self) -> bool:
+        # whether there is anything newer than the last read, without touching the data
+        return self.sequence() != self.seen
+
+    def read_with(self, read: typing.Callable[[memoryview], typing.Any], timeout: float = READ_TIMEOUT) -> typing.Optional[typing.Tuple[int, typing.Any]]:
+        # calls read with a view straight onto the shared data, and again if the writer changed it in the
+        # meantime; the view is only valid during the call. The result is None for a deleted document.
+        # Raises TimeoutError when there is no consistent read within timeout seconds, rather than spinning
+        # forever on a region left mid-write.
+        deadline = time.monotonic() + timeout
+        retry = False
+        while True:
+            if retry and time.monotonic() >= deadline:
+                raise TimeoutError(f'No consistent read of {self.path} in {timeout}s, its writer may have died mid-write')
+            retry = True
+
+            sequence = self.sequence()
+            if sequence is None: return None
+            if sequence % 2:
+                time.sleep(0)
+                continue
+
+            _, flags, _, version, length = HEADER.unpack_from(self.map, 0)
+            if flags & STALE: continue
+
+            result = None
+            if not flags & DELETED:
+                view = memoryview(self.map)[DATA_OFFSET:DATA_OFFSET + length]
+                try:
+                    result = read(view)
+                except Exception:
+                    # torn data can fail to parse, that is only an error if it was not torn
+                    if self.sequence_word[0] == sequence: raise
+                    continue
+                finally:
+                    view.release()
+
+            if self.sequence_word[0] == sequence:
+                self.seen = sequence
+                return version, result
+
+    def read(self, timeout: float = READ_TIMEOUT) -> typing.Optional[typing.Tuple[int, typing.Optional[dict]]]:
+        # (version, document), or None if nothing has been written yet
+        return self.read_with(lambda view: json.loads(str(view, 'utf-8')), timeout)
+
+    def version(self, timeout: float = READ_TIMEOUT) -> typing.Optional[int]:
+        result = self.read_with(lambda view: None, timeout)
+        return result[0] if result else None
+
+    def wait(self, timeout: float) -> bool:
+        # blocks until there is something newer than the last read, woken by the writer, and returns False
+        # on timeout. The sequence is checked after the socket is bound, so a write just before is not missed.
+        self.listen()
+        deadline = time.monotonic() + timeout
+        while not self.changed():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return False
+            readable, _, _ = select.select([self.notify_socket], [], [], remaining)
+            if readable: self.drain()
+        return True
+
+    def listen(self) -> None:
+        if self.notify_socket is not None: return
+        directory = notify_dir(self.path)
+        os.makedirs(directory, exist_ok=True)
+        notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        notify_socket.setblocking(False)
+        self.notify_path = f'{directory}/{os.getpid()}.{next(reader_ids)}'
+        notify_socket.bind(self.notify_path)
+        self.notify_socket = notify_socket
+
+    def drain(self) -> None:
+        try:
+            while True: self.notify_socket.recv(64)
+        except BlockingIOError:
+            pass
+
+    def unmap(self) -> None:
+        if self.map is not None:
+            self.sequence_word.release()
+            self.sequence_word = None
+            self.map.close()
+            self.map = None
+
+    def close(self) -> None:
+        self.unmap()
+        if self.notify_socket is not None:
+            self.notify_socket.close()
+            self.notify_socket = None
+            try:
+                os.remove(self.notify_path)
+            except OSError:
+                pass
+
+
+reader_ids = itertools.count()
+
+
+def notify_dir(path: str) -> str:
+    return f'{path}.notify'
+
+
+def sequence_word(region: mmap.mmap) -> memoryview:
+    # an aligned native word, so each read and write of the sequence is a single load or store
+    return memoryview(region)[SEQUENCE_OFFSET:SEQUENCE_OFFSET + 8].cast('Q')
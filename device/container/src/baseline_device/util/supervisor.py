@@ -0,0 +1,161 @@
+import asyncio
+import http.client
+import socket
+import typing
+import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
+
+from baseline_device.util.config import config
+
+# http://supervisord.org/api.html#supervisor.rpcinterface.SupervisorNamespaceRPCInterface
+# faults raised by the process control methods, see supervisor.xmlrpc.Faults
+ALREADY_STARTED = 60
+NOT_RUNNING = 70
+
+
+class UnixStreamHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path: str, timeout: float) -> None:
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class UnixStreamTransport(xmlrpc.client.Transport):
+
+    def __init__(self, path: str, timeout: float) -> None:
+        super().__init__()
+        self.path = path
+        self.timeout = timeout
+
+    def make_connection(self, host: str) -> http.client.HTTPConnection:
+        # the base Transport keeps the connection open between requests, and reconnects if the server closed it
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        self._connection = host, UnixStreamHTTPConnection(self.path, self.timeout)
+        return self._connection[1]
+
+
+# Talks to supervisord's XML-RPC interface over its unix socket, instead of spawning supervisorctl for
+# each call. The calls run on a single worker thread, which keeps one connection open and the event
+# loop free while waiting on supervisord.
+class Supervisor(object):
+
+    def __init__(self, path: typing.Optional[str] = None, timeout: float = 30) -> None:
+        self.path = path or f'/tmp/{config.app_name}/supervisor.sock'
+        self.proxy = xmlrpc.client.ServerProxy('http://localhost', transport=UnixStreamTransport(self.path, timeout))
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='supervisor')
+
+    def call(self, method: str, *args) -> typing.Any:
+        return getattr(self.proxy, method)(*args)
+
+    async def call_async(self, method: str, *args) -> typing.Any:
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.call, method, *args)
+
+    async def start(self, name: str, wait: bool = True) -> bool:
+        return await self.call_async('supervisor.startProcess', name, wait)
+
+    async def stop(self, name: str, wait: bool = True) -> bool:
+        return await self.call_async('supervisor.stopProcess', name, wait)
+
+    async def restart(self, name: str, wait: bool = True) -> bool:
+        # same as supervisorctl restart, a process that is not running is just started
+        try:
+            await self.stop(name, wait)
+        except xmlrpc.client.Fault as e:
+            if e.faultCode != NOT_RUNNING: raise
+        return await self.start(name, wait)
+
+    async def pid(self, name: str) -> int:
+        # zero when the process is not running
+        info = await self.process_info(name)
+        return info['pid']
+
+    async def process_info(self, name: str) -> dict:
+        # {
+        #     "name": "string",
+        #     "group": "string",
+        #     "start": int,
+        #     "stop": int,
+        #     "now": int,
+        #     "state": int,
+        #     "statename": "string",
+        #     "spawnerr": "string",
+        #     "exitstatus": int,
+        #     "pid": int,
+        #     ...
+        # }
+        return await self.call_async('supervisor.getProcessInfo', name)
+
+    async def all_process_info(self) -> typing.List[dict]:
+        # the same as process_info, for every process
+        return await self.call_async('supervisor.getAllProcessInfo')
+
+
+supervisor = Supervisor()
+
+
+# http://supervisord.org/events.html#event-listener-notification-protocol
+# Splits what supervisor writes to an event listener's stdin into (headers, payload) events. Data can be fed
+# in any sized pieces, a partial header line or payload is kept until the rest arrives.
+class EventParser(object):
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.headers: typing.Optional[dict] = None
+
+    def feed(self, data: bytes) -> typing.List[typing.Tuple[dict, bytes]]:
+        self.buffer += data
+        events = []
+
+        while True:
+            if self.headers is None:
+                end = self.buffer.find(b'\n')
+                if end == -1: break
+                self.headers = parse_tokens(self.buffer[:end].decode('utf-8'))
+                del self.buffer[:end + 1]
+
+            length = int(self.headers['len'])
+            if len(self.buffer) < length: break
+
+            events.append((self.headers, bytes(self.buffer[:length])))
+            del self.buffer[:length]
+            self.headers = None
+
+        return events
+
+
+def parse_tokens(line: str) -> dict:
+    # key:value pairs separated by spaces, the values may contain colons themselves
+    return dict(token.split(':', 1) for token in line.split())
+
+
+def parse_payload(payload: bytes) -> dict:
+    # the payload is a line of tokens, optionally followed by a newline and data (e.g. PROCESS_LOG_STDOUT)
+    line, newline, data = payload.decode('utf-8', errors='replace').partition('\n')
+    body = parse_tokens(line)
+    if newline: body['data'] = data
+    return body
+
+
+# the base type that an event name belongs to, e.g. PROCESS_STATE for PROCESS_STATE_RUNNING
+EVENT_TYPES = [
+    'PROCESS_STATE',
+    'PROCESS_LOG',
+    'PROCESS_COMMUNICATION',
+    'PROCESS_GROUP',
+    'REMOTE_COMMUNICATION',
+    'SUPERVISOR_STATE_CHANGE',
+    'TICK'
+]
+
+
+def event_type(event_name: str) -> str:
+    for base in EVENT_TYPES:
+        if event_name == base or event_name.startswith(f'{base}_'):
+            return base
+    return event_name
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+import sys
+
+import paho.mqtt.client as paho
+
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, src_dir)
+os.environ.setdefault('BASELINE_CLIENT_ID', 'thing')
+
+import baseline_device.util.py  # noqa: E402
+from baseline_device import util  # noqa: E402
+
+# loaded by path like service/agent.py does, the jobs/ package shadows jobs.py
+jobs = util.py.load_source('baseline_device.service.agent_jobs', f'{src_dir}/baseline_device/service/jobs.py')
+
+
+class FakeClient(object):
+
+    def __init__(self) -> None:
+        self.published = []
+
+    def publish(self, topic, payload=None, **kwargs) -> None:
+        self.published.append((topic, json.loads(payload) if payload else None))
+
+    def call_later(self, delay, callback, *args) -> asyncio.TimerHandle:
+        return asyncio.get_event_loop().call_later(delay, callback, *args)
+
+
+def message(topic: str, payload: dict) -> paho.MQTTMessage:
+    msg = paho.MQTTMessage(topic=topic.encode('utf-8'))
+    msg.payload = json.dumps(payload).encode('utf-8')
+    return msg
+
+
+def execution(job_id: str = 'job1') -> dict:
+    return {
+        'jobId': job_id,
+        'jobDocument': {'program': 'sample1'},
+        'status': 'QUEUED',
+        'queuedAt': 1700000000,
+        'versionNumber': 1,
+        'executionNumber': 1
+    }
+
+
+def run(handler, client: FakeClient, msg: paho.MQTTMessage) -> None:
+    async def main() -> None:
+        await handler(client, msg)
+        for job_execution in jobs.active_executions.values():
+            if job_execution.timer: job_execution.timer.cancel()
+
+    asyncio.run(main())
+
+
+def reset(tmp_path, monkeypatch) -> list:
+    # the names of the processes started
+    started = []
+
+    async def start(name: str, wait: bool = True) -> bool:
+        started.append(name)
+        return True
+
+    monkeypatch.setattr(jobs, 'active_executions', {})
+    monkeypatch.setattr(jobs, 'waiting_executions', {})
+    monkeypatch.setattr(jobs, 'waiting_queue', [])
+    monkeypatch.setattr(jobs.config, 'values', {**jobs.config.values, 'app_name': str(tmp_path)})
+    monkeypatch.setattr(jobs.supervisor, 'start', start)
+    return started
+
+
+def test_queued_job_starts_after_update_accepted(tmp_path, monkeypatch):
+    started = reset(tmp_path, monkeypatch)
+    client = FakeClient()
+
+    run(jobs.jobs_jobid_get_accepted, client, message('$aws/things/thing/jobs/job1/get/accepted', {'execution': execution(), 'timestamp': 1700000001}))
+
+    topic, payload = client.published[-1]
+    assert topic == '$aws/things/thing/jobs/job1/update'
+    assert payload == {'status': 'IN_PROGRESS', 'expectedVersion': 1, 'includeJobExecutionState': True}
+    assert not started
+
+    run(jobs.jobs_jobid_update_accepted, client, message('$aws/things/thing/jobs/job1/update/accepted', {
+        'executionState': {'status': 'IN_PROGRESS', 'statusDetails': {}, 'versionNumber': 2},
+        'timestamp': 1700000002,
+        'clientToken': 'token'
+    }))
+
+    assert started == ['jobs_sample1']
+    assert jobs.active_executions['job1'].execution['versionNumber'] == 2
+
+
+def test_queued_job_starts_without_execution_state(tmp_path, monkeypatch):
+    started = reset(tmp_path, monkeypatch)
+    client = FakeClient()
+
+    run(jobs.jobs_jobid_get_accepted, client, message('$aws/things/thing/jobs/job1/get/accepted', {'execution': execution(), 'timestamp': 1700000001}))
+    run(jobs.jobs_jobid_update_accepted, client, message('$aws/things/thing/jobs/job1/update/accepted', {'timestamp': 1700000002, 'clientToken': 'token'}))
+
+    assert started == ['jobs_sample1']
+    assert jobs.active_executions['job1'].execution['versionNumber'] == 2
+
+
+def test_update_rejected_requeues_the_job(tmp_path, monkeypatch):
+    started = reset(tmp_path, monkeypatch)
+    client = FakeClient()
+
+    run(jobs.jobs_jobid_get_accepted, client, message('$aws/things/thing/jobs/job1/get/accepted', {'execution': execution(), 'timestamp': 1700000001}))
+    run(jobs.jobs_jobid_update_rejected, client, message('$aws/things/thing/jobs/job1/update/rejected', {'code': 'VersionMismatch', 'message': 'version mismatch', 'timestamp': 1700000002}))
+
+    # not queued again until the execution has been described with its current versionNumber
+    assert 'job1' not in jobs.active_executions
+    assert 'job1' not in jobs.waiting_executions
+    assert client.published[-1] == ('$aws/things/thing/jobs/job1/get', None)
+
+    run(jobs.jobs_jobid_get_accepted, client, message('$aws/things/thing/jobs/job1/get/accepted', {'execution': {**execution(), 'versionNumber': 3}, 'timestamp': 1700000003}))
+
+    assert client.published[-1] == ('$aws/things/thing/jobs/job1/update', {'status': 'IN_PROGRESS', 'expectedVersion': 3, 'includeJobExecutionState': True})
+    assert not started
@@ -0,0 +1,81 @@
+#!/bin/bash
+#
+# What is this?
+# This script compares reading and writing a batch of keys one command at a
+# time against mget, mset and a pipeline, with core.aws.redis backed by its
+# in-memory MockRedis (USE_MOCK_REDIS=1). The mock sleeps for one simulated
+# round trip per command or pipeline, so the times show what batching saves
+# on the network, and the latencies recorded by core.aws.redis are printed.
+#
+# How do I use it?
+# $ bash <project-root>/scripts/cloud-bench-redis.sh [keys] [rtt_ms]
+
+set -e
+
+script_dir=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+script_path=${script_dir}/$(basename "${BASH_SOURCE[0]}")
+script_name=$(basename ${BASH_SOURCE[0]})
+
+root_dir=$(cd "${script_dir}/.." && pwd)
+cloud_dir=${root_dir}/cloud
+
+function toolchain_require() { [ -n "$(command -v $1)" ] && return 0 || >&2 echo "$1: not found"; return 1; }
+toolchain_require python3
+
+keys=${1:-100}
+rtt_ms=${2:-0.5}
+
+bench_dir=$(mktemp -d)
+trap "rm -rf ${bench_dir}" EXIT
+
+cp -r "${cloud_dir}/src/baseline_cloud" "${bench_dir}/baseline_cloud"
+
+python3 - <<-EOF
+	import json
+	with open('${bench_dir}/config.json', 'w') as f:
+	  json.dump({
+	    **json.loads('''$(cat "${root_dir}/config.json")'''),
+	    **json.loads('''$(cat "${cloud_dir}/config.json")''')
+	  }, f, indent=4)
+EOF
+
+USE_MOCK_REDIS=1 MOCK_REDIS_RTT_MS=${rtt_ms} PYTHONPATH="${bench_dir}" python3 - <<-EOF
+	import time
+
+	import baseline_cloud.core.aws.redis
+	from baseline_cloud.core import aws
+
+	keys = [f'bench/{i}/sequence_token' for i in range(${keys})]
+
+	def bench(label, func):
+	  started = time.perf_counter()
+	  func()
+	  print(f'{label:>28} {(time.perf_counter() - started) * 1000:>8.1f}ms')
+
+	def set_each():
+	  for key in keys: aws.redis.set(key, key)
+
+	def get_each():
+	  assert [aws.redis.get(key) for key in keys] == keys
+
+	def pipelined():
+	  with aws.redis.pipeline() as pipe:
+	    for key in keys: pipe.get(key)
+	  assert pipe.results == keys
+
+	print(f'{len(keys)} keys, ${rtt_ms}ms simulated round trip')
+	bench('set, one key at a time', set_each)
+	bench('mset', lambda: aws.redis.mset({key: key for key in keys}))
+	bench('get, one key at a time', get_each)
+	bench('mget', lambda: aws.redis.mget(keys))
+	bench('pipeline of gets', pipelined)
+
+	assert aws.redis.mget(keys) == keys
+	aws.redis.set('bench/expiring', '1', ttl=1)
+	time.sleep(1.1)
+	assert aws.redis.get('bench/expiring') is None
+
+	print()
+	for op, summary in aws.redis.latency_summary().items():
+	  print(f'{op:>28} {summary["count"]:>6} calls {summary["mean_ms"]:>8.3f}ms mean {summary["max_ms"]:>8.3f}ms max')
+EOF
@@ -4,7 +4,7 @@
 # This script tests the AWS Lambda code used for device provisioning.
 #
 # How do I use it?
-# $ bash <project-root>/scripts/cloud-test-integration-lambda-provision.sh
+# $ bash <project-root>/scripts/cloud-test-integration-lambda-provision.sh [rsa|ec]
 
 set -e
 
@@ -39,7 +39,13 @@ app_name=$(json_load "${root_dir}/config.json" 'app_name')
 topic_prefix=$(json_load "${root_dir}/config.json" 'topic_prefix')
 
 client_id=$(hex_rand 128)
-client_key=$(openssl genrsa -out /dev/stdout 2048 2> /dev/null)
+key_type=${1:-rsa}
+
+if [ "${key_type}" == "ec" ]; then
+  client_key=$(openssl ecparam -name prime256v1 -genkey -noout -out /dev/stdout 2> /dev/null)
+else
+  client_key=$(openssl genrsa -out /dev/stdout 2048 2> /dev/null)
+fi
 client_csr=$(echo "${client_key}" | openssl req -new -key /dev/stdin -out /dev/stdout -subj "/C=US/CN=${app_name}")
 
 AWS_LAMBDA_EVENT=$(echo "{
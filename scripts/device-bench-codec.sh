@@ -0,0 +1,98 @@
+#!/bin/bash
+#
+# What is this?
+# This script compares the uplink size of typical log batches and telemetry
+# windows in each util.codec format (JSON, msgpack and CBOR, with and
+# without zlib) against the plain JSON that was sent before, and how long
+# encoding takes. Every payload is decoded again with the cloud's
+# core.codec to check the two sides agree. Formats whose module is not
+# installed are skipped.
+#
+# How do I use it?
+# $ bash <project-root>/scripts/device-bench-codec.sh [iterations]
+
+set -e
+
+script_dir=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+script_path=${script_dir}/$(basename "${BASH_SOURCE[0]}")
+script_name=$(basename ${BASH_SOURCE[0]})
+
+root_dir=$(cd "${script_dir}/.." && pwd)
+device_dir=${root_dir}/device
+cloud_dir=${root_dir}/cloud
+
+function toolchain_require() { [ -n "$(command -v $1)" ] && return 0 || >&2 echo "$1: not found"; return 1; }
+toolchain_require python3
+
+iterations=${1:-1000}
+
+bench_dir=$(mktemp -d)
+trap "rm -rf ${bench_dir}" EXIT
+
+cp -r "${device_dir}/container/src/baseline_device" "${bench_dir}/baseline_device"
+mkdir -p "${bench_dir}/cloud/src"
+cp -r "${cloud_dir}/src/baseline_cloud" "${bench_dir}/cloud/src/baseline_cloud"
+echo '{"app_name": "bench", "topic_prefix": "bench"}' > "${bench_dir}/cloud/src/config.json"
+
+python3 - <<-EOF
+	import json
+	with open('${bench_dir}/config.json', 'w') as f:
+	  json.dump({
+	    **json.loads('''$(cat "${root_dir}/config.json")'''),
+	    **json.loads('''$(cat "${device_dir}/container/config.json")''')
+	  }, f, indent=4)
+EOF
+
+PYTHONPATH="${bench_dir}:${bench_dir}/cloud/src" python3 - <<-EOF
+	import json
+	import random
+	import timeit
+
+	from baseline_cloud.core import codec as cloud_codec
+	from baseline_device.util import codec
+
+	random.seed(0)
+
+	traceback = '\n'.join([
+	  'Traceback (most recent call last):',
+	  '  File "/opt/iot-baseline/baseline_device/service/jobs.py", line 212, in jobs_jobid_get_accepted',
+	  '    await start_job_execution(client, job_execution)',
+	  '  File "/opt/iot-baseline/baseline_device/util/supervisor.py", line 60, in start',
+	  '    return await self.call_async("supervisor.startProcess", name, wait)',
+	  'xmlrpc.client.Fault: <Fault 60: "ALREADY_STARTED: jobs_sample1">'
+	])
+
+	def log_batch(size):
+	  records = []
+	  for i in range(size):
+	    record = {'level': random.choice(['INFO', 'INFO', 'INFO', 'WARNING']), 'message': f'Job {random.randrange(1000)} state changed to {random.choice(["RUNNING", "EXITED", "STOPPED"])}', 'timestamp': 1700000000000 + i * 250}
+	    if i % 20 == 0: record.update(level='ERROR', exception=traceback)
+	    records.append(record)
+	  return {'process': 'jobs', 'records': records}
+
+	def telemetry():
+	  summary = lambda scale: [round(random.uniform(0, scale), 2) for _ in range(4)]
+	  return {
+	    'timestamp': 1700000000000, 'window': 60, 'samples': 12,
+	    'metrics': {name: summary(100) for name in ['cpu', 'memory', 'disk', 'load', 'network_rx', 'network_tx']},
+	    'processes': {name: summary(50000000) for name in ['main', 'jobs', 'shadows_sample', 'tunnels', 'telemetry', 'mosquitto', 'supervisor_events_0']}
+	  }
+
+	payloads = [('log batch, 1 record', log_batch(1)), ('log batch, 20 records', log_batch(20)), ('log batch, 100 records', log_batch(100)), ('telemetry window', telemetry())]
+
+	formats = [(name, compress) for name in codec.CODECS if codec.available(name) for compress in [False, True]]
+
+	print(f'{"":>24} {"before":>8}' + ''.join(f' {name + (" + zlib" if compress else ""):>16}' for name, compress in formats))
+
+	for label, payload in payloads:
+	  before = len(json.dumps(payload))
+	  row = f'{label:>24} {before:>6} B'
+	  for name, compress in formats:
+	    data = codec.encode(payload, name, compress_min_bytes=0 if compress else 1 << 30)
+	    assert cloud_codec.decode(data) == payload
+	    encode = timeit.timeit(lambda: codec.encode(payload, name, compress_min_bytes=0 if compress else 1 << 30), number=${iterations}) / ${iterations} * 1e6
+	    row += f' {len(data):>5} B {100 * (1 - len(data) / before):>3.0f}% {encode:>4.0f}us'
+	  print(row)
+
+	print('each cell is the encoded size, the saving against the JSON sent before, and the time to encode')
+EOF
@@ -0,0 +1,74 @@
+#!/bin/bash
+#
+# What is this?
+# This script benchmarks util.dict.deep_diff and util.dict.deep_patch on
+# large nested shadow documents, and compares the size of the minimal
+# reported update against sending the whole desired document. It also
+# checks that applying each patch gives back the expected document.
+#
+# How do I use it?
+# $ bash <project-root>/scripts/device-bench-dict-diff.sh [attributes] [iterations]
+
+set -e
+
+script_dir=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+script_path=${script_dir}/$(basename "${BASH_SOURCE[0]}")
+script_name=$(basename ${BASH_SOURCE[0]})
+
+root_dir=$(cd "${script_dir}/.." && pwd)
+device_dir=${root_dir}/device
+
+function toolchain_require() { [ -n "$(command -v $1)" ] && return 0 || >&2 echo "$1: not found"; return 1; }
+toolchain_require python3
+
+attributes=${1:-500}
+iterations=${2:-1000}
+
+PYTHONPATH="${device_dir}/container/src" python3 - <<-EOF
+	import json
+	import random
+	import timeit
+
+	from baseline_device.util.dict import deep_copy, deep_diff, deep_patch, diff
+
+	random.seed(0)
+
+	def document(attributes):
+	  # groups of settings a few levels deep, with lists and mixed value types
+	  d = {}
+	  for i in range(attributes):
+	    group = d.setdefault(f'group{i % 10}', {}).setdefault(f'section{i % 7}', {})
+	    group[f'attribute{i}'] = random.choice([i, str(i) * 3, i % 2 == 0, [i, i + 1, i + 2], {'value': i, 'unit': 'ms'}])
+	  return d
+
+	reported = document(${attributes})
+
+	def changed(changes):
+	  desired = deep_copy(reported)
+	  for _ in range(changes):
+	    group = desired[random.choice(list(desired))]
+	    section = group[random.choice(list(group))]
+	    key = random.choice(list(section))
+	    if random.random() < 0.2: section.pop(key)
+	    else: section[key] = random.randint(0, 1000000)
+	  return desired
+
+	print(f'document: {${attributes}} attributes, {len(json.dumps(reported)):,} bytes')
+	print(f'{"changes":>8} {"full update":>12} {"minimal":>10} {"top-level diff":>15} {"deep_diff":>12} {"deep_patch":>12}')
+
+	for changes in [1, 10, 100]:
+	  desired = changed(changes)
+	  patch = deep_diff(reported, desired)
+	  assert deep_patch(deep_copy(reported), patch) == desired
+
+	  full = len(json.dumps({'state': {'reported': desired}}))
+	  minimal = len(json.dumps({'state': {'reported': patch}}))
+
+	  top = timeit.timeit(lambda: diff(reported, desired), number=${iterations}) / ${iterations} * 1e6
+	  deep = timeit.timeit(lambda: deep_diff(reported, desired), number=${iterations}) / ${iterations} * 1e6
+	  apply = timeit.timeit(lambda: deep_patch(deep_copy(reported), patch), number=${iterations}) / ${iterations} * 1e6
+
+	  print(f'{changes:>8} {full:>10,} B {minimal:>8,} B {top:>12.1f} us {deep:>9.1f} us {apply:>9.1f} us')
+
+	print('deep_patch includes a deep_copy of the document for each run')
+EOF
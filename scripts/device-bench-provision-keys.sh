@@ -0,0 +1,168 @@
+#!/bin/bash
+#
+# What is this?
+# This script compares how long provisioning takes on this machine with an
+# RSA-2048 and an EC P-256 device key. Each run generates the key, makes
+# the CSR, has it signed by the cloud's core.x509 against a throwaway CA,
+# and connects to a local TLS server with the new certificate, as the
+# device does to verify. Each connection waits 3 round trips of rtt_ms
+# (TCP, TLS and MQTT CONNECT) to stand in for the network to AWS IoT Core.
+# It reports the key generated inline (as before), generated while the
+# bootstrap connection is made, and taken from the spare service/keygen.py
+# leaves behind.
+#
+# How do I use it?
+# $ bash <project-root>/scripts/device-bench-provision-keys.sh [iterations] [rtt_ms]
+
+set -e
+
+script_dir=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+script_path=${script_dir}/$(basename "${BASH_SOURCE[0]}")
+script_name=$(basename ${BASH_SOURCE[0]})
+
+root_dir=$(cd "${script_dir}/.." && pwd)
+device_dir=${root_dir}/device
+cloud_dir=${root_dir}/cloud
+
+function toolchain_require() { [ -n "$(command -v $1)" ] && return 0 || >&2 echo "$1: not found"; return 1; }
+toolchain_require python3
+
+iterations=${1:-20}
+rtt_ms=${2:-50}
+
+bench_dir=$(mktemp -d)
+trap "rm -rf ${bench_dir}" EXIT
+
+cp -r "${device_dir}/container/src/baseline_device" "${bench_dir}/baseline_device"
+mkdir -p "${bench_dir}/cloud/src"
+cp -r "${cloud_dir}/src/baseline_cloud" "${bench_dir}/cloud/src/baseline_cloud"
+cp "${root_dir}/config.json" "${bench_dir}/cloud/src/config.json"
+
+python3 - <<-EOF
+	import json
+	with open('${bench_dir}/config.json', 'w') as f:
+	  json.dump({
+	    **json.loads('''$(cat "${root_dir}/config.json")'''),
+	    **json.loads('''$(cat "${device_dir}/container/config.json")'''),
+	    'provision_key_dir': '${bench_dir}/keys'
+	  }, f, indent=4)
+EOF
+
+PYTHONPATH="${bench_dir}:${bench_dir}/cloud/src" python3 - <<-EOF
+	import socket
+	import ssl
+	import statistics
+	import threading
+	import time
+	import uuid
+
+	import OpenSSL.crypto as openssl
+
+	from baseline_cloud.core import x509
+	from baseline_device.util import keys
+
+	def write(name, data):
+	  with open(f'${bench_dir}/{name}', 'w') as f:
+	    f.write(data)
+	  return f'${bench_dir}/{name}'
+
+	def certificate(subject, key, issuer, issuer_key, ca=False):
+	  crt = openssl.X509()
+	  crt.set_serial_number(uuid.uuid4().int)
+	  crt.gmtime_adj_notBefore(0)
+	  crt.gmtime_adj_notAfter(86400)
+	  crt.get_subject().CN = subject
+	  crt.set_issuer(issuer or crt.get_subject())
+	  crt.set_pubkey(key)
+	  if ca: crt.add_extensions([openssl.X509Extension(b'basicConstraints', True, b'CA:TRUE,pathlen:0')])
+	  crt.sign(issuer_key or key, 'sha256')
+	  return crt
+
+	# the CA, the endpoint and the bootstrap certificate are RSA-2048, as they are deployed
+	ca_key = keys.generate('rsa')
+	ca_crt = certificate('bench', ca_key, None, None, ca=True)
+	ca_key_pem = keys.dump(ca_key)
+	ca_crt_pem = openssl.dump_certificate(openssl.FILETYPE_PEM, ca_crt).decode('utf-8')
+	ca_path = write('ca.crt', ca_crt_pem)
+
+	server_key = keys.generate('rsa')
+	server_crt = certificate('localhost', server_key, ca_crt.get_subject(), ca_key)
+	bootstrap_key = keys.generate('rsa')
+	bootstrap_crt = certificate('bootstrap', bootstrap_key, ca_crt.get_subject(), ca_key)
+
+	server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+	server_context.load_cert_chain(write('server.crt', openssl.dump_certificate(openssl.FILETYPE_PEM, server_crt).decode('utf-8')), write('server.key', keys.dump(server_key)))
+	server_context.load_verify_locations(ca_path)
+	server_context.verify_mode = ssl.CERT_REQUIRED
+
+	server = socket.socket()
+	server.bind(('127.0.0.1', 0))
+	server.listen(16)
+
+	def serve():
+	  while True:
+	    sock, _ = server.accept()
+	    try:
+	      with server_context.wrap_socket(sock, server_side=True) as tls:
+	        tls.recv(1)
+	    except (OSError, ssl.SSLError):
+	      pass
+
+	threading.Thread(target=serve, daemon=True).start()
+
+	def connect(crt_path, key_path):
+	  # as paho's tls_set and connect do, a new context each time
+	  context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+	  context.check_hostname = False
+	  context.load_verify_locations(ca_path)
+	  context.load_cert_chain(crt_path, key_path)
+	  time.sleep(3 * ${rtt_ms} / 1000)
+	  with socket.create_connection(server.getsockname()) as sock:
+	    with context.wrap_socket(sock) as tls:
+	      tls.sendall(b'\0')
+
+	bootstrap = (write('bootstrap.crt', openssl.dump_certificate(openssl.FILETYPE_PEM, bootstrap_crt).decode('utf-8')), write('bootstrap.key', keys.dump(bootstrap_key)))
+
+	def provision(key_type, mode):
+	  times = {}
+	  start = time.perf_counter()
+
+	  if mode == 'inline':
+	    key = keys.generate(key_type)
+	    times['keygen'] = time.perf_counter() - start
+	    connect(*bootstrap)
+	  else:
+	    if mode == 'spare': keys.ensure_spare(key_type)
+	    start = time.perf_counter()
+	    future = keys.take_or_generate_async(key_type)
+	    connect(*bootstrap)
+	    times['keygen'] = time.perf_counter() - start
+	    key = future.result()
+	    times['keygen'] = time.perf_counter() - start - times['keygen']  # only the wait after connecting
+	  times['connect'] = time.perf_counter() - start
+
+	  mark = time.perf_counter()
+	  csr_pem = keys.create_csr(key, 'bench')
+	  times['csr'] = time.perf_counter() - mark
+
+	  mark = time.perf_counter()
+	  crt_pem = x509.sign_csr(csr_pem, ca_key_pem, ca_crt_pem, str(uuid.uuid4()), key_types=[key_type])
+	  times['sign'] = time.perf_counter() - mark
+
+	  mark = time.perf_counter()
+	  connect(write('client.crt', crt_pem), write('client.key', keys.dump(key)))
+	  times['verify'] = time.perf_counter() - mark
+
+	  times['total'] = time.perf_counter() - start
+	  return times
+
+	columns = ['keygen', 'connect', 'csr', 'sign', 'verify', 'total']
+	print(f'{"":>18}' + ''.join(f' {column:>10}' for column in columns))
+
+	for key_type in keys.KEY_TYPES:
+	  for mode in ['inline', 'overlapped', 'spare']:
+	    runs = [provision(key_type, mode) for _ in range(${iterations})]
+	    print(f'{key_type + " " + mode:>18}' + ''.join(f' {statistics.median(run[column] for run in runs) * 1000:>8.1f}ms' for column in columns))
+
+	print('median of ${iterations} runs; "keygen" is the time spent waiting on the key, "connect" is until the key and the bootstrap connection are both ready')
+EOF
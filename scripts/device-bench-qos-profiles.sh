@@ -0,0 +1,98 @@
+#!/bin/bash
+#
+# What is this?
+# This script measures local publish throughput for each QoS profile in
+# util/qos.py (and any qos_profiles in the device config.json). It publishes
+# a mix of log, telemetry, job, shadow and supervisor event messages through
+# util.aiomqtt.AsyncClient, letting the profile pick each message's QoS,
+# and waits for every acknowledgement. A throwaway mosquitto is started on
+# a free port, unless the host and port of a running broker are given.
+#
+# How do I use it?
+# $ bash <project-root>/scripts/device-bench-qos-profiles.sh [messages] [host] [port]
+
+set -e
+
+script_dir=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+script_path=${script_dir}/$(basename "${BASH_SOURCE[0]}")
+script_name=$(basename ${BASH_SOURCE[0]})
+
+root_dir=$(cd "${script_dir}/.." && pwd)
+device_dir=${root_dir}/device
+
+function toolchain_require() { [ -n "$(command -v $1)" ] && return 0 || >&2 echo "$1: not found"; return 1; }
+toolchain_require python3
+
+messages=${1:-20000}
+host=${2:-localhost}
+port=${3}
+
+bench_dir=$(mktemp -d)
+trap "rm -rf ${bench_dir}" EXIT
+
+if [ -z "${port}" ]; then
+  toolchain_require mosquitto
+  port=$(python3 -c "import socket; s = socket.socket(); s.bind(('localhost', 0)); print(s.getsockname()[1])")
+  printf "listener ${port} localhost\nallow_anonymous true\nmax_queued_messages 0\n" > "${bench_dir}/mosquitto.conf"
+  mosquitto -c "${bench_dir}/mosquitto.conf" > /dev/null 2>&1 &
+  mosquitto_pid=$!
+  trap "kill ${mosquitto_pid}; rm -rf ${bench_dir}" EXIT
+  sleep 1
+fi
+
+cp -r "${device_dir}/container/src/baseline_device" "${bench_dir}/baseline_device"
+
+python3 - <<-EOF
+	import json
+	with open('${bench_dir}/config.json', 'w') as f:
+	  json.dump({
+	    **json.loads('''$(cat "${root_dir}/config.json")'''),
+	    **json.loads('''$(cat "${device_dir}/container/config.json")''')
+	  }, f, indent=4)
+EOF
+
+PYTHONPATH="${bench_dir}" python3 - <<-EOF
+	import asyncio
+	import json
+	import time
+
+	import baseline_device.util.qos
+	from baseline_device import util
+	from baseline_device.util.aiomqtt import AsyncClient
+	from baseline_device.util.config import config
+
+	prefix = config.topic_prefix
+
+	# roughly what a busy device sends, most of it logs and telemetry
+	mix = [
+	  (f'outbox/{prefix}/things/bench/log', 40),
+	  (f'outbox/{prefix}/things/bench/metrics', 40),
+	  ('supervisor/processes/main/events/PROCESS_STATE', 10),
+	  ('\$aws/things/bench/shadow/name/sample/update', 8),
+	  ('\$aws/things/bench/jobs/job1/update', 2)
+	]
+	topics = [topic for topic, weight in mix for _ in range(weight)]
+	payload = json.dumps({'value': 'x' * 200})
+
+	async def bench(name):
+	  profile = util.qos.profile(name)
+	  client = AsyncClient(f'bench-{name}', qos_profile=profile)
+	  await client.connect('${host}', ${port})
+
+	  start = time.perf_counter()
+	  futures = [client.publish(topics[i % len(topics)], payload) for i in range(${messages})]
+	  await asyncio.gather(*futures)
+	  elapsed = time.perf_counter() - start
+
+	  await client.disconnect()
+
+	  levels = ' '.join(f'{k}={v}' for k, v in profile.levels.items())
+	  print(f'{name:>10} {${messages} / elapsed:>10,.0f} msg/s   {levels}')
+
+	async def main():
+	  for name in {**util.qos.PROFILES, **(config.qos_profiles or {})}:
+	    await bench(name)
+
+	print(f'{${messages}:,} messages of {len(payload)} bytes to ${host}:${port}')
+	asyncio.run(main())
+EOF
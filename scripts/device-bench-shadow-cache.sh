@@ -0,0 +1,100 @@
+#!/bin/bash
+#
+# What is this?
+# This script compares how long a local consumer takes to find out whether
+# a shadow's desired state has changed, and to read it, using the shared
+# memory cache in util/statecache.py against polling the JSON file the
+# shadows service also writes. It also runs a writer in another process
+# while reading, and checks that no read returns a torn document.
+#
+# How do I use it?
+# $ bash <project-root>/scripts/device-bench-shadow-cache.sh [attributes] [iterations]
+
+set -e
+
+script_dir=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+script_path=${script_dir}/$(basename "${BASH_SOURCE[0]}")
+script_name=$(basename ${BASH_SOURCE[0]})
+
+root_dir=$(cd "${script_dir}/.." && pwd)
+device_dir=${root_dir}/device
+
+function toolchain_require() { [ -n "$(command -v $1)" ] && return 0 || >&2 echo "$1: not found"; return 1; }
+toolchain_require python3
+
+attributes=${1:-500}
+iterations=${2:-10000}
+
+bench_dir=$(mktemp -d)
+trap "rm -rf ${bench_dir}" EXIT
+
+cp -r "${device_dir}/container/src/baseline_device" "${bench_dir}/baseline_device"
+
+python3 - <<-EOF
+	import json
+	with open('${bench_dir}/config.json', 'w') as f:
+	  json.dump({
+	    **json.loads('''$(cat "${root_dir}/config.json")'''),
+	    **json.loads('''$(cat "${device_dir}/container/config.json")'''),
+	    'shadow_cache_dir': '${bench_dir}/shm'
+	  }, f, indent=4)
+EOF
+
+PYTHONPATH="${bench_dir}" python3 - <<-EOF
+	import json
+	import multiprocessing
+	import os
+	import time
+	import timeit
+
+	from baseline_device.util.file import write_atomic
+	from baseline_device.util.statecache import StateReader, StateWriter, path
+
+	desired = {f'attribute{i}': {'value': i, 'unit': 'ms', 'enabled': i % 2 == 0} for i in range(${attributes})}
+	data = json.dumps(desired)
+
+	file = '${bench_dir}/sample.json'
+	write_atomic(file, data)
+
+	writer = StateWriter(path('sample'))
+	writer.write(1, data.encode())
+	reader = StateReader(path('sample'))
+	reader.read()
+
+	def file_changed(mtime=os.stat(file).st_mtime_ns):
+	  return os.stat(file).st_mtime_ns != mtime
+
+	def file_read():
+	  with open(file) as f:
+	    return json.load(f)
+
+	def us(f):
+	  return timeit.timeit(f, number=${iterations}) / ${iterations} * 1e6
+
+	print(f'document: {${attributes}} attributes, {len(data):,} bytes')
+	print(f'{"":>24} {"file":>10} {"statecache":>12}')
+	print(f'{"changed?":>24} {us(file_changed):>7.2f} us {us(reader.changed):>9.2f} us')
+	print(f'{"read":>24} {us(file_read):>7.2f} us {us(reader.read):>9.2f} us')
+	print(f'{"version":>24} {"":>10} {us(reader.version):>9.2f} us')
+
+	def write(stop):
+	  version = 1
+	  while not stop.is_set():
+	    version += 1
+	    writer.write(version, json.dumps({**desired, 'version': version, 'padding': 'x' * (version % 1000)}).encode())
+
+	stop = multiprocessing.Event()
+	process = multiprocessing.Process(target=write, args=(stop,))
+	process.start()
+
+	reads, torn, end = 0, 0, time.monotonic() + 2
+	while time.monotonic() < end:
+	  version, document = reader.read()
+	  reads += 1
+	  if version > 1 and (document['version'] != version or len(document['padding']) != version % 1000): torn += 1
+
+	stop.set()
+	process.join()
+
+	print(f'{reads:,} reads during concurrent writes, {torn} torn')
+EOF
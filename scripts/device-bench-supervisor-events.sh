@@ -0,0 +1,74 @@
+#!/bin/bash
+#
+# What is this?
+# This script measures how many supervisor events per second the events
+# listener can parse and turn into MQTT publishes. It feeds a stream of
+# synthetic PROCESS_STATE and PROCESS_LOG events through the same parser
+# and publish path as service/supervisor/events.py, with the MQTT client
+# replaced by a counter, so only the listener's own cost is measured.
+#
+# How do I use it?
+# $ bash <project-root>/scripts/device-bench-supervisor-events.sh [events]
+
+set -e
+
+script_dir=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+script_path=${script_dir}/$(basename "${BASH_SOURCE[0]}")
+script_name=$(basename ${BASH_SOURCE[0]})
+
+root_dir=$(cd "${script_dir}/.." && pwd)
+device_dir=${root_dir}/device
+
+function toolchain_require() { [ -n "$(command -v $1)" ] && return 0 || >&2 echo "$1: not found"; return 1; }
+toolchain_require python3
+
+events=${1:-100000}
+
+bench_dir=$(mktemp -d)
+trap "rm -rf ${bench_dir}" EXIT
+
+cp -r "${device_dir}/container/src/baseline_device" "${bench_dir}/baseline_device"
+
+python3 - <<-EOF
+	import json
+	with open('${bench_dir}/config.json', 'w') as f:
+	  json.dump({
+	    **json.loads('''$(cat "${root_dir}/config.json")'''),
+	    **json.loads('''$(cat "${device_dir}/container/config.json")''')
+	  }, f, indent=4)
+EOF
+
+PYTHONPATH="${bench_dir}" BASELINE_CLIENT_ID=bench python3 - <<-EOF
+	import time
+
+	from baseline_device.util.py import load_source
+	from baseline_device.util.supervisor import EventParser
+
+	events = load_source('events', '${bench_dir}/baseline_device/service/supervisor/events.py')
+
+	class Client(object):
+	  published = 0
+	  def publish(self, topic, payload=None, qos=0, retain=False):
+	    self.published += 1
+
+	def event(serial, eventname, payload):
+	  payload = payload.encode()
+	  headers = f'ver:3.0 server:supervisor serial:{serial} pool:events poolserial:{serial} eventname:{eventname} len:{len(payload)}\n'
+	  return headers.encode() + payload
+
+	stream = b''.join(
+	  event(i, 'PROCESS_STATE_RUNNING', 'processname:jobs_sample1 groupname:jobs_sample1 from_state:STARTING pid:1234') if i % 2 else
+	  event(i, 'PROCESS_LOG_STDOUT', 'processname:main groupname:main pid:1234 channel:stdout\nINFO:root:time 12:00:00 a: b')
+	  for i in range(${events}))
+
+	client = Client()
+	parser = EventParser()
+
+	start = time.perf_counter()
+	for offset in range(0, len(stream), 4096):
+	  for headers, payload in parser.feed(stream[offset:offset + 4096]):
+	    events.publish_event(client, headers, payload)
+	elapsed = time.perf_counter() - start
+
+	print(f'{client.published} events in {elapsed:.3f}s, {client.published / elapsed:,.0f} events/s')
+EOF
@@ -60,6 +60,12 @@ pushd overlay
   cp "${device_dir}/container/files/supervisord.conf.template" etc/${app_name}/supervisord.conf
   rewrite app_name ${app_name} etc/${app_name}/supervisord.conf
 
+  cp "${device_dir}/container/files/supervisord.processes.conf.template" etc/${app_name}/supervisord.processes.conf
+  rewrite app_name ${app_name} etc/${app_name}/supervisord.processes.conf
+
+  cp "${device_dir}/container/files/supervisord.agent.conf.template" etc/${app_name}/supervisord.agent.conf
+  rewrite app_name ${app_name} etc/${app_name}/supervisord.agent.conf
+
   mkdir -p opt/${app_name}
   cp "${device_dir}/container/files/mosquitto.sh.template" opt/${app_name}/mosquitto.sh
   rewrite app_name ${app_name} opt/${app_name}/mosquitto.sh